@@ -0,0 +1,190 @@
+"""Latency of /api/thumbnail while /api/videos pages and a reload write to the db
+
+    python -m benchmarks.api_latency [rows] [seconds]
+
+Same handlers both times: `before` runs their db work (and the reload's batch
+writes) on the event loop like they used to, `after` on the db threads.
+"""
+
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import urlencode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# The app's db & thumbnail pack live under ~, give it a scratch one
+os.environ["HOME"] = tempfile.mkdtemp(prefix="file-browser-bench-")
+
+from fastapi import FastAPI
+from sqlmodel import Session
+
+from benchmarks.insert_throughput import make_videos
+from main import app
+from src.api import normal_session
+from src.catalog import catalog
+from src.config import INGEST_BATCH_SIZE
+from src.models import VideosDataBase, thumbnail_key
+from src.sessions import DatabaseExecutor
+from src.utils.columns import video_columns
+from src.utils.pipeline import add_modals_to_db
+from src.utils.thumbnail_store import thumbnail_store
+
+THUMBNAIL_CLIENTS = 8
+LISTING_CLIENTS = 2
+PAGE_SIZE = 60
+SORTS = ["date", "duration", "size", "title"]
+
+
+def seed(rows: int):
+    videos = make_videos(rows)
+    for video in videos:
+        thumbnail_store.put(thumbnail_key(video.thumbnail_path), b"RIFF\0\0\0\0WEBP")
+    with Session(normal_session.engine) as session:
+        add_modals_to_db(session, videos, print)
+        video_columns.load(session)
+    catalog.bump()
+    return [video.id for video in videos]
+
+
+async def get(app: FastAPI, path: str, **params) -> int:
+    """Calls the app in-process (no sockets, no client library), returns the status"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": urlencode(params).encode(),
+        "root_path": "",
+        "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 0),
+        "server": ("bench", 80),
+    }
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    # A socket round trip would give the loop back, a handler that never awaits doesn't
+    await asyncio.sleep(0)
+    return status
+
+
+class InlineExecutor(DatabaseExecutor):
+    """The db work right on the event loop, what the handlers used to do"""
+
+    async def read(self, fn, *args):
+        return self._call(fn, args, False)
+
+    async def write(self, fn, *args):
+        return self._call(fn, args, True)
+
+
+def use_executor(executor: DatabaseExecutor):
+    normal_session.db = executor
+
+
+def make_batch(numbers: Iterator[int]) -> list[VideosDataBase]:
+    videos = make_videos(INGEST_BATCH_SIZE)
+    for video, i in zip(videos, numbers):
+        video.id = f"{i:0128x}"
+        video.video_path = video.fingerprint.path = f"/videos/reload/video-{i}.mp4"
+    return videos
+
+
+async def reload(stop: asyncio.Event, blocking: bool, numbers: Iterator[int]):
+    """Batches of new rows like the ingest pipeline's, each one bumps the catalog"""
+
+    def write(batch: list[VideosDataBase]):
+        with Session(normal_session.engine) as session:
+            add_modals_to_db(session, batch, print)
+            video_columns.refresh(session, [video.id for video in batch])
+        catalog.bump()
+
+    while not stop.is_set():
+        batch = make_batch(numbers)
+        if blocking:
+            write(batch)
+        else:
+            await asyncio.to_thread(write, batch)
+        await asyncio.sleep(0.05)  # probes & thumbnails of the next batch
+
+
+async def measure(
+    app: FastAPI,
+    ids: list[str],
+    seconds: float,
+    blocking: bool,
+    numbers: Iterator[int],
+):
+    latencies: list[float] = []
+    listings = 0
+    stop = asyncio.Event()
+
+    async def thumbnails():
+        while not stop.is_set():
+            start = time.perf_counter()
+            status = await get(app, "/api/thumbnail", video_id=random.choice(ids))
+            latencies.append(time.perf_counter() - start)
+            assert status == 200, status
+
+    async def listing():
+        nonlocal listings
+        while not stop.is_set():
+            sort_by = random.choice(SORTS)
+            status = await get(app, "/api/videos", sort_by=sort_by, limit=PAGE_SIZE)
+            assert status == 200, status
+            listings += 1
+
+    tasks = [asyncio.create_task(thumbnails()) for _ in range(THUMBNAIL_CLIENTS)]
+    tasks += [asyncio.create_task(listing()) for _ in range(LISTING_CLIENTS)]
+    tasks.append(asyncio.create_task(reload(stop, blocking, numbers)))
+
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return latencies, listings
+
+
+def main(rows: int, seconds: float):
+    ids = seed(rows)
+    # Rows the reloads add, numbered after the seeded ones
+    numbers = itertools.count(rows)
+    threaded = normal_session.db
+    for name, executor, blocking in (
+        ("before", InlineExecutor(normal_session.engine), True),
+        ("after", threaded, False),
+    ):
+        use_executor(executor)
+        latencies, listings = asyncio.run(
+            measure(app, ids, seconds, blocking, numbers)
+        )
+        cuts = statistics.quantiles(latencies, n=100)
+        print(
+            f"{name:>6}: /api/thumbnail p50 {cuts[49] * 1000:6.1f}ms "
+            f"p99 {cuts[98] * 1000:6.1f}ms max {max(latencies) * 1000:6.1f}ms "
+            f"({len(latencies) / seconds:6.0f} req/s, {listings / seconds:4.0f} pages/s)"
+        )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20_000,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 10.0,
+    )
@@ -0,0 +1,80 @@
+"""Encoding listings: `VideoResponse` + `jsonable_encoder` vs plain dicts through `dumps`
+
+    python -m benchmarks.encode_listing [rows]
+
+`dumps` is orjson's when the `speedups` extra is installed, the stdlib json's otherwise.
+"""
+
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi.encoders import jsonable_encoder
+from sqlmodel import Session
+
+from benchmarks.insert_throughput import make_videos
+from src.config import CATALOG_STREAM_CHUNK
+from src.data_store import (
+    create_engine_url,
+    create_models,
+    create_search_index,
+    create_tuned_engine,
+)
+from src.models import DeletedVideo, SQLModel, VideoResponse, VideosDataBase
+from src.utils import fastjson
+from src.utils.columns import VideoColumns, VideoRecord
+from src.utils.pipeline import add_modals_to_db
+
+PAGE_SIZE = 500
+
+
+def pydantic_encode(videos: list[VideoRecord]) -> bytes:
+    """What FastAPI did with the returned models: validate, encode, then `json`"""
+    models = [VideoResponse(**video.as_dict()) for video in videos]
+    content = jsonable_encoder({"videos": models})
+    return json.dumps(content, separators=(",", ":")).encode()
+
+
+def fast_encode(videos: list[VideoRecord]) -> bytes:
+    return fastjson.dumps({"videos": [video.as_dict() for video in videos]})
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main(rows: int):
+    print(f"dumps: {'orjson' if fastjson.orjson else 'json'}")
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_tuned_engine(create_engine_url("bench.db", tmp))
+        create_models(SQLModel, engine, excludes=[DeletedVideo])
+        create_search_index(engine, VideosDataBase.__tablename__)  # type: ignore
+        with Session(engine) as session:
+            add_modals_to_db(session, make_videos(rows), print)
+            columns = VideoColumns()
+            columns.load(session)
+
+    videos = columns.all()
+    for name, encode in (("before", pydantic_encode), ("after", fast_encode)):
+        page = min(timed(encode, videos[:PAGE_SIZE]) for _ in range(20))
+        whole = timed(encode, videos)
+        print(
+            f"{name:>7}: {PAGE_SIZE}-row page {page * 1000:6.2f}ms, "
+            f"{rows} rows {whole * 1000:7.0f}ms"
+        )
+
+    # The NDJSON catalog: its first chunk is out long before the last is encoded
+    start = time.perf_counter()
+    chunk = videos[:CATALOG_STREAM_CHUNK]
+    b"".join(fastjson.dumps(video.as_dict()) + b"\n" for video in chunk)
+    print(f" ndjson: first {len(chunk)} rows after {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
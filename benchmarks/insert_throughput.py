@@ -0,0 +1,109 @@
+"""Insert throughput of the db layer: `session.add` on a default engine vs bulk on a tuned one
+
+    python -m benchmarks.insert_throughput [rows]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlmodel import Session, create_engine
+
+from src.config import BULK_CHUNK_SIZE
+from src.data_store import (
+    chunked,
+    create_engine_url,
+    create_models,
+    create_search_index,
+    create_tuned_engine,
+)
+from src.models import (
+    DeletedVideo,
+    SQLModel,
+    VideoFingerprint,
+    VideosDataBase,
+)
+from src.utils.pipeline import add_modals_to_db
+from src.utils.video_processing import apply_probe
+
+PROBE = {
+    "streams": [
+        {"index": 0, "codec_type": "video", "codec_name": "h264", "width": 1920,
+         "height": 1080, "avg_frame_rate": "30000/1001", "bit_rate": "4000000"},
+        {"index": 1, "codec_type": "audio", "codec_name": "aac"},
+    ],
+    "format": {"format_name": "mov,mp4,m4a,3gp,3g2,mj2", "duration": "61.5",
+               "size": "31457280", "bit_rate": "4091000"},
+}
+
+
+def make_videos(count: int) -> list[VideosDataBase]:
+    videos = []
+    for i in range(count):
+        path = f"/videos/folder-{i % 100}/video-{i}.mp4"
+        video = VideosDataBase(
+            id=f"{i:0128x}",
+            title=f"video {i}",
+            video_path=path,
+            thumbnail_path=f"/thumbs/{i}.webp",
+            duration=61,
+            filesize=31457280 + i,
+            modified_time=1_700_000_000 + i,
+            fingerprint=VideoFingerprint(
+                path=path, size=31457280 + i, mtime_ns=i, inode=i, device=1
+            ),
+        )
+        apply_probe(video, PROBE)
+        videos.append(video)
+    return videos
+
+
+def setup(engine):
+    create_models(SQLModel, engine, excludes=[DeletedVideo])
+    create_search_index(engine, VideosDataBase.__tablename__)  # type: ignore
+
+
+def before(url: str, videos: list[VideosDataBase]):
+    """What reloads used to do: default engine, one `session.add` per row, one commit"""
+    engine = create_engine(url)
+    setup(engine)
+    with Session(engine) as session:
+        for video in videos:
+            session.add(video)
+        session.commit()
+    engine.dispose()
+
+
+def after(url: str, videos: list[VideosDataBase]):
+    engine = create_tuned_engine(url)
+    setup(engine)
+    with Session(engine) as session:
+        for chunk in chunked(videos, BULK_CHUNK_SIZE):
+            add_modals_to_db(session, chunk, print)
+    engine.dispose()
+
+
+def main(rows: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, run in (("before", before), ("after", after)):
+            # Built outside the timer, rows are models in both cases
+            videos = make_videos(rows)
+            url = create_engine_url(f"{name}.db", tmp)
+
+            start = time.perf_counter()
+            run(url, videos)
+            elapsed = time.perf_counter() - start
+
+            size = os.path.getsize(url.removeprefix("sqlite:///")) / 2**20
+            print(
+                f"{name:>6}: {rows} rows in {elapsed:6.2f}s "
+                f"({rows / elapsed:8.0f} rows/s, {size:.1f} MiB)"
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,111 @@
+"""Listing pages: ORM rows into `VideoResponse`s vs the in-memory columns, plus their size
+
+    python -m benchmarks.listing_pages [rows] [pages]
+"""
+
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlmodel import Session, col, select
+
+from benchmarks.insert_throughput import make_videos
+from src.config import INGEST_BATCH_SIZE
+from src.data_store import (
+    create_engine_url,
+    create_models,
+    create_search_index,
+    create_tuned_engine,
+)
+from src.models import DeletedVideo, SQLModel, VideosDataBase
+from src.utils.columns import VideoColumns
+from src.utils.helpers import convert_db_to_response
+from src.utils.listing import SORT_COLUMNS, listing_sort_key
+from src.utils.pipeline import add_modals_to_db
+
+PAGE_SIZE = 60
+# Pages between two of the reload's batches
+WRITE_EVERY = 5
+
+
+def orm_page(session: Session, sort_key, offset: int):
+    """What the listing did before: full rows, parsed `extras` and all"""
+    query = select(VideosDataBase).order_by(
+        *(
+            col(getattr(VideosDataBase, name)).desc()
+            if desc
+            else col(getattr(VideosDataBase, name)).asc()
+            for name, desc in sort_key
+        )
+    )
+    rows = session.exec(query.offset(offset).limit(PAGE_SIZE)).all()
+    return [convert_db_to_response(row) for row in rows]
+
+
+def columns_page(columns: VideoColumns, sort_key, cursor):
+    return [record.as_dict() for record in columns.page(sort_key, None, None, cursor, PAGE_SIZE)]
+
+
+def main(rows: int, pages: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_tuned_engine(create_engine_url("bench.db", tmp))
+        create_models(SQLModel, engine, excludes=[DeletedVideo])
+        create_search_index(engine, VideosDataBase.__tablename__)  # type: ignore
+        with Session(engine) as session:
+            videos = make_videos(rows)
+            add_modals_to_db(session, videos, print)
+
+            columns = VideoColumns()
+            tracemalloc.start()
+            columns.load(session)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"columns: {rows} rows in {size / 2**20:.1f} MiB ({size / rows:.0f} B/video)")
+
+            # Same random pages both times, up to a few dozen deep into the listing
+            random.seed(0)
+            requests = []
+            for _ in range(pages):
+                sort_key = listing_sort_key(random.choice(list(SORT_COLUMNS)), False, False)
+                offset = random.randrange(0, min(rows, 2000), PAGE_SIZE)
+                before = columns.page(sort_key, None, None, None, offset)[-1:]
+                cursor = [getattr(before[0], name) for name, _ in sort_key] if before else None
+                requests.append((sort_key, offset, cursor))
+
+            def write_batch():
+                # What a reload does between pages: a batch of rows changes
+                batch = random.sample(videos, INGEST_BATCH_SIZE)
+                for video in batch:
+                    session.get(VideosDataBase, video.id).filesize += 1
+                session.commit()
+                columns.refresh(session, [video.id for video in batch])
+
+            for writes in (False, True):
+                for name, page in (
+                    ("before", lambda key, offset, _: orm_page(session, key, offset)),
+                    ("after", lambda key, _, cursor: columns_page(columns, key, cursor)),
+                ):
+                    elapsed = 0.0
+                    for i, request in enumerate(requests):
+                        if writes and i % WRITE_EVERY == 0:
+                            write_batch()
+                        start = time.perf_counter()
+                        page(*request)
+                        elapsed += time.perf_counter() - start
+                    print(
+                        f"{name:>7}: {pages} pages in {elapsed:6.2f}s "
+                        f"({elapsed / pages * 1000:6.2f}ms/page)"
+                        + (f", a batch written every {WRITE_EVERY}" if writes else "")
+                    )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 500,
+    )
@@ -1,15 +1,72 @@
-from fastapi import Depends, FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+import json
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from rich.console import Console
 import uvicorn
 
 from src.api import Session, normal_session, router
+from src.api.exceptions import ReloadJobNotFound
+from src.api.duplicates import router
 from src.api.thumbnails import router
 from src.api.videos import router
-from src.utils.helpers import reload_data
+from src.config import WATCH_ROOT_DIRS
+from src.jobs import ReloadJob, reload_jobs
+from src.utils.columns import video_columns
+from src.utils.helpers import (
+    backfill_video_metadata,
+    pack_legacy_thumbnails,
+    reload_data,
+)
+from src.utils.hls import hls_segments
+from src.utils.remux import faststart_remuxer
+from src.utils.scrub import scrub_previews
+from src.utils.thumbnail_store import thumbnail_store
+from src.watcher import LibraryWatcher
+
+console = Console()
+
+# Seconds between progress events, and between keep-alives when nothing changed
+PROGRESS_INTERVAL = 0.5
+KEEPALIVE_INTERVAL = 15
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fill the metadata columns of rows indexed before they existed
+    with Session(normal_session.engine) as session:
+        backfill_video_metadata(session)
+        if packed := pack_legacy_thumbnails(session):
+            console.print(f"Moved {packed} thumbnail files into the thumbnail pack")
+        # Listings are served from memory from here on, writers keep it current
+        video_columns.load(session)
+    # Indexed now, not by the first thumbnail request
+    thumbnail_store.open()
 
-app = FastAPI()
+    watcher = None
+    if WATCH_ROOT_DIRS:
+        library_watcher = LibraryWatcher(
+            normal_session.engine, lambda: reload_jobs.start(False, run_reload)
+        )
+        watcher = asyncio.create_task(library_watcher.run())
+
+    yield
+
+    if watcher:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+    await reload_jobs.shutdown()
+    await scrub_previews.shutdown()
+    await hls_segments.shutdown()
+    if faststart_remuxer:
+        await faststart_remuxer.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Mount static files (CSS, JS)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -24,15 +81,67 @@ app.add_middleware(
 )
 
 
-# Endpoint to reload
-@app.post("/reload")
-async def update_data_store(
-    hard: bool = False, session: Session = Depends(normal_session.get_session)
-):
-    if await reload_data(session, hard):
-        return 200
-    else:
-        raise HTTPException(500, detail="Internal Server Error!")
+async def run_reload(job: ReloadJob):
+    # Sessions of its own, the request that started it is long gone
+    await reload_data(normal_session.engine, job.hard, job)
+
+
+def get_job(job_id: str) -> ReloadJob:
+    job = reload_jobs.get(job_id)
+    if job is None:
+        raise ReloadJobNotFound(job_id)
+    return job
+
+
+# Reloads run in the background, a reload already running is joined instead
+@app.post("/reload", status_code=202)
+async def update_data_store(hard: bool = False):
+    job, started = reload_jobs.start(hard, run_reload)
+    return {**job.as_dict(), "started": started}
+
+
+@app.get("/reload/{job_id}")
+async def reload_status(job_id: str):
+    return get_job(job_id).as_dict()
+
+
+@app.delete("/reload/{job_id}", status_code=202)
+async def cancel_reload(job_id: str):
+    job = get_job(job_id)
+    return {**job.as_dict(), "cancelled": reload_jobs.cancel(job)}
+
+
+@app.get("/reload/{job_id}/events")
+async def reload_events(job_id: str, request: Request):
+    """Server-Sent Events: a `progress` event per change, `end` once the job stops"""
+    job = get_job(job_id)
+
+    async def events():
+        revision, idle = -1, 0.0
+        while not await request.is_disconnected():
+            if job.revision != revision:
+                revision = job.revision
+                status = job.as_dict()
+                name = "progress" if status["state"] == "running" else "end"
+                yield f"event: {name}\ndata: {json.dumps(status)}\n\n"
+                if name == "end":
+                    return
+                idle = 0.0
+
+            elif idle >= KEEPALIVE_INTERVAL:
+                # Keeps proxies from closing a quiet connection
+                yield ": keep-alive\n\n"
+                idle = 0.0
+
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            idle += PROGRESS_INTERVAL
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # No caching, and no buffering by nginx & co
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/favicon.ico")
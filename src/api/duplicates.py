@@ -0,0 +1,100 @@
+import asyncio
+
+from fastapi import Header, Request, Response
+
+from src.catalog import catalog, revalidate
+from src.models import DeletedVideo, DuplicatesTrash
+from src.utils.columns import VideoRecord, video_columns
+from src.utils.duplicates import (
+    duplicate_groups,
+    library_path,
+    shared_hashes,
+    trash_copies,
+    wasted,
+)
+from src.utils.fastjson import FastJSONResponse
+from src.utils.fingerprints import fetch_entries
+from src.api import (
+    router,
+    normal_session,
+    deleted_video_session,
+    Session,
+    HTTPException,
+)
+
+
+def copy_response(copy: VideoRecord, path: str) -> dict:
+    return {**copy.as_dict(), "path": library_path(path)}
+
+
+@router.get("/duplicates")
+async def get_duplicates(request: Request, response: Response):
+    if not_modified := revalidate(request, response):
+        return not_modified
+
+    hashes = await normal_session.db.read(shared_hashes)
+    groups = await asyncio.to_thread(duplicate_groups, hashes)
+    return FastJSONResponse(
+        {
+            "groups": [
+                {
+                    "content_hash": content_hash,
+                    # The first copy is the one trashing keeps
+                    "keep": copies[0].id,
+                    "wasted": wasted(copies),
+                    "videos": [copy_response(copy, copy.video_path) for copy in copies],
+                }
+                for content_hash, copies in groups
+            ],
+            "wasted": sum(wasted(copies) for _, copies in groups),
+        },
+        headers=response.headers,
+    )
+
+
+@router.post("/duplicates/trash")
+async def trash_duplicates(payload: DuplicatesTrash, user: str = Header(...)):
+    if user != "maxim":
+        raise HTTPException(401, "Unauthorized")
+
+    hashes = await normal_session.db.read(shared_hashes, payload.content_hashes)
+    groups = await asyncio.to_thread(duplicate_groups, hashes)
+    # Moved, not deleted, the trash is only emptied by hand
+    trashed, failed = await asyncio.to_thread(trash_copies, groups)
+    trash_paths = {copy.id: path for copy, path in trashed}
+
+    # The ORM delete takes the probes & fingerprints along
+    def delete_rows(session: Session):
+        entries = fetch_entries(session, list(trash_paths))
+        for entry in entries:
+            session.delete(entry)
+        return entries
+
+    entries = await normal_session.db.write(delete_rows)
+    await deleted_video_session.db.write(
+        Session.add_all,
+        [
+            DeletedVideo(
+                id=entry.id,
+                title=entry.title,
+                video_path=trash_paths[entry.id],
+                duration=entry.duration,
+                filesize=entry.filesize,
+                extras=entry.extras,
+            )
+            for entry in entries
+        ],
+    )
+    video_columns.remove(list(trash_paths))
+    catalog.bump()
+
+    for entry in entries:
+        entry.delete_thumb()
+
+    return FastJSONResponse(
+        {
+            "trashed": [copy_response(copy, path) for copy, path in trashed],
+            "freed": sum(copy.filesize for copy, _ in trashed),
+            "failed": [copy.id for copy in failed],
+        }
+    )
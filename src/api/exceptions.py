@@ -15,3 +15,40 @@ class FileNotFoundOnServer(HTTPException):
         if file_path:
             msg += f" (path: {file_path})"
         super().__init__(status_code=404, detail=msg)
+
+
+class InvalidListingQuery(HTTPException):
+    def __init__(self, reason: str):
+        super().__init__(status_code=400, detail=f"Invalid listing query: {reason}")
+
+
+class UnknownThumbnailSize(HTTPException):
+    def __init__(self, size: str):
+        super().__init__(status_code=400, detail=f"Unknown thumbnail size: {size}")
+
+
+class AtlasNotFound(HTTPException):
+    def __init__(self, key: str):
+        super().__init__(status_code=404, detail=f"No atlas with key: {key}")
+
+
+class ScrubFileNotFound(HTTPException):
+    def __init__(self, name: str):
+        super().__init__(status_code=404, detail=f"No scrub preview file: {name}")
+
+
+class ReloadJobNotFound(HTTPException):
+    def __init__(self, job_id: str):
+        super().__init__(status_code=404, detail=f"No reload job with id: {job_id}")
+
+
+class StreamNotAvailable(HTTPException):
+    def __init__(self, video_id: str):
+        super().__init__(
+            status_code=404, detail=f"No HLS stream for video with id: {video_id}"
+        )
+
+
+class HlsFileNotFound(HTTPException):
+    def __init__(self, name: str):
+        super().__init__(status_code=404, detail=f"No HLS file: {name}")
@@ -1,47 +1,137 @@
-from fastapi import HTTPException
-from src.models import VideosDataBase
+import asyncio
+import mimetypes
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import RedirectResponse
+from src.api.exceptions import AtlasNotFound, ScrubFileNotFound, UnknownThumbnailSize
+from src.catalog import catalog, etag_matches
+from src.config import THUMBNAIL_SIZES
+from src.models import VideosDataBase, thumbnail_key, thumbnail_url
+from src.utils.atlas import KEY_PATTERN, atlas_store
+from src.utils.columns import video_columns
+from src.utils.processes import Priority
+from src.utils.scrub import FILE_PATTERN, scrub_previews
+from src.utils.thumbnail_store import thumbnail_store
 from src.api import (
     router,
-    select,
     normal_session,
-    Depends,
     Session,
     FileResponse,
     VideoInfoNotFound,
     FileNotFoundOnServer,
 )
 
+# The versioned URLs never change content, a new thumbnail gets a new URL
+IMMUTABLE = "public, max-age=31536000, immutable"
 
-@router.get("/thumbnail")
-async def get_thumbnail(
-    video_id: str, session: Session = Depends(normal_session.get_session)
-):
-    video_server = session.exec(
-        select(VideosDataBase).where(VideosDataBase.id == video_id)
-    ).first()
 
-    if not video_server:
+def thumbnail_file(video_id: str, size: str | None) -> tuple[str, str]:
+    """(thumbnail path of the video, name in the store to serve for `size`)"""
+    if size is not None and size not in THUMBNAIL_SIZES:
+        raise UnknownThumbnailSize(size)
+
+    thumbnail_path = video_columns.thumbnail_path(video_id)
+    if thumbnail_path is None:
         raise VideoInfoNotFound(video_id)
 
-    if not video_server.exist():
+    name = stored_thumbnail(thumbnail_path, size)
+    if name is None:
+        raise FileNotFoundOnServer()
+    return thumbnail_path, name
+
+
+def stored_thumbnail(thumbnail_path: str, size: str | None) -> str | None:
+    # Thumbnails made before the sizes existed only have the default one
+    for name in (thumbnail_key(thumbnail_path, size), thumbnail_key(thumbnail_path)):
+        if thumbnail_store.exists(name):
+            return name
+    return None
+
+
+async def serve_thumbnail(name: str, cache_control: str, etag: str | None = None):
+    headers = {"Cache-Control": cache_control, "Access-Control-Allow-Origin": "*"}
+    if etag:
+        headers["ETag"] = etag
+
+    # A view of the pack's mmap, sent as is. Off the loop, ingest & compaction
+    # hold the pack's lock while they write
+    data = await asyncio.to_thread(thumbnail_store.read, name)
+    if data is None:
         raise FileNotFoundOnServer()
+    return Response(data, media_type=mimetypes.guess_type(name)[0], headers=headers)
+
+
+@router.get("/thumbnail")
+async def get_thumbnail(request: Request, video_id: str, size: str | None = None):
+    _, name = await asyncio.to_thread(thumbnail_file, video_id, size)
+
+    # Unversioned, so the browser has to ask every time
+    etag = f'"{name}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return await serve_thumbnail(name, "no-cache", etag)
+
+
+@router.get("/thumbnail/{video_id}/{version}")
+async def get_versioned_thumbnail(video_id: str, version: str, size: str | None = None):
+    thumbnail_path, name = await asyncio.to_thread(thumbnail_file, video_id, size)
 
-    response = FileResponse(
-        video_server.thumbnail_path,
-        filename=(video_server.title + ".jpg"),
+    current = thumbnail_url(video_id, thumbnail_path)
+    if current.rsplit("/", 1)[1] != version:
+        # Regenerated since this URL was handed out
+        url = current + (f"?size={size}" if size else "")
+        return RedirectResponse(url, headers={"Cache-Control": "no-cache"})
+
+    return await serve_thumbnail(name, IMMUTABLE)
+
+
+@router.get("/atlas/{key}")
+async def get_atlas(key: str):
+    if not KEY_PATTERN.fullmatch(key):
+        raise AtlasNotFound(key)
+
+    path = await atlas_store.image(key)
+    if path is None:
+        raise AtlasNotFound(key)
+
+    # Keyed by the thumbnails in it, like the versioned thumbnail URLs
+    return FileResponse(
+        path, headers={"Cache-Control": IMMUTABLE, "Access-Control-Allow-Origin": "*"}
     )
-    response.headers["Access-Control-Allow-Origin"] = "*"
 
-    return response
+
+@router.get("/scrub/{video_id}")
+async def get_scrub_preview(video_id: str, response: Response):
+    video_server = await normal_session.db.read(Session.get, VideosDataBase, video_id)
+    if not video_server:
+        raise VideoInfoNotFound(video_id)
+
+    status = scrub_previews.status(video_server)
+    if status["state"] == "pending":
+        # Made in the background, ask again in a bit
+        response.status_code = 202
+    return status
+
+
+@router.get("/scrub/files/{name}")
+async def get_scrub_file(name: str):
+    if not FILE_PATTERN.fullmatch(name):
+        raise ScrubFileNotFound(name)
+
+    path = scrub_previews.root / name
+    if not path.exists():
+        raise ScrubFileNotFound(name)
+
+    # Named after the video's size & mtime, a changed file gets new ones
+    return FileResponse(
+        path, headers={"Cache-Control": IMMUTABLE, "Access-Control-Allow-Origin": "*"}
+    )
 
 
 @router.patch("/thumbnail/{video_id}")
-async def patch_thumbnail(
-    video_id: str, session: Session = Depends(normal_session.get_session)
-):
-    video_server = session.exec(
-        select(VideosDataBase).where(VideosDataBase.id == video_id)
-    ).first()
+async def patch_thumbnail(request: Request, video_id: str):
+    video_server = await normal_session.db.read(Session.get, VideosDataBase, video_id)
 
     if not video_server:
         raise VideoInfoNotFound(video_id)
@@ -52,14 +142,28 @@ async def patch_thumbnail(
     from src.utils.video_processing import generate_thumbnail
 
     new_thumbnail = await generate_thumbnail(
-        video_server.video_path, -2, video_server.duration
+        video_server.video_path,
+        -2,
+        video_server.duration,
+        priority=Priority.INTERACTIVE,
     )
     if not new_thumbnail:
         raise HTTPException(500, "Unable to generate thumbnail")
 
-    video_server.delete_thumb()
-    video_server.thumbnail_path = str(new_thumbnail)
-    session.commit()
-    session.refresh(video_server)
+    def replace_thumbnail(session: Session) -> VideosDataBase | None:
+        video = session.get(VideosDataBase, video_id)
+        if video:
+            video.delete_thumb()
+            video.thumbnail_path = str(new_thumbnail)
+        return video
+
+    video_server = await normal_session.db.write(replace_thumbnail)
+    if not video_server:
+        raise VideoInfoNotFound(video_id)
+    video_columns.put([video_server])
+    catalog.bump()
+    await asyncio.to_thread(
+        atlas_store.update_thumbnail, video_id, video_server.thumbnail_path
+    )
 
-    return await get_thumbnail(video_id, session)
+    return await get_thumbnail(request, video_id)
@@ -1,6 +1,10 @@
+import asyncio
 from datetime import datetime, timezone
 import json
-from fastapi import Header
+import os
+from fastapi import Header, Query, Request, Response
+from fastapi.responses import RedirectResponse, StreamingResponse
+from sqlmodel import col
 from src.models import (
     DeletedVideo,
     VideoResponse,
@@ -8,7 +12,19 @@ from src.models import (
     VideosDataBase,
     DeletedVideoResponse,
 )
-from src.utils.helpers import convert_db_to_response
+from src.api.exceptions import HlsFileNotFound, StreamNotAvailable
+from src.catalog import catalog, etag_matches, pick_encoding, revalidate
+from src.utils.atlas import atlas_store
+from src.utils.columns import video_columns
+from src.utils.fastjson import NDJSON, FastJSONResponse
+from src.utils.helpers import (
+    build_catalog,
+    convert_db_to_response,
+    stream_catalog,
+    visible_extras,
+)
+from src.utils import hls
+from src.utils.hls import hls_segments
 
 from src.api import (
     router,
@@ -16,38 +32,43 @@ from src.api import (
     normal_session,
     deleted_video_session,
     Session,
-    Depends,
     FileResponse,
     HTTPException,
     VideoInfoNotFound,
     FileNotFoundOnServer,
 )
-from src.utils.video_processing import probe_video
+from src.utils.listing import (
+    DEFAULT_NEIGHBOURS,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_RELATED,
+    MAX_NEIGHBOURS,
+    MAX_PAGE_SIZE,
+    MAX_RELATED,
+    decode_cursor,
+    encode_cursor,
+    filter_labels,
+    listing_sort_key,
+)
+from src.utils.search import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT, search_ids
+from src.utils.processes import Priority
+from src.utils.video_processing import apply_probe, probe_video
 
 
 @router.get("/deleted")
-async def get_deleted(
-    video_id: str | None = None,
-    session: Session = Depends(deleted_video_session.get_session),
-):
+async def get_deleted(video_id: str | None = None):
+    query = select(DeletedVideo)
     if video_id:
-        videos = session.exec(
-            select(DeletedVideo).where(DeletedVideo.id == video_id)
-        ).all()
-    else:
-        videos = session.exec(select(DeletedVideo)).all()
+        query = query.where(DeletedVideo.id == video_id)
+    videos = await deleted_video_session.db.read(
+        lambda session: session.exec(query).all()
+    )
 
     return {"results": [DeletedVideoResponse(**de.model_dump()) for de in videos]}
 
 
 @router.get("/video")
-async def get_video(
-    video_id: str, session: Session = Depends(normal_session.get_session)
-):
-
-    video = session.exec(
-        select(VideosDataBase).where(VideosDataBase.id == video_id)
-    ).first()
+async def get_video(video_id: str):
+    video = await normal_session.db.read(Session.get, VideosDataBase, video_id)
 
     if not video:
         raise VideoInfoNotFound(video_id)
@@ -65,18 +86,50 @@ async def get_video(
     return response
 
 
+@router.get("/hls/{video_id}.m3u8")
+async def get_hls_stream(video_id: str):
+    video = await normal_session.db.read(Session.get, VideosDataBase, video_id)
+    if not video:
+        raise VideoInfoNotFound(video_id)
+
+    if not video.exist():
+        raise FileNotFoundOnServer()
+
+    key = hls_segments.start(video)
+    if key is None:
+        raise StreamNotAvailable(video_id)
+
+    # The segments are named relative to the playlist, under the key
+    return RedirectResponse(
+        f"/api/hls/files/{key}/index.m3u8", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@router.get("/hls/files/{key}/{name}")
+async def get_hls_file(key: str, name: str):
+    if not (hls.KEY_PATTERN.fullmatch(key) and hls.FILE_PATTERN.fullmatch(name)):
+        raise HlsFileNotFound(name)
+
+    path = await hls_segments.file(key, name)
+    if path is None:
+        raise HlsFileNotFound(name)
+
+    # Segments never change, the playlist does until the segmenter is through
+    growing = name == "index.m3u8" and hls_segments.running(key)
+    cache_control = "no-cache" if growing else "public, max-age=31536000, immutable"
+    return FileResponse(
+        path,
+        media_type=hls.MEDIA_TYPES[path.suffix],
+        headers={"Cache-Control": cache_control, "Access-Control-Allow-Origin": "*"},
+    )
+
+
 @router.delete("/video")
-async def delete_video(
-    video_id: str,
-    user: str = Header(...),
-    session: Session = Depends(normal_session.get_session),
-):
+async def delete_video(video_id: str, user: str = Header(...)):
     if user != "maxim":
         raise HTTPException(401, "Unauthorized")
 
-    video = session.exec(
-        select(VideosDataBase).where(VideosDataBase.id == video_id)
-    ).first()
+    video = await normal_session.db.read(Session.get, VideosDataBase, video_id)
 
     if not video:
         raise VideoInfoNotFound(video_id)
@@ -87,24 +140,24 @@ async def delete_video(
         return video_data
 
     # Adds to deleted_videos_database
-    second_session = next(deleted_video_session.get_session())
-    second_session.add(
-        DeletedVideo(
-            id=video.id,
-            title=video.title,
-            video_path=video.video_path,
-            duration=video.duration,
-            filesize=video.filesize,
-            extras=video.extras,
-        )
+    deleted = DeletedVideo(
+        id=video.id,
+        title=video.title,
+        video_path=video.video_path,
+        duration=video.duration,
+        filesize=video.filesize,
+        extras=video.extras,
     )
+    await deleted_video_session.db.write(Session.add, deleted)
 
-    # Delete from database
-    session.delete(video)
+    # Delete from database (the ORM delete takes the probe & fingerprint along)
+    def delete_row(session: Session):
+        if row := session.get(VideosDataBase, video_id):
+            session.delete(row)
 
-    # Commit Changes to databases
-    second_session.commit()
-    session.commit()
+    await normal_session.db.write(delete_row)
+    video_columns.remove([video_id])
+    catalog.bump()
 
     # Delete locally
     video.delete()
@@ -114,17 +167,7 @@ async def delete_video(
 
 
 @router.patch("/video")
-async def update_video(
-    video_id: str,
-    payload: VideoUpdate,
-    session: Session = Depends(normal_session.get_session),
-):
-    video_db = session.exec(
-        select(VideosDataBase).where(VideosDataBase.id == video_id)
-    ).first()
-    if not video_db:
-        raise HTTPException(404, "Not found")
-
+async def update_video(video_id: str, payload: VideoUpdate):
     def response_success(modal):
         return {
             "updated": (
@@ -134,64 +177,221 @@ async def update_video(
             )
         }
 
-    updated_fields = {}
-    for key, value in payload.model_dump(exclude_unset=True).items():
-        if hasattr(video_db, key) and value is not None:
-            updated_fields[f"prev_{key}"] = str(getattr(video_db, key))
+    def update(session: Session) -> tuple[VideosDataBase | None, bool]:
+        video_db = session.get(VideosDataBase, video_id)
+        if not video_db:
+            return None, False
+
+        changed, updated_fields = False, {}
+        for key, value in payload.model_dump(exclude_unset=True).items():
+            if not hasattr(video_db, key) or value is None:
+                continue
+            if getattr(video_db, key) == value:
+                continue
+
+            # Favourites get toggled all the time, only edits go in the history
+            if key != "favourite":
+                updated_fields[f"prev_{key}"] = str(getattr(video_db, key))
             setattr(video_db, key, value)
+            changed = True
 
-    if not updated_fields:
-        return response_success(video_db)
+        if not changed:
+            return video_db, False
 
-    if video_db.extras is None:
-        video_db.extras = {}
+        if updated_fields:
+            update_key = f"update_{datetime.now(tz=timezone.utc).timestamp()}"
 
-    update_key = f"update_{datetime.now(tz=timezone.utc).timestamp()}"
+            extras = dict(video_db.extras or {})
+            extras[update_key] = updated_fields
+            video_db.extras = extras
+        return video_db, True
 
-    extras = dict(video_db.extras or {})
-    extras[update_key] = updated_fields
-    video_db.extras = extras
+    video_db, updated = await normal_session.db.write(update)
+    if not video_db:
+        raise HTTPException(404, "Not found")
 
-    session.commit()
-    session.refresh(video_db)
+    if updated:
+        video_columns.put([video_db])
+        catalog.bump()
 
     return response_success(video_db)
 
 
 @router.get("/videos")
 async def get_videos(
-    extras: bool = False, session: Session = Depends(normal_session.get_session)
+    request: Request,
+    response: Response,
+    sort_by: str = "date",
+    sort_asc: bool = False,
+    fav_first: bool = False,
+    quality: str = "all",
+    orientation: str = "all",
+    cursor: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    extras: bool = False,
 ):
-    videos = session.exec(select(VideosDataBase)).all()
-    return {"videos": [convert_db_to_response(d, extras) for d in videos]}
+    # Pages only change with the catalog version, no query needed for a 304
+    if not_modified := revalidate(request, response, str(request.query_params)):
+        return not_modified
 
+    sort_key = listing_sort_key(sort_by, sort_asc, fav_first)
+    values = decode_cursor(cursor, len(sort_key)) if cursor else None
 
-@router.get("/stats", response_model=VideoResponse)
-async def get_stat(
+    # Fetch one extra row to know whether there's a next page
+    videos = video_columns.page(
+        sort_key, *filter_labels(quality, orientation), values, limit + 1
+    )
+    next_cursor = None
+    if len(videos) > limit:
+        videos = videos[:limit]
+        next_cursor = encode_cursor(videos[-1], sort_key)
+
+    # Only extras aren't kept in memory
+    found = await read_extras([v.id for v in videos]) if extras else {}
+    content = {
+        "videos": [v.as_dict(found.get(v.id)) for v in videos],
+        "next_cursor": next_cursor,
+        # One image with every thumbnail of the page, when the `atlas` extra is there
+        "atlas": await atlas_store.describe(videos),
+    }
+    return FastJSONResponse(content, headers=response.headers)
+
+
+@router.get("/neighbours")
+async def get_neighbours(
+    request: Request,
+    response: Response,
     video_id: str,
-    extras: bool = False,
-    session: Session = Depends(normal_session.get_session),
+    sort_by: str = "date",
+    sort_asc: bool = False,
+    fav_first: bool = False,
+    quality: str = "all",
+    orientation: str = "all",
+    count: int = Query(DEFAULT_NEIGHBOURS, ge=0, le=MAX_NEIGHBOURS),
+    related: int = Query(DEFAULT_RELATED, ge=0, le=MAX_RELATED),
 ):
-    video_server = session.exec(
-        select(VideosDataBase).where(VideosDataBase.id == video_id)
-    ).first()
+    # What the watch page shows around a video, instead of pages of the listing
+    if not_modified := revalidate(request, response, str(request.query_params)):
+        return not_modified
 
-    if not video_server:
+    sort_key = listing_sort_key(sort_by, sort_asc, fav_first)
+    found = video_columns.neighbours(
+        video_id, sort_key, *filter_labels(quality, orientation), count
+    )
+    if found is None:
         raise VideoInfoNotFound(video_id)
 
-    if not video_server.exist():
+    previous, following = found
+    content = {
+        "previous": [v.as_dict() for v in previous],
+        "next": [v.as_dict() for v in following],
+        "related": [v.as_dict() for v in video_columns.related(video_id, related)],
+    }
+    return FastJSONResponse(content, headers=response.headers)
+
+
+async def read_extras(video_ids: list[str]) -> dict[str, dict]:
+    query = select(VideosDataBase.id, VideosDataBase.extras).where(
+        col(VideosDataBase.id).in_(video_ids)
+    )
+    rows = await normal_session.db.read(lambda session: session.exec(query).all())
+    return {video_id: visible_extras(extras) for video_id, extras in rows}
+
+
+@router.get("/search")
+async def search(
+    request: Request,
+    response: Response,
+    q: str,
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+):
+    if not_modified := revalidate(request, response, q, str(limit)):
+        return not_modified
+
+    ids = await normal_session.db.read(search_ids, q, limit)
+    content = {"videos": [v.as_dict() for v in video_columns.records(ids)]}
+    return FastJSONResponse(content, headers=response.headers)
+
+
+@router.get("/catalog")
+async def get_catalog(request: Request, response: Response):
+    if NDJSON in request.headers.get("accept", ""):
+        # Streamed as it's encoded, the first videos arrive before the last are done
+        if not_modified := revalidate(request, response, NDJSON):
+            return not_modified
+        return StreamingResponse(
+            stream_catalog(catalog.version),
+            media_type=NDJSON,
+            headers={**response.headers, "Vary": "Accept"},
+        )
+
+    snapshot = catalog.current()
+    if snapshot and etag_matches(request, *map(snapshot.etag, snapshot.bodies)):
+        encoding = pick_encoding(request, snapshot.bodies)
+        return Response(status_code=304, headers={"ETag": snapshot.etag(encoding)})
+
+    # Serialized & compressed once per catalog version, off the event loop
+    snapshot = await asyncio.to_thread(
+        catalog.snapshot, lambda: build_catalog(catalog.version)
+    )
+    encoding = pick_encoding(request, snapshot.bodies)
+
+    headers = {
+        "ETag": snapshot.etag(encoding),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept, Accept-Encoding",
+    }
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    return Response(
+        snapshot.bodies[encoding], media_type="application/json", headers=headers
+    )
+
+
+@router.get("/summary")
+async def get_summary(request: Request, response: Response):
+    if not_modified := revalidate(request, response):
+        return not_modified
+
+    count, filesize, favourites = video_columns.summary()
+    return {"count": count, "filesize": filesize, "favourites": favourites}
+
+
+# Encoded without the model (`as_dict` has its shape), it only documents the route
+@router.get("/stats", responses={200: {"model": VideoResponse}})
+async def get_stat(video_id: str, extras: bool = False):
+    video = video_columns.get(video_id)
+
+    if not video:
+        raise VideoInfoNotFound(video_id)
+
+    if not os.path.exists(video.video_path):
         raise FileNotFoundOnServer()
 
-    return convert_db_to_response(video_server, extras)
+    found = await read_extras([video_id]) if extras else {}
+    return FastJSONResponse(video.as_dict(found.get(video_id)))
+
+
+@router.get("/probe")
+async def get_probe(video_id: str):
+    def read_probe(session: Session) -> dict | None:
+        video_server = session.get(VideosDataBase, video_id)
+        if not video_server:
+            return None
+
+        # Only this endpoint pulls the (compressed) full probe from its table
+        return video_server.probe.unpack() if video_server.probe else {}
+
+    probe = await normal_session.db.read(read_probe)
+    if probe is None:
+        raise VideoInfoNotFound(video_id)
+    return probe
 
 
 @router.patch("/stats")
-async def patch_stats(
-    video_id: str, session: Session = Depends(normal_session.get_session)
-):
-    video_server = session.exec(
-        select(VideosDataBase).where(VideosDataBase.id == video_id)
-    ).first()
+async def patch_stats(video_id: str):
+    video_server = await normal_session.db.read(Session.get, VideosDataBase, video_id)
 
     if not video_server:
         raise VideoInfoNotFound(video_id)
@@ -199,10 +399,19 @@ async def patch_stats(
     if not video_server.exist():
         raise FileNotFoundOnServer()
 
-    video_server.extras = json.loads(
-        await probe_video(vid_path=video_server.video_path)
-    )
-    session.commit()
-    session.refresh(video_server)
+    # The user is waiting on this one, it goes ahead of any reload
+    probe = await probe_video(video_server.video_path, Priority.INTERACTIVE)
+
+    def update(session: Session) -> VideosDataBase | None:
+        video = session.get(VideosDataBase, video_id)
+        if video:
+            apply_probe(video, json.loads(probe))
+        return video
+
+    video = await normal_session.db.write(update)
+    if not video:
+        raise VideoInfoNotFound(video_id)
+    video_columns.put([video])
+    catalog.bump()
 
     return True
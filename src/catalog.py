@@ -0,0 +1,107 @@
+from dataclasses import dataclass, field
+import gzip
+import hashlib
+import threading
+from typing import Callable
+from uuid import uuid4
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: int
+    digest: str
+    # content-encoding -> body, compressed once when the snapshot is built
+    bodies: dict[str, bytes] = field(default_factory=dict)
+
+    def etag(self, encoding: str) -> str:
+        # Strong ETags have to differ between encodings of the same body
+        suffix = "" if encoding == "identity" else f"-{encoding}"
+        return f'"{self.digest}{suffix}"'
+
+
+class Catalog:
+    """Version of the video library, every write to the videos table must `bump` it"""
+
+    def __init__(self):
+        self.version = 0
+        # A restart may see a different db, never reuse ETags across processes
+        self.boot_id = uuid4().hex
+        self._snapshot: CatalogSnapshot | None = None
+        self._lock = threading.Lock()
+        self._bump_lock = threading.Lock()
+
+    def bump(self):
+        # Writes happen on worker threads too, no bump may be lost
+        with self._bump_lock:
+            self.version += 1
+
+    def etag(self, *parts: str) -> str:
+        key = ":".join((self.boot_id, str(self.version), *parts))
+        return f'"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+
+    def current(self) -> CatalogSnapshot | None:
+        snapshot = self._snapshot
+        if snapshot and snapshot.version == self.version:
+            return snapshot
+        return None
+
+    def snapshot(self, build: Callable[[], bytes]) -> CatalogSnapshot:
+        with self._lock:
+            if snapshot := self.current():
+                return snapshot
+
+            # A bump during the build leaves this snapshot stale for the next call
+            version = self.version
+            raw = build()
+
+            bodies = {"identity": raw, "gzip": gzip.compress(raw, 9)}
+            if brotli is not None:
+                bodies["br"] = brotli.compress(raw, quality=11)
+
+            digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+            self._snapshot = CatalogSnapshot(version, digest, bodies)
+            return self._snapshot
+
+
+def etag_matches(request: Request, *etags: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*":
+        return True
+
+    sent = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return any(etag in sent for etag in etags)
+
+
+def pick_encoding(request: Request, available: dict[str, bytes]) -> str:
+    accepted = {
+        token.split(";")[0].strip().lower()
+        for token in request.headers.get("accept-encoding", "").split(",")
+    }
+    for encoding in ("br", "gzip"):
+        if encoding in accepted and encoding in available:
+            return encoding
+    return "identity"
+
+
+def revalidate(request: Request, response: Response, *parts: str) -> Response | None:
+    """Stamps `response` with the versioned ETag, returns a 304 if the client has it"""
+    headers = {
+        "ETag": catalog.etag(request.url.path, *parts),
+        # Let the browser cache it but always ask us first
+        "Cache-Control": "no-cache",
+    }
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return None
+
+
+catalog = Catalog()
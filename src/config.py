@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 # Extension of files to search for (use video format if possible)
@@ -12,8 +13,156 @@ ROOT_DIRS = [
 # The directory where the '.db' file(s) will be saved
 DATA_DIR = Path("~/Extras/web/file-browser/data").expanduser().resolve()
 
-# The directory where the thumbnails will be saved of indexed media files
+# Thumbnails of indexed media files live in a single pack file in here
+THUMB_STORE_DIR = DATA_DIR / "thumbs"
+
+# Rewrite the pack once this share of it is replaced/deleted thumbnails
+THUMB_PACK_COMPACT_RATIO = 0.5
+
+# Where thumbnails used to be saved, one file each; the ones still there are
+# moved into the pack at startup
 THUMB_DIR = Path("~/Extras/web/file-browser/static/.thumbs").expanduser().resolve()
 
-# Seting this to True, will use '.webp' and size of '640x360' for thumbnails creation; .png with no commpression if False
+# Seting this to True, will use '.webp' for thumbnails; .png with no commpression if False
 PERFORMANCE = True
+
+# Widths of the thumbnails made for every video (one decode, never upscaled);
+# the default one is `thumbnail_path`, the others are named after it (thumbnail_x.grid.webp)
+THUMBNAIL_SIZES = {"grid": 320, "card": 640, "poster": 1280}
+DEFAULT_THUMBNAIL_SIZE = "card"
+
+# Keyframes considered for a thumbnail, and the seconds of video they're taken from
+THUMBNAIL_CANDIDATES = 8
+THUMBNAIL_SCAN_SECONDS = 60
+
+# Skip dot-directories (e.g. `.git`, `.thumbs`) found *inside* the root dirs
+SKIP_HIDDEN_DIRS = True
+
+# Glob patterns (matched against the path relative to its root, `**` allowed)
+# of files/dirs to skip while discovering, keyed by root dir
+EXCLUDE_GLOBS: dict[Path, list[str]] = {
+    # ROOT_DIRS[1]: ["**/*.PARTIAL", "private/**"],
+}
+
+# Threads scanning directories in parallel (mostly waiting on I/O, helps on NAS mounts)
+DISCOVERY_WORKERS = 8
+
+# Reload pipeline: files waiting between stages (discover -> probe -> thumbnail -> db)
+INGEST_QUEUE_SIZE = 64
+
+# New videos are committed (and show up) every this many files or seconds
+INGEST_BATCH_SIZE = 50
+INGEST_FLUSH_INTERVAL = 2.0
+
+# Applied to every sqlite connection: WAL lets the API read while a reload writes
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # safe with WAL, only the last commits can be lost on power loss
+    "busy_timeout": 5000,  # ms to wait on a locked db instead of failing
+    "cache_size": -64000,  # KiB (negative) of page cache
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# Threads (each with its own connection) the API reads the db on, writes get one
+DB_READ_THREADS = 4
+
+# Rows per executemany statement/transaction for bulk inserts & upserts
+BULK_CHUNK_SIZE = 1000
+
+# Videos per chunk of the NDJSON catalog (`Accept: application/x-ndjson`)
+CATALOG_STREAM_CHUNK = 1000
+
+# Index new/removed files under ROOT_DIRS as they happen (needs the `watch` extra)
+WATCH_ROOT_DIRS = False
+
+# Seconds a file's size & mtime must stay put before it's indexed (uploads in progress)
+WATCH_SETTLE_SECONDS = 5.0
+
+# Full rescan every this many seconds while watching, catches whatever events missed
+WATCH_RESCAN_INTERVAL = 6 * 60 * 60
+
+# Probe results & thumbnails by file content, kept apart from the videos db so
+# a hard reload can rebuild from it instead of running ffmpeg again
+MEDIA_CACHE_DIR = DATA_DIR / "cache"
+
+# Cache entries that no full reload has seen for this many days are dropped
+MEDIA_CACHE_MAX_AGE_DAYS = 90
+
+# Bytes read from the start, the middle & the end of a file to tell its content apart
+PARTIAL_HASH_CHUNK = 64 * 1024
+
+# Duplicates sent to the trash are moved here, inside their root dir (never scanned)
+TRASH_DIR_NAME = ".trash"
+
+# ffprobe/ffmpeg processes running at once (probes are cheap, decodes are not)
+PROBE_CONCURRENCY = os.cpu_count() or 4
+DECODE_CONCURRENCY = max((os.cpu_count() or 4) // 2, 1)
+
+# Extra slots only user-triggered work may use, so it never waits for a reload
+INTERACTIVE_EXTRA_SLOTS = 1
+
+# MP4s with their index (moov) after the data make browsers read the end of the
+# file before playing, ingest queues a lossless rewrite with it up front
+FASTSTART_REMUX = True
+
+# Remuxes running at once, they're disk bound
+REMUX_CONCURRENCY = 1
+
+# Free space a remux leaves on the video's disk, on top of the copy it writes
+REMUX_MIN_FREE_SPACE = 2 * 1024**3
+
+# Shrink the budgets while the load average is above the number of cores
+LOAD_ADAPTIVE = True
+
+# Seconds before a stuck process is killed
+PROBE_TIMEOUT = 30.0
+THUMBNAIL_TIMEOUT = 120.0
+
+# Read .mp4/.m4v/.mov metadata from the file's boxes (in-process), ffprobe only
+# runs for files that can't be parsed that way
+FAST_MP4_PROBE = True
+
+# Listing pages also get one sprite image of all their thumbnails (needs the
+# `atlas` extra): tiles of this size, this many per row
+ATLAS_DIR = MEDIA_CACHE_DIR / "atlases"
+ATLAS_TILE_SIZE = (320, 180)
+ATLAS_COLUMNS = 6
+
+# Atlases kept on disk, the least recently listed are dropped past it
+ATLAS_MAX_FILES = 500
+
+# Scrub previews on the watch page: a frame every SCRUB_INTERVAL seconds (longer
+# for long videos, never more than SCRUB_MAX_FRAMES) tiled into one sheet
+SCRUB_DIR = MEDIA_CACHE_DIR / "scrub"
+SCRUB_INTERVAL = 10
+SCRUB_MAX_FRAMES = 100
+SCRUB_TILE_SIZE = (160, 90)
+SCRUB_COLUMNS = 10
+SCRUB_TIMEOUT = 300.0
+
+# Disk space the sheets may use, the least recently watched go first
+SCRUB_DISK_BUDGET = 512 * 1024**2
+
+# HLS streaming (browsers that play it natively): the video is cut into
+# segments of about this many seconds by one ffmpeg per video, shared by viewers
+HLS_DIR = MEDIA_CACHE_DIR / "hls"
+HLS_SEGMENT_SECONDS = 6
+
+# Codecs the segments can carry as is, anything else is re-encoded to h264
+HLS_COPY_CODECS = {"h264", "hevc"}
+
+# Disk space for segments, the least recently watched videos' go first
+HLS_CACHE_SIZE = 4 * 1024**3
+
+# Seconds a request waits for a segment (or the playlist) the segmenter hasn't written yet
+HLS_WAIT_TIMEOUT = 30.0
+
+# A segmenter (running or still waiting for a slot) is stopped once nobody fetched
+# its playlist or segments for this many seconds, players reload the playlist
+# every segment while they watch
+HLS_IDLE_TIMEOUT = 60.0
+
+# Segmenters running at once, in their own budget: each one holds its slot for
+# the whole video, in the decode one they'd starve thumbnails
+HLS_CONCURRENCY = max((os.cpu_count() or 4) // 4, 1)
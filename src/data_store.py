@@ -1,9 +1,17 @@
 from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, TypeVar
 
+from sqlalchemy import event, insert, inspect, literal, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine import Engine
+from sqlalchemy.schema import Table
+from sqlmodel import Session, create_engine
 
+from src.config import BULK_CHUNK_SIZE, SQLITE_PRAGMAS
 from src.models import SQLModel
 
+T = TypeVar("T")
+
 
 def create_models(
     base_class: SQLModel,
@@ -27,6 +35,45 @@ def create_models(
     tables = [all_tables[name] for name in tables_to_create]
 
     SQLModel.metadata.create_all(engine, tables=tables)
+    migrate_models(engine, tables)
+
+
+def migrate_models(engine: Engine, tables: list[Table]):
+    """Adds columns and indexes missing from an already existing table, drops retired ones"""
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in tables:
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" '
+                ddl += column.type.compile(engine.dialect)
+
+                # sqlite needs a constant default to add a NOT NULL column
+                default = column.default
+                if default is not None and default.is_scalar:
+                    value = literal(default.arg).compile(
+                        dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+                    )
+                    ddl += f" NOT NULL DEFAULT {value}"
+
+                conn.exec_driver_sql(ddl)
+
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+            for name in table.info.get("retired_indexes", ()):
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{name}"')
+
+
+def run_in_session(engine: Engine, fn: Callable[..., T], *args: Any) -> T:
+    """`fn(session, *args)` with a session of its own, for worker threads"""
+    with Session(engine) as session:
+        return fn(session, *args)
 
 
 def create_engine_url(
@@ -41,3 +88,105 @@ def create_engine_url(
 
     # Return the resolved absolute path
     return suffix + str((db_path / file_name).resolve().absolute())
+
+
+def create_tuned_engine(url: str, pragmas: dict[str, Any] = SQLITE_PRAGMAS) -> Engine:
+    engine = create_engine(url)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+def chunked(rows: Iterable[dict], size: int) -> Iterator[list[dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_insert(
+    session: Session,
+    table: Table,
+    rows: Iterable[dict],
+    *,
+    chunk_size: int = BULK_CHUNK_SIZE,
+) -> int:
+    """executemany inserts, `chunk_size` rows per statement (the caller commits)"""
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        session.execute(insert(table), chunk)
+        count += len(chunk)
+    return count
+
+
+def bulk_upsert(
+    session: Session,
+    table: Table,
+    rows: Iterable[dict],
+    *,
+    key: list[str] | None = None,
+    chunk_size: int = BULK_CHUNK_SIZE,
+) -> int:
+    """Like `bulk_insert` but rows whose `key` (primary key) exists are overwritten"""
+    key = key or [column.name for column in table.primary_key]
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        statement = sqlite_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=key,
+            set_={
+                name: statement.excluded[name] for name in chunk[0] if name not in key
+            },
+        )
+        session.execute(statement, chunk)
+        count += len(chunk)
+    return count
+
+
+def create_search_index(engine: Engine, table_name: str, column: str = "title"):
+    """FTS5 index over `table_name.column`, kept in sync by triggers"""
+    fts_name = f"{table_name}_fts"
+
+    # External content table: the text lives in `table_name`, fts only keeps the index
+    statements = [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts_name} USING fts5(
+            {column}, content='{table_name}', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts_name}_insert AFTER INSERT ON {table_name}
+        BEGIN
+            INSERT INTO {fts_name}(rowid, {column}) VALUES (new.rowid, new.{column});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts_name}_delete AFTER DELETE ON {table_name}
+        BEGIN
+            INSERT INTO {fts_name}({fts_name}, rowid, {column})
+            VALUES ('delete', old.rowid, old.{column});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts_name}_update AFTER UPDATE OF {column} ON {table_name}
+        BEGIN
+            INSERT INTO {fts_name}({fts_name}, rowid, {column})
+            VALUES ('delete', old.rowid, old.{column});
+            INSERT INTO {fts_name}(rowid, {column}) VALUES (new.rowid, new.{column});
+        END""",
+    ]
+
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+        # Rows written before the triggers existed, only then does it need a full
+        # rebuild (`_docsize` holds a row per indexed document)
+        indexed = conn.execute(text(f"SELECT count(*) FROM {fts_name}_docsize")).scalar()
+        rows = conn.execute(text(f"SELECT count(*) FROM {table_name}")).scalar()
+        if indexed != rows:
+            conn.execute(text(f"INSERT INTO {fts_name}({fts_name}) VALUES ('rebuild')"))
@@ -0,0 +1,161 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Any, Awaitable, Callable
+from uuid import uuid4
+
+from rich.errors import MarkupError
+from rich.markup import render
+
+# Jobs kept around (after they end) for late progress/status requests
+JOB_HISTORY = 5
+
+
+def plain_text(value: Any) -> str:
+    # Log messages carry rich markup for the terminal
+    try:
+        return render(value).plain if isinstance(value, str) else str(value)
+    except MarkupError:
+        return value
+
+
+@dataclass
+class PhaseProgress:
+    total: int = 0
+    done: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def as_dict(self, now: float) -> dict:
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.done, 0)
+        return {
+            "done": self.done,
+            "total": self.total,
+            "rate": round(rate, 2),
+            # Totals grow while files are still being found, so this is a lower bound
+            "eta": round(remaining / rate, 1) if rate else None,
+        }
+
+
+class ReloadJob:
+    """One reload run, doubles as the pipeline's reporter (thread-safe)"""
+
+    def __init__(self, hard: bool):
+        self.id = uuid4().hex
+        self.hard = hard
+        self.state = "running"
+        self.error: str | None = None
+        self.started = time.time()
+        self.finished: float | None = None
+        self.phases: dict[str, PhaseProgress] = {}
+        self.messages: deque[str] = deque(maxlen=50)
+        # Bumped on every change, lets the event stream skip idle ticks
+        self.revision = 0
+        self.task: asyncio.Task | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.state == "running"
+
+    def _phase(self, phase: str) -> PhaseProgress:
+        if phase not in self.phases:
+            self.phases[phase] = PhaseProgress()
+        return self.phases[phase]
+
+    def queued(self, phase: str, count: int = 1):
+        with self._lock:
+            self._phase(phase).total += count
+            self.revision += 1
+
+    def done(self, phase: str, count: int = 1):
+        with self._lock:
+            progress = self._phase(phase)
+            if phase == "discover":
+                # Nothing queues files before the walk finds them
+                progress.total += count
+            progress.done += count
+            self.revision += 1
+
+    def log(self, *objects: Any):
+        message = " ".join(plain_text(o) for o in objects)
+        with self._lock:
+            self.messages.append(message)
+            self.revision += 1
+
+    def finish(self, state: str, error: str | None = None):
+        with self._lock:
+            self.state = state
+            self.error = error
+            self.finished = time.time()
+            self.revision += 1
+
+    def as_dict(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "id": self.id,
+                "hard": self.hard,
+                "state": self.state,
+                "error": self.error,
+                "started": self.started,
+                "finished": self.finished,
+                "phases": {name: p.as_dict(now) for name, p in self.phases.items()},
+                "messages": list(self.messages),
+            }
+
+
+class ReloadJobs:
+    """Runs at most one reload at a time, a second request joins the running one"""
+
+    def __init__(self):
+        self.jobs: dict[str, ReloadJob] = {}
+        self.current: ReloadJob | None = None
+        # Held by anything writing the library (reloads, the watcher)
+        self.lock = asyncio.Lock()
+
+    def get(self, job_id: str) -> ReloadJob | None:
+        return self.jobs.get(job_id)
+
+    def start(
+        self, hard: bool, run: Callable[[ReloadJob], Awaitable[Any]]
+    ) -> tuple[ReloadJob, bool]:
+        """(job, whether it was started by this call)"""
+        if self.current and self.current.running:
+            return self.current, False
+
+        job = ReloadJob(hard)
+        self.current = job
+        self.jobs[job.id] = job
+        while len(self.jobs) > JOB_HISTORY:
+            del self.jobs[next(iter(self.jobs))]
+
+        job.task = asyncio.create_task(self._run(job, run))
+        return job, True
+
+    async def _run(self, job: ReloadJob, run: Callable[[ReloadJob], Awaitable[Any]]):
+        try:
+            async with self.lock:
+                await run(job)
+        except asyncio.CancelledError:
+            job.finish("cancelled")
+        except Exception as e:
+            job.finish("failed", f"{type(e).__name__}: {e}")
+        else:
+            job.finish("done")
+
+    def cancel(self, job: ReloadJob) -> bool:
+        if not job.running or job.task is None:
+            return False
+        return job.task.cancel()
+
+    async def shutdown(self):
+        if self.current and self.current.task and self.current.running:
+            self.current.task.cancel()
+            await asyncio.gather(self.current.task, return_exceptions=True)
+
+
+reload_jobs = ReloadJobs()
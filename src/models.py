@@ -1,12 +1,62 @@
 from datetime import datetime
+import json
 import os
-from typing import Optional
+from typing import Iterable, Optional
+import zlib
 
 from pydantic import BaseModel
-from sqlmodel import Column, Field, JSON, SQLModel
+from sqlmodel import Column, Field, Index, JSON, LargeBinary, Relationship, SQLModel
+
+from src.config import DEFAULT_THUMBNAIL_SIZE, THUMBNAIL_SIZES
+from src.utils.thumbnail_store import thumbnail_store
+
+
+def thumbnail_variant(thumbnail_path: str, size: str | None = None) -> str:
+    """thumbnail_x.webp + "grid" -> thumbnail_x.grid.webp, the default size is the path itself"""
+    if size is None or size == DEFAULT_THUMBNAIL_SIZE:
+        return thumbnail_path
+
+    root, suffix = os.path.splitext(thumbnail_path)
+    return f"{root}.{size}{suffix}"
+
+
+def thumbnail_key(thumbnail_path: str, size: str | None = None) -> str:
+    """Name of the thumbnail in the pack, rows indexed before it hold a full path"""
+    return os.path.basename(thumbnail_variant(thumbnail_path, size))
+
+
+def delete_thumbnails(thumbnail_paths: Iterable[str]):
+    """Every size of each thumbnail, only once no committed row points at them"""
+    thumbnail_store.delete_many(
+        thumbnail_key(path, size) for path in thumbnail_paths for size in THUMBNAIL_SIZES
+    )
+
+
+def thumbnail_url(video_id: str, thumbnail_path: str) -> str:
+    """Changes whenever the thumbnail is regenerated (every one gets a new file name)"""
+    version = os.path.splitext(os.path.basename(thumbnail_path))[0]
+    return f"/api/thumbnail/{video_id}/{version}"
 
 
 class VideosDataBase(SQLModel, table=True):
+    # The listings are sorted in memory (`VideoColumns`), the keyset indexes they
+    # used only slowed every write down, dropped from existing dbs by the migration
+    __table_args__ = {
+        "info": {
+            "retired_indexes": (
+                "ix_videos_date",
+                "ix_videos_duration",
+                "ix_videos_filesize",
+                "ix_videos_title",
+                "ix_videos_fav_date",
+                "ix_videos_fav_duration",
+                "ix_videos_fav_filesize",
+                "ix_videos_fav_title",
+                "ix_videos_quality_orientation",
+            )
+        }
+    }
+
     id: str = Field(default=None, primary_key=True)
     title: str = Field(...)
     video_path: str = Field(...)
@@ -17,22 +67,94 @@ class VideosDataBase(SQLModel, table=True):
     duration: int = Field(default=-1)
     timestamp: float = Field(default_factory=datetime.now().timestamp)
 
+    width: int = Field(default=0)
+    height: int = Field(default=0)
+    quality: str = Field(default="")
+    orientation: str = Field(default="")
+    favourite: bool = Field(default=False)
+
+    codec: str = Field(default="")
+    bit_rate: int = Field(default=0)
+    frame_rate: float = Field(default=0.0)
+    rotation: int = Field(default=0)
+    # Outcome of the faststart remux ("done"/"failed"), files get only one
+    remux: str = Field(default="")
+    # Sampled hash of the file's bytes (`partial_hash`), equal for copies
+    content_hash: str = Field(default="", index=True)
+
     extras: dict = Field(sa_column=Column(JSON), default_factory=dict)
 
+    # Full ffprobe output, lives in its own table and only loads when accessed
+    probe: Optional["VideoProbe"] = Relationship(
+        sa_relationship_kwargs={"uselist": False, "cascade": "all, delete-orphan"}
+    )
+    # What the file looked like on disk when it was probed
+    fingerprint: Optional["VideoFingerprint"] = Relationship(
+        sa_relationship_kwargs={"uselist": False, "cascade": "all, delete-orphan"}
+    )
+
     def exist(self) -> bool:
         return os.path.exists(self.video_path)
 
     def exist_thumb(self) -> bool:
-        return os.path.exists(self.thumbnail_path)
+        return thumbnail_store.exists(thumbnail_key(self.thumbnail_path))
 
     def delete_thumb(self):
-        if self.exist_thumb():
-            os.remove(self.thumbnail_path)
+        delete_thumbnails([self.thumbnail_path])
     
     def delete(self):
         if self.exist():
             os.remove(self.video_path)
 
+class VideoProbe(SQLModel, table=True):
+    id: str = Field(foreign_key="videosdatabase.id", primary_key=True)
+    data: bytes = Field(sa_column=Column(LargeBinary))
+
+    @classmethod
+    def pack(cls, ffprobe: dict) -> "VideoProbe":
+        raw = json.dumps(ffprobe, separators=(",", ":")).encode()
+        return cls(data=zlib.compress(raw, 9))
+
+    def unpack(self) -> dict:
+        return json.loads(zlib.decompress(self.data))
+
+class VideoFingerprint(SQLModel, table=True):
+    __table_args__ = (Index("ix_fingerprint_inode", "device", "inode"),)
+
+    id: str = Field(foreign_key="videosdatabase.id", primary_key=True)
+    path: str = Field(index=True, unique=True)
+    size: int = Field(...)
+    mtime_ns: int = Field(...)
+    inode: int = Field(...)
+    device: int = Field(...)
+
+    @classmethod
+    def from_stat(cls, path: str, st: os.stat_result) -> "VideoFingerprint":
+        return cls(
+            path=path,
+            size=st.st_size,
+            mtime_ns=st.st_mtime_ns,
+            inode=st.st_ino,
+            device=st.st_dev,
+        )
+
+    def update(self, path: str, st: os.stat_result):
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.inode = st.st_ino
+        self.device = st.st_dev
+
+class CachedMedia(SQLModel, table=True):
+    """Probe & thumbnail of a file's content, lives in its own db (survives hard reloads)"""
+
+    digest: str = Field(primary_key=True)
+    size: int = Field(primary_key=True)
+    mtime_ns: int = Field(primary_key=True)
+    probe: bytes = Field(sa_column=Column(LargeBinary))  # zlib'd json, like VideoProbe
+    thumbnail: str = Field(...)  # file name in MEDIA_CACHE_DIR
+    last_seen: float = Field(default_factory=lambda: datetime.now().timestamp(), index=True)
+
 class VideoResponse(BaseModel):
     id: str = Field(...)
     title: str
@@ -40,10 +162,25 @@ class VideoResponse(BaseModel):
     duration: int
     filesize: int
     modified_time: float
+    width: int = 0
+    height: int = 0
+    quality: str = ""
+    orientation: str = ""
+    favourite: bool = False
+    codec: str = ""
+    bit_rate: int = 0
+    frame_rate: float = 0.0
+    rotation: int = 0
+    thumbnail: str = ""
     extras: dict
 
 class VideoUpdate(BaseModel):
-    title: Optional[str]
+    title: Optional[str] = None
+    favourite: Optional[bool] = None
+
+class DuplicatesTrash(BaseModel):
+    # Groups to trash the extra copies of, every group when not given
+    content_hashes: Optional[list[str]] = None
 
 class DeletedVideo(SQLModel, table=True):
     id: str = Field(default=None, primary_key=True)
@@ -1,21 +1,72 @@
-from typing import Generator, Protocol
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from typing import Any, Callable, Generator, Protocol, TypeVar
 
-from sqlmodel import Session, create_engine
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import Session
 
-from src.config import DATA_DIR
-from src.data_store import create_engine_url, create_models
-from src.models import DeletedVideo, SQLModel
+from src.config import DATA_DIR, DB_READ_THREADS, MEDIA_CACHE_DIR
+from src.data_store import (
+    create_engine_url,
+    create_models,
+    create_search_index,
+    create_tuned_engine,
+)
+from src.models import CachedMedia, DeletedVideo, SQLModel, VideosDataBase
+
+
+T = TypeVar("T")
 
 
 class DataBaseSession(Protocol):
     def get_session(self) -> Generator[Session, None, None]: ...
 
 
+class DatabaseExecutor:
+    """Runs db work off the event loop: reads on a few threads, writes on one
+
+    `fn(session, *args)` gets a session of its own. What it returns comes back
+    detached with its columns loaded, relationships have to be loaded in `fn`.
+    Writes are committed after `fn`, one at a time (sqlite has one writer anyway).
+    """
+
+    def __init__(self, engine: Engine, readers: int = DB_READ_THREADS):
+        self.engine = engine
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+        self._local = threading.local()
+
+    def _connection(self) -> Connection:
+        # Every thread keeps the connection it checked out for its whole life
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self.engine.connect()
+        return connection
+
+    def _call(self, fn: Callable[..., T], args: tuple, commit: bool) -> T:
+        with Session(self._connection(), expire_on_commit=False) as session:
+            result = fn(session, *args)
+            if commit:
+                session.commit()
+            return result
+
+    async def read(self, fn: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._call, fn, args, False)
+
+    async def write(self, fn: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._call, fn, args, True)
+
+
 class NormalSession:
     def __init__(self):
         self.db_url = create_engine_url("videostore.db", DATA_DIR)
-        self.engine = create_engine(self.db_url)
-        create_models(SQLModel, self.engine, excludes=[DeletedVideo])
+        self.engine = create_tuned_engine(self.db_url)
+        create_models(SQLModel, self.engine, excludes=[DeletedVideo, CachedMedia])
+        create_search_index(self.engine, VideosDataBase.__tablename__)  # type: ignore
+        self.db = DatabaseExecutor(self.engine)
 
     def get_session(self) -> Generator[Session, None, None]:
         with Session(self.engine) as session:
@@ -25,8 +76,20 @@ class NormalSession:
 class DeletedVideosSession:
     def __init__(self):
         self.db_url = create_engine_url("deleted_videos.db", DATA_DIR)
-        self.engine = create_engine(self.db_url)
+        self.engine = create_tuned_engine(self.db_url)
         create_models(SQLModel, self.engine, includes=[DeletedVideo])
+        self.db = DatabaseExecutor(self.engine, readers=1)
+
+    def get_session(self) -> Generator[Session, None, None]:
+        with Session(self.engine) as session:
+            yield session
+
+
+class MediaCacheSession:
+    def __init__(self):
+        self.db_url = create_engine_url("media_cache.db", MEDIA_CACHE_DIR)
+        self.engine = create_tuned_engine(self.db_url)
+        create_models(SQLModel, self.engine, includes=[CachedMedia])
 
     def get_session(self) -> Generator[Session, None, None]:
         with Session(self.engine) as session:
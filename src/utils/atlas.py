@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import io
+import json
+import math
+import os
+from pathlib import Path
+import re
+import threading
+from typing import Iterable
+
+from src.config import (
+    ATLAS_COLUMNS,
+    ATLAS_DIR,
+    ATLAS_MAX_FILES,
+    ATLAS_TILE_SIZE,
+    THUMBNAIL_SIZES,
+)
+from src.models import VideosDataBase, thumbnail_key
+from src.utils.thumbnail_store import thumbnail_store
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional, without it the gallery loads thumbnails one by one
+    Image = None
+
+KEY_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# Smallest thumbnail that still fills a tile
+TILE_SOURCE_SIZE = min(
+    (size for size, width in THUMBNAIL_SIZES.items() if width >= ATLAS_TILE_SIZE[0]),
+    key=THUMBNAIL_SIZES.__getitem__,
+    default=None,
+)
+
+# (video id, thumbnail path) in the order of the page
+Tiles = list[tuple[str, str]]
+
+
+def atlas_key(tiles: Tiles) -> str:
+    """Changes with any of the page's thumbnails (they get a new file name each time)"""
+    parts = [f"{ATLAS_TILE_SIZE}:{ATLAS_COLUMNS}"]
+    parts += [f"{video_id}:{os.path.basename(path)}" for video_id, path in tiles]
+    return hashlib.blake2b("\n".join(parts).encode(), digest_size=16).hexdigest()
+
+
+def atlas_layout(tiles: Tiles) -> dict:
+    width, height = ATLAS_TILE_SIZE
+    columns = min(len(tiles), ATLAS_COLUMNS)
+    rows = math.ceil(len(tiles) / columns)
+    return {
+        "tile": [width, height],
+        "size": [columns * width, rows * height],
+        "tiles": {
+            video_id: [(i % columns) * width, (i // columns) * height]
+            for i, (video_id, _) in enumerate(tiles)
+        },
+    }
+
+
+def write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def paste_tile(atlas, offset: list[int], thumbnail_path: str):
+    """Draws the thumbnail letterboxed in its tile, missing/broken ones stay black"""
+    x, y = offset
+    width, height = ATLAS_TILE_SIZE
+    atlas.paste((0, 0, 0), (x, y, x + width, y + height))
+
+    data = thumbnail_store.read(thumbnail_key(thumbnail_path, TILE_SOURCE_SIZE))
+    if data is None:
+        data = thumbnail_store.read(thumbnail_key(thumbnail_path))
+    if data is None:
+        return
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            tile = ImageOps.contain(image.convert("RGB"), ATLAS_TILE_SIZE)
+    except OSError:
+        return
+    atlas.paste(tile, (x + (width - tile.width) // 2, y + (height - tile.height) // 2))
+
+
+class AtlasStore:
+    """Sprite sheets of listing pages: `<key>.json` (tiles & offsets), `<key>.webp`
+
+    The json is written with the listing, the image on its first request. The
+    json's mtime is the last time a listing used it, the least recent go first.
+    """
+
+    def __init__(self, root: Path = ATLAS_DIR):
+        self.root = root
+        # video id -> atlases it's in (described by this process), for regenerations
+        self.by_video: dict[str, set[str]] = {}
+        # `by_video` is shared by the listings' and the builds' threads
+        self._lock = threading.Lock()
+        self._building: dict[str, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    def image_path(self, key: str) -> Path:
+        return self.root / f"{key}.webp"
+
+    def meta_path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
+
+    async def describe(self, videos: Iterable[VideosDataBase]) -> dict | None:
+        """Atlas of a listing page for the gallery (url & tile offsets by video id)"""
+        tiles = [(video.id, video.thumbnail_path) for video in videos]
+        if not (self.enabled and tiles):
+            return None
+
+        key = await asyncio.to_thread(self.remember, tiles)
+        return {"url": f"/api/atlas/{key}", **atlas_layout(tiles)}
+
+    def remember(self, tiles: Tiles) -> str:
+        """Writes the page's json, or marks it as used if it's there already"""
+        key = atlas_key(tiles)
+        meta = self.meta_path(key)
+        try:
+            os.utime(meta)
+            written = False
+        except FileNotFoundError:
+            self.root.mkdir(parents=True, exist_ok=True)
+            write_atomic(meta, json.dumps({"tiles": tiles}).encode())
+            written = True
+
+        with self._lock:
+            for video_id, _ in tiles:
+                self.by_video.setdefault(video_id, set()).add(key)
+
+        # Pages that are listed but never looked at count too
+        if written:
+            self.prune()
+        return key
+
+    def load_tiles(self, key: str) -> Tiles | None:
+        try:
+            meta = json.loads(self.meta_path(key).read_bytes())
+            return [(video_id, path) for video_id, path in meta["tiles"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    async def image(self, key: str) -> Path | None:
+        """The atlas image, built once even when requested many times at once"""
+        path = self.image_path(key)
+        if path.exists():
+            return path
+        if not self.enabled or not self.meta_path(key).exists():
+            return None
+
+        if key not in self._building:
+            future = asyncio.ensure_future(asyncio.to_thread(self.build, key))
+            future.add_done_callback(lambda _: self._building.pop(key, None))
+            self._building[key] = future
+
+        built = await asyncio.shield(self._building[key])
+        return path if built else None
+
+    def build(self, key: str) -> bool:
+        tiles = self.load_tiles(key)
+        if not tiles:
+            return False
+
+        layout = atlas_layout(tiles)
+        atlas = Image.new("RGB", tuple(layout["size"]))
+        for video_id, thumbnail_path in tiles:
+            paste_tile(atlas, layout["tiles"][video_id], thumbnail_path)
+
+        self.save(key, atlas)
+        return True
+
+    def save(self, key: str, atlas):
+        tmp = self.image_path(key).with_suffix(".webp.tmp")
+        atlas.save(tmp, "WEBP", quality=80)
+        os.replace(tmp, self.image_path(key))
+
+    def update_thumbnail(self, video_id: str, thumbnail_path: str):
+        """Derives the atlases with the video's new thumbnail, only its tile is redrawn"""
+        with self._lock:
+            keys = list(self.by_video.get(video_id, ()))
+
+        for key in keys:
+            tiles = self.load_tiles(key)
+            if not tiles or video_id not in dict(tiles):
+                continue
+
+            tiles = [
+                (vid, thumbnail_path if vid == video_id else path) for vid, path in tiles
+            ]
+            new_key = self.remember(tiles)
+            old_image = self.image_path(key)
+            if not self.enabled or not old_image.exists():
+                continue  # Built in full on its first request
+
+            try:
+                with Image.open(old_image) as image:
+                    atlas = image.convert("RGB")
+                paste_tile(atlas, atlas_layout(tiles)["tiles"][video_id], thumbnail_path)
+                self.save(new_key, atlas)
+            except OSError:
+                continue
+
+    def prune(self):
+        metas = []
+        for meta in self.root.glob("*.json"):
+            try:
+                metas.append((meta.stat().st_mtime, meta))
+            except OSError:  # Pruned by another thread meanwhile
+                continue
+        metas = [meta for _, meta in sorted(metas)]
+
+        removed = set()
+        for meta in metas[: max(len(metas) - ATLAS_MAX_FILES, 0)]:
+            key = meta.stem
+            self.image_path(key).unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            removed.add(key)
+
+        if not removed:
+            return
+
+        with self._lock:
+            for video_id in list(self.by_video):
+                self.by_video[video_id] -= removed
+                if not self.by_video[video_id]:
+                    del self.by_video[video_id]
+
+
+atlas_store = AtlasStore()
@@ -0,0 +1,513 @@
+from array import array
+import heapq
+from itertools import filterfalse
+import os
+import re
+import sys
+import threading
+from typing import Any, Iterable
+
+from sqlmodel import Session, col, select
+
+from src.api.exceptions import InvalidListingQuery
+from src.models import VideosDataBase, thumbnail_url
+
+# What the listings need of a row, in the order it's selected
+FIELDS = (
+    "id",
+    "title",
+    "video_path",
+    "thumbnail_path",
+    "duration",
+    "filesize",
+    "modified_time",
+    "width",
+    "height",
+    "quality",
+    "orientation",
+    "favourite",
+    "codec",
+    "bit_rate",
+    "frame_rate",
+    "rotation",
+)
+
+# Numbers live in typed arrays, 1-8 bytes a value instead of an object each
+TYPECODES = {
+    "duration": "q",
+    "filesize": "q",
+    "modified_time": "d",
+    "width": "i",
+    "height": "i",
+    "favourite": "b",
+    "bit_rate": "q",
+    "frame_rate": "d",
+    "rotation": "i",
+}
+# A handful of distinct values, every row points at the same interned str
+LABELS = {"quality", "orientation", "codec"}
+
+# Thumbnails named by `generate_thumbnail`, their uuid fits in 16 bytes
+THUMBNAIL_NAME = re.compile(r"thumbnail_([0-9a-f]{32})(\.\w+)")
+
+# Removed rows are only marked until there are this many (or half the rows)
+COMPACT_AFTER = 1024
+# Sorted & filtered orders kept, each is patched with the rows changed since
+MAX_ORDERS = 16
+# More changed rows than this share of an order and it's sorted again instead
+RESORT_SHARE = 0.05
+# Ids per `IN (...)` when rows are read back after a write
+REFRESH_CHUNK = 500
+# What changed about a removed row, as far as the orders are concerned
+REMOVED = frozenset(FIELDS)
+
+# Related videos are picked from the video's folder and from this many videos
+# on either side of it by duration
+RELATED_WINDOW = 100
+BY_DURATION = [("duration", False), ("id", False)]
+
+
+def pack_id(video_id: str) -> bytes:
+    """Hex ids (the sha512 ones `build_video_model` makes) in half the bytes, same order"""
+    try:
+        packed = bytes.fromhex(video_id)
+        if packed.hex() == video_id:
+            return b"\0" + packed
+    except ValueError:
+        pass
+    return b"\1" + video_id.encode()
+
+
+def unpack_id(key: bytes) -> str:
+    return key[1:].hex() if key[0] == 0 else key[1:].decode()
+
+
+class PathColumn:
+    """Paths as (directory, file name), the videos of a folder share its str"""
+
+    def __init__(self, paths: Iterable[str] = ()):
+        self.folders: list[str] = []
+        self.names: list[str] = []
+        for path in paths:
+            self.append(path)
+
+    @staticmethod
+    def split(path: str) -> tuple[str, str]:
+        folder, sep, name = path.rpartition(os.sep)
+        return sys.intern(folder + sep), name
+
+    def append(self, path: str):
+        folder, name = self.split(path)
+        self.folders.append(folder)
+        self.names.append(name)
+
+    def __getitem__(self, position: int) -> str:
+        return self.folders[position] + self.names[position]
+
+    def __setitem__(self, position: int, path: str):
+        self.folders[position], self.names[position] = self.split(path)
+
+
+class ThumbnailColumn:
+    """Thumbnail names as their 16 byte uuid & interned suffix, others kept whole"""
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.uuids = bytearray()
+        self.suffixes: list[str] = []
+        # Position -> name that isn't a `generate_thumbnail` one (older full paths)
+        self.others: dict[int, str] = {}
+        for name in names:
+            self.append(name)
+
+    def append(self, name: str):
+        self.uuids += bytes(16)
+        self.suffixes.append("")
+        self[len(self.suffixes) - 1] = name
+
+    def __getitem__(self, position: int) -> str:
+        if position in self.others:
+            return self.others[position]
+        uuid = self.uuids[position * 16 : position * 16 + 16].hex()
+        return f"thumbnail_{uuid}{self.suffixes[position]}"
+
+    def __setitem__(self, position: int, name: str):
+        if match := THUMBNAIL_NAME.fullmatch(name):
+            self.uuids[position * 16 : position * 16 + 16] = bytes.fromhex(match[1])
+            self.suffixes[position] = sys.intern(match[2])
+            self.others.pop(position, None)
+        else:
+            self.others[position] = name
+
+
+# Columns that aren't plain lists or arrays
+PACKED = {"video_path": PathColumn, "thumbnail_path": ThumbnailColumn}
+
+
+def new_column(name: str, values: Iterable = ()):
+    if name in TYPECODES:
+        return array(TYPECODES[name], values)
+    if name in PACKED:
+        return PACKED[name](values)
+    return list(values)
+
+
+class VideoRecord:
+    """One row out of the columns, only made for the rows a response has"""
+
+    __slots__ = FIELDS
+
+    def __init__(self, *values: Any):
+        for name, value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+    def as_dict(self, extras: dict | None = None) -> dict[str, Any]:
+        """Shaped like `VideoResponse`, built without it (the values come from the db)"""
+        return {
+            "id": self.id,
+            "title": self.title,
+            "duration": self.duration,
+            "filesize": self.filesize,
+            "modified_time": self.modified_time,
+            "width": self.width,
+            "height": self.height,
+            "quality": self.quality,
+            "orientation": self.orientation,
+            "favourite": self.favourite,
+            "codec": self.codec,
+            "bit_rate": self.bit_rate,
+            "frame_rate": self.frame_rate,
+            "rotation": self.rotation,
+            "thumbnail": thumbnail_url(self.id, self.thumbnail_path),
+            "extras": extras or {},
+        }
+
+
+class VideoColumns:
+    """The listing fields of every video in memory, one column per field
+
+    Loaded once at startup, every writer of the videos table hands it the rows
+    it changed before bumping the catalog. Listings sort, filter & page over it
+    without the ORM, a row is only built into a `VideoRecord` for a response.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.columns: dict[str, Any] = {name: new_column(name) for name in FIELDS}
+        self.alive = array("b")
+        # Packed id -> position, the "id" column holds the same bytes
+        self.positions: dict[bytes, int] = {}
+        # Directory -> positions of the videos in it, for the related videos
+        self.folders: dict[str, set[int]] = {}
+        self._dead = 0
+        # (position, fields that changed, None for a new row) since the oldest
+        # order was sorted, an order knows how many it has seen
+        self._changes: list[tuple[int, frozenset | None]] = []
+        self._orders: dict[tuple, tuple[list[int], int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def load(self, session: Session):
+        rows = session.exec(select(*(getattr(VideosDataBase, f) for f in FIELDS))).all()
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._set(row)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def put(self, videos: Iterable[VideosDataBase]):
+        """Rows a writer has at hand, with every listing field loaded"""
+        with self._lock:
+            for video in videos:
+                self._set(tuple(getattr(video, name) for name in FIELDS))
+
+    def refresh(self, session: Session, video_ids: Iterable[str]):
+        """Reads the rows back after a write, the ones that are gone are dropped"""
+        video_ids = list(video_ids)
+        for i in range(0, len(video_ids), REFRESH_CHUNK):
+            chunk = video_ids[i : i + REFRESH_CHUNK]
+            rows = session.exec(
+                select(*(getattr(VideosDataBase, f) for f in FIELDS)).where(
+                    col(VideosDataBase.id).in_(chunk)
+                )
+            ).all()
+            with self._lock:
+                for row in rows:
+                    self._set(row)
+                self._discard(set(chunk) - {row[0] for row in rows})
+
+    def remove(self, video_ids: Iterable[str]):
+        with self._lock:
+            self._discard(video_ids)
+
+    def _changed(self, position: int, fields: frozenset | None):
+        if not self._orders:
+            return
+        self._changes.append((position, fields))
+        if len(self._changes) > len(self.alive):
+            # Cheaper to sort them all again than to keep the log
+            self._changes.clear()
+            self._orders.clear()
+
+    def _set(self, values: tuple):
+        values = [
+            sys.intern(value or "") if name in LABELS else value
+            for name, value in zip(FIELDS, values)
+        ]
+        values[0] = pack_id(values[0])
+        position = self.positions.get(values[0])
+        if position is None:
+            position = self.positions[values[0]] = len(self.alive)
+            self._changed(position, None)
+            self.alive.append(1)
+            for name, value in zip(FIELDS, values):
+                self.columns[name].append(value)
+            self._file(position)
+            return
+
+        changed = []
+        for name, value in zip(FIELDS, values):
+            column = self.columns[name]
+            if column[position] != value:
+                changed.append(name)
+                if name == "video_path":
+                    self._unfile(position)
+                column[position] = value
+                if name == "video_path":
+                    self._file(position)
+        # A reload reads back plenty of rows that didn't change
+        if changed:
+            self._changed(position, frozenset(changed))
+
+    def _discard(self, video_ids: Iterable[str]):
+        for video_id in video_ids:
+            position = self.positions.pop(pack_id(video_id), None)
+            if position is not None:
+                self.alive[position] = 0
+                self._dead += 1
+                self._unfile(position)
+                self._changed(position, REMOVED)
+
+        if self._dead >= max(COMPACT_AFTER, len(self.positions)):
+            self._compact()
+
+    def _compact(self):
+        live = [i for i in range(len(self.alive)) if self.alive[i]]
+        columns = self.columns
+        self._reset()
+        for name, column in columns.items():
+            self.columns[name] = new_column(name, [column[i] for i in live])
+        self.alive = array("b", [1]) * len(live)
+        self.positions = {video_id: i for i, video_id in enumerate(self.columns["id"])}
+        for position in range(len(live)):
+            self._file(position)
+
+    def _folder(self, position: int) -> str:
+        return self.columns["video_path"].folders[position]
+
+    def _file(self, position: int):
+        self.folders.setdefault(self._folder(position), set()).add(position)
+
+    def _unfile(self, position: int):
+        folder = self._folder(position)
+        if positions := self.folders.get(folder):
+            positions.discard(position)
+            if not positions:
+                del self.folders[folder]
+
+    def _record(self, position: int) -> VideoRecord:
+        record = VideoRecord(*(self.columns[name][position] for name in FIELDS))
+        record.id = unpack_id(record.id)
+        record.favourite = bool(record.favourite)
+        return record
+
+    def get(self, video_id: str) -> VideoRecord | None:
+        with self._lock:
+            position = self.positions.get(pack_id(video_id))
+            return None if position is None else self._record(position)
+
+    def ids(self) -> list[str]:
+        with self._lock:
+            return list(map(unpack_id, self.positions))
+
+    def records(self, video_ids: Iterable[str]) -> list[VideoRecord]:
+        """In the order given, unknown ids are skipped"""
+        with self._lock:
+            positions = (self.positions.get(pack_id(video_id)) for video_id in video_ids)
+            return [self._record(p) for p in positions if p is not None]
+
+    def all(self) -> list[VideoRecord]:
+        with self._lock:
+            return [self._record(position) for position in self.positions.values()]
+
+    def thumbnail_path(self, video_id: str) -> str | None:
+        with self._lock:
+            position = self.positions.get(pack_id(video_id))
+            return None if position is None else self.columns["thumbnail_path"][position]
+
+    def summary(self) -> tuple[int, int, int]:
+        """(count, total size, favourites)"""
+        with self._lock:
+            alive = self.alive
+            filesize, favourite = self.columns["filesize"], self.columns["favourite"]
+            if not self._dead:
+                return len(alive), sum(filesize), sum(favourite)
+
+            live = [i for i in range(len(alive)) if alive[i]]
+            return (
+                len(live),
+                sum(filesize[i] for i in live),
+                sum(favourite[i] for i in live),
+            )
+
+    def page(
+        self,
+        sort_key: list[tuple[str, bool]],
+        quality: str | None,
+        orientation: str | None,
+        cursor: list[Any] | None,
+        limit: int,
+    ) -> list[VideoRecord]:
+        """Up to `limit` rows in `sort_key` order, strictly after the cursor's values"""
+        if cursor is not None:
+            # The cursor has the id as it's sent, the column the packed one
+            cursor = [
+                pack_id(value) if name == "id" and isinstance(value, str) else value
+                for (name, _), value in zip(sort_key, cursor)
+            ]
+
+        with self._lock:
+            order = self._order(sort_key, quality, orientation)
+            try:
+                start = 0 if cursor is None else self._bisect(order, sort_key, cursor)
+            except TypeError:
+                raise InvalidListingQuery("Cursor doesn't match the requested sort")
+            return [self._record(position) for position in order[start : start + limit]]
+
+    def neighbours(
+        self,
+        video_id: str,
+        sort_key: list[tuple[str, bool]],
+        quality: str | None,
+        orientation: str | None,
+        count: int,
+    ) -> tuple[list[VideoRecord], list[VideoRecord]] | None:
+        """The `count` videos before & after one in a listing, both nearest first"""
+        with self._lock:
+            position = self.positions.get(pack_id(video_id))
+            if position is None:
+                return None
+
+            order = self._order(sort_key, quality, orientation)
+            # Where it is, or would be when the filters leave it out
+            after = self._bisect(order, sort_key, self._row(position, sort_key))
+            before = after - 1 if after and order[after - 1] == position else after
+            return (
+                [self._record(p) for p in reversed(order[max(0, before - count) : before])],
+                [self._record(p) for p in order[after : after + count]],
+            )
+
+    def related(self, video_id: str, count: int) -> list[VideoRecord]:
+        """Videos like this one: same folder, close in duration, same resolution"""
+        with self._lock:
+            position = self.positions.get(pack_id(video_id))
+            if position is None:
+                return []
+
+            by_duration = self._order(BY_DURATION, None, None)
+            at = self._bisect(by_duration, BY_DURATION, self._row(position, BY_DURATION))
+            candidates = set(by_duration[max(0, at - RELATED_WINDOW) : at + RELATED_WINDOW])
+            candidates.update(self.folders.get(self._folder(position), ()))
+            candidates.discard(position)
+
+            ids = self.columns["id"]
+            best = heapq.nsmallest(
+                count, candidates, key=lambda p: (-self._similarity(position, p), ids[p])
+            )
+            return [self._record(p) for p in best]
+
+    def _similarity(self, a: int, b: int) -> float:
+        duration, width, height = (self.columns[n] for n in ("duration", "width", "height"))
+        score = 1 - abs(duration[a] - duration[b]) / max(duration[a], duration[b], 1)
+        if self._folder(a) == self._folder(b):
+            score += 1
+        if (width[a], height[a]) == (width[b], height[b]):
+            score += 0.5
+        return score
+
+    def _order(
+        self, sort_key: list[tuple[str, bool]], quality: str | None, orientation: str | None
+    ) -> list[int]:
+        key = (tuple(sort_key), quality, orientation)
+        order, seen = self._orders.pop(key, (None, 0))
+
+        # Only rows whose changes touch what this order sorts or filters by move
+        relevant = {name for name, _ in sort_key}
+        relevant.update(
+            name for name, label in (("quality", quality), ("orientation", orientation)) if label
+        )
+        moved, added = set(), set()
+        for position, fields in self._changes[seen:]:
+            if fields is None:
+                added.add(position)
+            elif not relevant.isdisjoint(fields):
+                moved.add(position)
+        # Ones added since weren't in it
+        moved -= added
+
+        if order is None or len(moved) + len(added) > RESORT_SHARE * len(order):
+            order = [i for i in range(len(self.alive)) if self._keeps(i, quality, orientation)]
+            # Stable sorts, least significant column first, give the mixed directions
+            for name, desc in reversed(sort_key):
+                order.sort(key=self.columns[name].__getitem__, reverse=desc)
+        else:
+            # A reload changes a batch at a time, moving those beats sorting it all
+            if moved:
+                order = list(filterfalse(moved.__contains__, order))
+            for i in moved | added:
+                if self._keeps(i, quality, orientation):
+                    order.insert(self._bisect(order, sort_key, self._row(i, sort_key)), i)
+
+        if len(self._orders) >= MAX_ORDERS:
+            del self._orders[next(iter(self._orders))]
+        self._orders[key] = (order, len(self._changes))
+        return order
+
+    def _keeps(self, position: int, quality: str | None, orientation: str | None) -> bool:
+        return bool(
+            self.alive[position]
+            and (quality is None or self.columns["quality"][position] == quality)
+            and (orientation is None or self.columns["orientation"][position] == orientation)
+        )
+
+    def _row(self, position: int, sort_key: list[tuple[str, bool]]) -> list[Any]:
+        return [self.columns[name][position] for name, _ in sort_key]
+
+    def _bisect(self, order: list[int], sort_key: list[tuple[str, bool]], values: list[Any]) -> int:
+        """Index of the first row in `order` (sorted by `sort_key`) after `values`"""
+        columns = [(self.columns[name], desc) for name, desc in sort_key]
+
+        def after(position: int) -> bool:
+            for (column, desc), value in zip(columns, values):
+                current = column[position]
+                if current != value:
+                    return current < value if desc else current > value
+            return False
+
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if after(order[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+video_columns = VideoColumns()
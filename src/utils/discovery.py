@@ -0,0 +1,158 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import os
+from pathlib import Path, PurePosixPath
+from typing import Callable, Iterable, Iterator
+
+from src.config import (
+    DISCOVERY_WORKERS,
+    EXCLUDE_GLOBS,
+    SKIP_HIDDEN_DIRS,
+    TRASH_DIR_NAME,
+)
+
+FileValidator = Callable[[os.DirEntry], bool]
+# Told about each directory that couldn't be scanned, and why
+ScanErrorHandler = Callable[[str, OSError], None]
+
+
+@dataclass(frozen=True)
+class RootRules:
+    root: str
+    excludes: list[str] = field(default_factory=list)
+    skip_hidden_dirs: bool = SKIP_HIDDEN_DIRS
+
+    def excluded(self, path: str) -> bool:
+        if not self.excludes:
+            return False
+
+        relative = PurePosixPath(path[len(self.root) + 1 :])
+        return any(relative.full_match(pattern) for pattern in self.excludes)
+
+    def covers(self, path: str) -> bool:
+        """Whether a walk from the root would reach `path`"""
+        if not path.startswith(self.root + os.sep):
+            return False
+
+        parts = path[len(self.root) + 1 :].split(os.sep)
+        if TRASH_DIR_NAME in parts[:-1]:
+            return False
+        if self.skip_hidden_dirs and any(part.startswith(".") for part in parts[:-1]):
+            return False
+
+        # An excluded directory hides everything under it
+        return not any(
+            self.excluded(os.path.join(self.root, *parts[:i]))
+            for i in range(1, len(parts) + 1)
+        )
+
+
+class FileEntry:
+    """Enough of `os.DirEntry` for a path that wasn't found by scanning"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def stat(self) -> os.stat_result:
+        return os.stat(self.path)
+
+    def is_symlink(self) -> bool:
+        return os.path.islink(self.path)
+
+
+def root_rules(root: Path) -> RootRules:
+    root = Path(root).expanduser().resolve()
+    return RootRules(str(root), EXCLUDE_GLOBS.get(root, []))
+
+
+def scan_dir(
+    rules: RootRules, directory: str, file_validator: FileValidator
+) -> tuple[list[os.DirEntry], list[str], OSError | None]:
+    """One directory level: (valid files, sub-directories to scan, why it failed)
+
+    A directory that couldn't be (fully) read isn't an empty one, what's under
+    it may still be there.
+    """
+    files, dirs = [], []
+
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # d_type answers these without a stat (except for symlinks)
+                if entry.is_dir(follow_symlinks=False):
+                    # Trashed duplicates are never indexed again
+                    if entry.name == TRASH_DIR_NAME:
+                        continue
+                    if rules.skip_hidden_dirs and entry.name.startswith("."):
+                        continue
+                    if not rules.excluded(entry.path):
+                        dirs.append(entry.path)
+
+                elif entry.is_file():
+                    if file_validator(entry) and not rules.excluded(entry.path):
+                        files.append(entry)
+    except OSError as e:
+        # Unreadable/vanished directory (or root), whatever was read is still valid
+        return files, dirs, e
+
+    return files, dirs, None
+
+
+def walk_roots(
+    roots: Iterable[Path],
+    file_validator: FileValidator,
+    *,
+    unreadable: ScanErrorHandler | None = None,
+    workers: int = DISCOVERY_WORKERS,
+) -> Iterator[os.DirEntry]:
+    """Scans every root (and sub-directory) on a thread pool, yields files as they're found"""
+    rules = [root_rules(root) for root in roots]
+    return walk_dirs(
+        [(rule, rule.root) for rule in rules],
+        file_validator,
+        unreadable=unreadable,
+        workers=workers,
+    )
+
+
+def walk_dirs(
+    starts: Iterable[tuple[RootRules, str]],
+    file_validator: FileValidator,
+    *,
+    unreadable: ScanErrorHandler | None = None,
+    workers: int = DISCOVERY_WORKERS,
+) -> Iterator[os.DirEntry]:
+    """`walk_roots` from given directories, each with the rules of its root
+
+    `unreadable` is called (on the consuming thread) for every directory whose
+    scan failed, a missing start directory included.
+    """
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="discovery")
+    pending: dict[Future, tuple[RootRules, str]] = {}
+
+    def submit(rules: RootRules, directory: str):
+        pending[pool.submit(scan_dir, rules, directory, file_validator)] = (
+            rules,
+            directory,
+        )
+
+    try:
+        for rules, directory in starts:
+            submit(rules, directory)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rules, directory = pending.pop(future)
+                files, dirs, error = future.result()
+                if error is not None and unreadable is not None:
+                    unreadable(directory, error)
+
+                # Sub-trees go back on the pool before we hand out the files
+                for directory in dirs:
+                    submit(rules, directory)
+
+                yield from files
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
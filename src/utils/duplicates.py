@@ -0,0 +1,122 @@
+from collections import defaultdict
+import os
+from pathlib import Path
+import shutil
+from uuid import uuid4
+
+from sqlmodel import Session, col, func, select
+
+from src.config import ROOT_DIRS, TRASH_DIR_NAME
+from src.models import VideosDataBase
+from src.utils.columns import VideoRecord, video_columns
+
+
+def shared_hashes(
+    session: Session, content_hashes: list[str] | None = None
+) -> dict[str, list[str]]:
+    """Ids by content hash, for the hashes more than one row has"""
+    shared = (
+        select(VideosDataBase.content_hash)
+        .where(VideosDataBase.content_hash != "")
+        .group_by(col(VideosDataBase.content_hash))
+        .having(func.count() > 1)
+    )
+    if content_hashes is not None:
+        shared = shared.where(col(VideosDataBase.content_hash).in_(content_hashes))
+
+    rows = session.exec(
+        select(VideosDataBase.content_hash, VideosDataBase.id).where(
+            col(VideosDataBase.content_hash).in_(shared)
+        )
+    ).all()
+
+    groups: dict[str, list[str]] = defaultdict(list)
+    for content_hash, video_id in rows:
+        groups[content_hash].append(video_id)
+    return groups
+
+
+def keeper_first(copies: list[VideoRecord]) -> list[VideoRecord]:
+    """The copy to keep first: on disk, then a favourite, the oldest, the shortest path"""
+    return sorted(
+        copies,
+        key=lambda copy: (
+            not os.path.exists(copy.video_path),
+            not copy.favourite,
+            copy.modified_time,
+            len(copy.video_path),
+            copy.id,
+        ),
+    )
+
+
+def wasted(copies: list[VideoRecord]) -> int:
+    return sum(copy.filesize for copy in copies[1:])
+
+
+def duplicate_groups(
+    groups: dict[str, list[str]],
+) -> list[tuple[str, list[VideoRecord]]]:
+    """(content hash, copies with the one to keep first), most wasted space first
+
+    Checks the disk, run it off the event loop. Groups without a copy left on disk
+    have nothing to keep, the next reload removes their rows.
+    """
+    found = []
+    for content_hash, video_ids in groups.items():
+        copies = keeper_first(video_columns.records(video_ids))
+        if len(copies) > 1 and os.path.exists(copies[0].video_path):
+            found.append((content_hash, copies))
+
+    found.sort(key=lambda group: wasted(group[1]), reverse=True)
+    return found
+
+
+def library_path(video_path: str) -> str:
+    """The path below its root dir (prefixed with the root's name), never the full one"""
+    path = Path(video_path)
+    for root in ROOT_DIRS:
+        if path.is_relative_to(root):
+            return str(Path(root.name) / path.relative_to(root))
+    return path.name
+
+
+def trash_path(video_path: str) -> Path:
+    """`TRASH_DIR_NAME` of the file's root dir, under the same sub-path"""
+    path = Path(video_path)
+    for root in ROOT_DIRS:
+        if path.is_relative_to(root):
+            return root / TRASH_DIR_NAME / path.relative_to(root)
+    return path.parent / TRASH_DIR_NAME / path.name
+
+
+def move_to_trash(video_path: str) -> str:
+    """Moves the file into the trash (a rename, the trash is on its root's disk)"""
+    target = trash_path(video_path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists():
+        # An earlier copy from the same path, both are kept
+        target = target.with_stem(f"{target.stem}-{uuid4().hex[:8]}")
+
+    shutil.move(video_path, target)
+    return str(target)
+
+
+def trash_copies(
+    groups: list[tuple[str, list[VideoRecord]]],
+) -> tuple[list[tuple[VideoRecord, str]], list[VideoRecord]]:
+    """Trashes all but the first copy of each group: ([(copy, trash path)], [failed])"""
+    trashed, failed = [], []
+    for _, copies in groups:
+        # The one `duplicate_groups` picked, unless it vanished since
+        if not os.path.exists(copies[0].video_path):
+            failed.extend(copies[1:])
+            continue
+
+        for copy in copies[1:]:
+            try:
+                trashed.append((copy, move_to_trash(copy.video_path)))
+            except OSError:
+                failed.append(copy)
+
+    return trashed, failed
@@ -0,0 +1,27 @@
+import json
+from typing import Any
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json writes the same, slower
+    orjson = None
+
+NDJSON = "application/x-ndjson"
+
+
+def dumps(content: Any) -> bytes:
+    """Compact JSON of plain dicts, lists, strs & numbers, nothing is validated"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class FastJSONResponse(Response):
+    """For rows out of the db, they skip pydantic & `jsonable_encoder`"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,237 @@
+import os
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from sqlmodel import Session, col, select
+
+from src.models import VideoFingerprint, VideoProbe, VideosDataBase
+
+# sqlite caps the number of bound parameters of a single statement
+ID_CHUNK_SIZE = 500
+
+
+class KnownFile(NamedTuple):
+    id: str
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+
+    def matches(self, st: os.stat_result) -> bool:
+        return (
+            self.size == st.st_size
+            and self.mtime_ns == st.st_mtime_ns
+            and self.inode == st.st_ino
+            and self.device == st.st_dev
+        )
+
+
+def load_known_files(
+    session: Session,
+    paths: Iterable[str] | None = None,
+    dirs: Iterable[str] = (),
+) -> dict[str, KnownFile]:
+    """Every fingerprint, or only those of `paths` and of files under `dirs`"""
+    query = select(
+        VideoFingerprint.id,
+        VideoFingerprint.path,
+        VideoFingerprint.size,
+        VideoFingerprint.mtime_ns,
+        VideoFingerprint.inode,
+        VideoFingerprint.device,
+    )
+    if paths is None:
+        return {row[1]: KnownFile(*row) for row in session.exec(query).all()}
+
+    paths = list(paths)
+    queries = [
+        query.where(col(VideoFingerprint.path).in_(paths[start : start + ID_CHUNK_SIZE]))
+        for start in range(0, len(paths), ID_CHUNK_SIZE)
+    ]
+    queries += [
+        query.where(
+            col(VideoFingerprint.path).startswith(directory + os.sep, autoescape=True)
+        )
+        for directory in dirs
+    ]
+    return {
+        row[1]: KnownFile(*row) for query in queries for row in session.exec(query).all()
+    }
+
+
+def fingerprint_legacy_entries(session: Session):
+    """Fingerprints rows indexed before fingerprints existed, if the file looks untouched"""
+    legacy_entries = session.exec(
+        select(VideosDataBase)
+        .outerjoin(VideoFingerprint, VideoFingerprint.id == VideosDataBase.id)  # type: ignore
+        .where(VideoFingerprint.id == None)  # noqa: E711
+    ).all()
+
+    for entry in legacy_entries:
+        fingerprint = VideoFingerprint(
+            path=entry.video_path, size=-1, mtime_ns=-1, inode=-1, device=-1
+        )
+        try:
+            st = os.stat(entry.video_path)
+            # A different mtime means it changed since the probe, so it's re-probed
+            if st.st_mtime == entry.modified_time:
+                fingerprint.update(entry.video_path, st)
+        except OSError:
+            pass  # Gone, the placeholder makes reconciliation remove it
+
+        entry.fingerprint = fingerprint
+
+    session.commit()
+
+
+class Reconciler:
+    """Sorts discovered files against the known fingerprints, one file at a time"""
+
+    def __init__(self, known: dict[str, KnownFile]):
+        self.known = known
+        self.by_inode = {(entry.device, entry.inode): entry for entry in known.values()}
+        self.seen: set[str] = set()
+        # video id -> (new path, stat), same file under another name
+        self.moved: dict[str, tuple[str, os.stat_result]] = {}
+        # Ids being re-probed, their file was modified in place
+        self.claimed: set[str] = set()
+        # Directories the walk couldn't scan (or finish scanning)
+        self.unscanned: list[str] = []
+        self.new = self.changed = self.unchanged = 0
+
+    def classify(self, file: os.DirEntry) -> tuple[str, str | None, os.stat_result] | None:
+        """(path, id of the row to re-probe, stat) of a file that has to be probed"""
+        try:
+            st = file.stat()
+            # Only symlinks differ from their resolved path (roots are resolved)
+            path = os.path.realpath(file.path) if file.is_symlink() else file.path
+        except OSError:
+            return None
+
+        # A symlink and its target are the same video
+        if path in self.seen:
+            return None
+        self.seen.add(path)
+
+        entry = self.known.get(path)
+        # A row that already moved elsewhere can't also claim its old path
+        if entry is not None and entry.id not in self.moved:
+            if entry.matches(st):
+                self.unchanged += 1
+                return None
+
+            self.changed += 1
+            self.claimed.add(entry.id)
+            return path, entry.id, st
+
+        # Renamed/moved: same inode & content, and nothing is left at the old path
+        entry = self.by_inode.get((st.st_dev, st.st_ino))
+        if (
+            entry
+            and entry.id not in self.moved
+            and entry.id not in self.claimed
+            and entry.size == st.st_size
+            and entry.mtime_ns == st.st_mtime_ns
+            and self._vacated(entry)
+        ):
+            self.moved[entry.id] = (path, st)
+            return None
+
+        self.new += 1
+        return path, None, st
+
+    @staticmethod
+    def _vacated(entry: KnownFile) -> bool:
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return True
+        # Hard links keep the old path, a replacement has a different inode
+        return (st.st_dev, st.st_ino) != (entry.device, entry.inode)
+
+    def removed(self) -> list[str]:
+        """Known files that weren't found again and are gone, only valid after the walk
+
+        The walk also misses files that are still there: those under a directory it
+        couldn't scan (permissions, I/O errors, an unmounted root) are kept.
+        """
+        unscanned = tuple(directory + os.sep for directory in self.unscanned)
+        return [
+            entry.id
+            for path, entry in self.known.items()
+            if path not in self.seen
+            and entry.id not in self.moved
+            and not path.startswith(unscanned)
+            and not os.path.lexists(path)
+        ]
+
+
+def fetch_entries(session: Session, ids: Iterable[str]) -> list[VideosDataBase]:
+    ids = list(ids)
+    entries = []
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        chunk = ids[start : start + ID_CHUNK_SIZE]
+        entries.extend(
+            session.exec(
+                select(VideosDataBase).where(col(VideosDataBase.id).in_(chunk))
+            ).all()
+        )
+    return entries
+
+
+def move_entry(entry: VideosDataBase, path: str, st: os.stat_result):
+    # Titles renamed by the user are kept, default ones follow the file
+    if entry.title == Path(entry.video_path).stem:
+        entry.title = Path(path).stem
+
+    entry.video_path = path
+    if entry.fingerprint is None:
+        entry.fingerprint = VideoFingerprint.from_stat(path, st)
+    else:
+        entry.fingerprint.update(path, st)
+
+
+def refresh_entry(entry: VideosDataBase, fresh: VideosDataBase):
+    """Copies a re-probed file's data onto its existing row (keeps id, title & favourite)
+
+    The old thumbnail is left in the pack, it's the caller's to delete after the commit.
+    """
+    for column in (
+        "thumbnail_path",
+        "filesize",
+        "modified_time",
+        "duration",
+        "width",
+        "height",
+        "quality",
+        "orientation",
+        "codec",
+        "bit_rate",
+        "frame_rate",
+        "rotation",
+        "remux",
+        "content_hash",
+    ):
+        setattr(entry, column, getattr(fresh, column))
+
+    history = {
+        key: value
+        for key, value in (entry.extras or {}).items()
+        if str(key).startswith("update_")
+    }
+    entry.extras = {**fresh.extras, **history}
+
+    # Updated in place, a replacement row would clash with the old primary key
+    if fresh.probe and entry.probe:
+        entry.probe.data = fresh.probe.data
+    elif fresh.probe:
+        entry.probe = VideoProbe(data=fresh.probe.data)
+
+    if fresh.fingerprint and entry.fingerprint:
+        for column in ("path", "size", "mtime_ns", "inode", "device"):
+            setattr(entry.fingerprint, column, getattr(fresh.fingerprint, column))
+    elif fresh.fingerprint:
+        entry.fingerprint = VideoFingerprint(
+            **fresh.fingerprint.model_dump(exclude={"id"})
+        )
@@ -0,0 +1,31 @@
+import hashlib
+import mmap
+import os
+from pathlib import Path
+
+from src.config import PARTIAL_HASH_CHUNK
+
+
+def partial_hash(
+    path: Path | str, size: int | None = None, chunk: int = PARTIAL_HASH_CHUNK
+) -> str:
+    """blake2b over the size plus `chunk` bytes of the head, middle & tail"""
+    size = os.path.getsize(path) if size is None else size
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, "little"))
+    if size == 0:
+        return digest.hexdigest()  # An empty file can't be mapped
+
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            # Only the pages of the samples are read (cheap, even on a NAS), small
+            # files are hashed whole
+            length = len(view)
+            if length <= 3 * chunk:
+                digest.update(view)
+            else:
+                for start in (0, (length - chunk) // 2, length - chunk):
+                    digest.update(view[start : start + chunk])
+
+    return digest.hexdigest()
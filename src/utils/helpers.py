@@ -1,21 +1,48 @@
 import asyncio
 import os
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterator
 
 from rich.progress import (
     BarColumn,
     MofNCompleteColumn,
     Progress,
+    TaskID,
     TextColumn,
     TimeElapsedColumn,
     TimeRemainingColumn,
 )
-from sqlmodel import Session, select
-
-from src.config import ALLOWED_FILES, ROOT_DIRS
-from src.models import VideoResponse, VideosDataBase
-from src.utils.video_processing import generate_video_info
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, delete, select, update
+
+from src.catalog import catalog
+from src.config import (
+    ALLOWED_FILES,
+    CATALOG_STREAM_CHUNK,
+    INGEST_BATCH_SIZE,
+    MEDIA_CACHE_MAX_AGE_DAYS,
+    ROOT_DIRS,
+    THUMBNAIL_SIZES,
+)
+from src.data_store import run_in_session
+from src.models import (
+    VideoFingerprint,
+    VideoProbe,
+    VideoResponse,
+    VideosDataBase,
+    thumbnail_key,
+    thumbnail_url,
+    thumbnail_variant,
+)
+from src.utils.columns import video_columns
+from src.utils.discovery import ScanErrorHandler, walk_roots
+from src.utils.fastjson import dumps
+from src.utils.fingerprints import fingerprint_legacy_entries, load_known_files
+from src.utils.hashing import partial_hash
+from src.utils.media_cache import media_cache
+from src.utils.pipeline import FanoutReporter, IngestPipeline, IngestReporter
+from src.utils.thumbnail_store import thumbnail_store
+from src.utils.video_processing import apply_probe
 
 
 PROGRESS_COLUMNS = [
@@ -30,15 +57,19 @@ PROGRESS_COLUMNS = [
 
 
 # Helper functions
+def visible_extras(extras: dict | None) -> dict:
+    """`extras` without the edit history"""
+    return {
+        name: value
+        for name, value in (extras or {}).items()
+        if not str(name).startswith("update_")
+    }
+
+
 def convert_db_to_response(
     db_entry: VideosDataBase, include_extras: bool = False
 ) -> VideoResponse:
-    extras = {}
-    for name, value in (db_entry.extras or {}).items():
-        if str(name).startswith("update_") or not include_extras:
-            continue
-
-        extras[name] = value
+    extras = visible_extras(db_entry.extras) if include_extras else {}
 
     return VideoResponse(
         id=db_entry.id,
@@ -46,241 +77,226 @@ def convert_db_to_response(
         duration=db_entry.duration,
         filesize=db_entry.filesize,
         modified_time=db_entry.modified_time,
+        width=db_entry.width,
+        height=db_entry.height,
+        quality=db_entry.quality,
+        orientation=db_entry.orientation,
+        favourite=db_entry.favourite,
+        codec=db_entry.codec,
+        bit_rate=db_entry.bit_rate,
+        frame_rate=db_entry.frame_rate,
+        rotation=db_entry.rotation,
+        thumbnail=thumbnail_url(db_entry.id, db_entry.thumbnail_path),
         extras=extras,
     )
 
 
-def discover_files(
-    file_validator: Callable[[Path], bool],
-    progress_callback: Callable[[Path], None],
-) -> list[Path]:
-    discovered_files: list[Path] = []
+def build_catalog(version: int) -> bytes:
+    """Serializes the whole library (without extras) for the catalog snapshot"""
+    return dumps(
+        {"version": version, "videos": [v.as_dict() for v in video_columns.all()]}
+    )
 
-    for root_dir in ROOT_DIRS:
-        # Exapands
-        root_dir = Path(root_dir).expanduser().resolve()
 
-        # iter through `root_dir` files
-        for file in root_dir.rglob("*"):
+def stream_catalog(version: int) -> Iterator[bytes]:
+    """The catalog as NDJSON: a `{"version"}` line, then one per video"""
+    yield dumps({"version": version}) + b"\n"
 
-            if not file.is_file():
-                continue
+    # Rows removed meanwhile are skipped, changed ones are sent as they are now
+    ids = video_columns.ids()
+    for i in range(0, len(ids), CATALOG_STREAM_CHUNK):
+        videos = video_columns.records(ids[i : i + CATALOG_STREAM_CHUNK])
+        yield b"".join(dumps(v.as_dict()) + b"\n" for v in videos)
 
-            if not file_validator(file):
-                continue
 
-            # `file` is valid and we should add it
-            progress_callback(file)
-            discovered_files.append(file)
+def backfill_video_metadata(session: Session):
+    """Splits the full probe out of `extras` for rows indexed before the typed columns"""
+    legacy_entries = session.exec(
+        select(VideosDataBase)
+        .outerjoin(VideoProbe, VideoProbe.id == VideosDataBase.id)  # type: ignore
+        .where(VideoProbe.id == None)  # noqa: E711
+    ).all()
 
-    return discovered_files
+    for entry in legacy_entries:
+        # Old rows stored the whole probe (plus edit history) as `extras`
+        apply_probe(entry, visible_extras(entry.extras))
 
+    session.commit()
 
-async def create_modals(
-    files: list[Path],
-    progress_callback: Callable[[], None],
-    error_callback: Callable[[Path, Exception], None],
-    *,
-    sem_limit: int = os.cpu_count() or 4,
-) -> list[VideosDataBase]:
 
-    sem = asyncio.Semaphore(sem_limit)
+def backfill_content_hashes(session: Session) -> int:
+    """Hashes the files of rows indexed before `content_hash` existed"""
+    legacy_entries = session.exec(
+        select(VideosDataBase.id, VideosDataBase.video_path).where(
+            VideosDataBase.content_hash == ""
+        )
+    ).all()
 
-    async def proc_wrapper(fp: Path):
+    hashed = 0
+    for video_id, video_path in legacy_entries:
         try:
-            result = await generate_video_info(
-                sem,
-                fp,
-            )
-            progress_callback()
-            return result
-        except Exception as e:
-            error_callback(fp, e)
-
-    tasks = [proc_wrapper(file) for file in files]
-    results = []
-    for result in await asyncio.gather(*tasks):
-        if result is not None:
-            results.append(result)
+            digest = partial_hash(video_path)
+        except OSError:
+            continue  # Gone, reconciliation removes it
+
+        session.execute(
+            update(VideosDataBase)
+            .where(VideosDataBase.id == video_id)  # type: ignore
+            .values(content_hash=digest)
+        )
+        hashed += 1
+        # A library's worth of reads, don't hold the write lock for all of them
+        if hashed % INGEST_BATCH_SIZE == 0:
+            session.commit()
 
-    return results
+    session.commit()
+    return hashed
 
 
-def add_modals_to_db(
-    session: Session,
-    modals: list[VideosDataBase],
-    progress_callback: Callable[[], None],
-    error_callback: Callable[[VideosDataBase, Exception], None],
-):
-    for vid in modals:
-        try:
-            session.add(vid)
-            progress_callback()
-        except Exception as e:
-            error_callback(vid, e)
+def pack_legacy_thumbnails(session: Session) -> int:
+    """Moves thumbnails still saved as files (before the pack) into the pack"""
+    paths = session.exec(select(VideosDataBase.thumbnail_path)).all()
+    return thumbnail_store.adopt(
+        (thumbnail_key(path, size), Path(thumbnail_variant(path, size)))
+        for path in paths
+        if os.path.isabs(path)
+        for size in THUMBNAIL_SIZES
+        if os.path.exists(thumbnail_variant(path, size))
+    )
 
 
-async def make_data(session: Session):
-    with Progress(*PROGRESS_COLUMNS) as progress_bar:
+def discover_files(
+    file_validator: Callable[[os.DirEntry], bool],
+    progress_callback: Callable[[os.DirEntry], None],
+    unreadable: ScanErrorHandler | None = None,
+) -> Iterator[os.DirEntry]:
+    """Streams the valid files of every `ROOT_DIRS` entry (scanned in parallel)"""
+    for entry in walk_roots(ROOT_DIRS, file_validator, unreadable=unreadable):
+        progress_callback(entry)
+        yield entry
 
-        # Video discovery task
-        video_discovery_task = progress_bar.add_task(
-            "[cyan]Discovering files[/cyan]", total=0
-        )
 
-        # Validator
-        def is_file_valid(file: Path) -> bool:
-            return bool(file.suffix and file.suffix in ALLOWED_FILES)
+def is_file_valid(entry: os.DirEntry) -> bool:
+    return os.path.splitext(entry.name)[1] in ALLOWED_FILES
 
-        files_to_add = discover_files(
-            is_file_valid, lambda _: progress_bar.advance(video_discovery_task)
-        )
-        progress_bar.update(video_discovery_task, total=len(files_to_add))
-        progress_bar.stop_task(video_discovery_task)
 
-        # Early exit
-        if not files_to_add:
-            return
+class ProgressReporter:
+    """Shows the pipeline's phases as rich progress bars (totals grow as files flow in)"""
 
-        # Video modal generation
-        video_generation_task = progress_bar.add_task(
-            "[green]Generating models[/green]", total=len(files_to_add)
-        )
-        results = await create_modals(
-            files_to_add,
-            lambda: progress_bar.advance(video_generation_task),
-            progress_bar.console.print,
-        )
-        progress_bar.stop_task(video_discovery_task)
+    PHASES = {
+        "discover": "[cyan]Discovering[/cyan]",
+        "probe": "[green]Probing[/green]",
+        "thumbnail": "[green]Thumbnails[/green]",
+        "insert": "[green]Inserting in db[/green]",
+    }
 
-        # Add generated video to database
-        add_video_task = progress_bar.add_task(
-            "[green]Inserting in db[/green]", total=len(results)
-        )
-        add_modals_to_db(
-            session,
-            results,
-            lambda: progress_bar.advance(add_video_task),
-            lambda v, e: progress_bar.console.print(
-                "Error while inserting to db:", e, v
-            ),
-        )
-        progress_bar.stop_task(add_video_task)
+    def __init__(self, progress_bar: Progress):
+        self.progress_bar = progress_bar
+        self.tasks: dict[str, TaskID] = {}
 
-        session.commit()
-        return True
+    def _task(self, phase: str) -> TaskID:
+        if phase not in self.tasks:
+            self.tasks[phase] = self.progress_bar.add_task(self.PHASES[phase], total=0)
+        return self.tasks[phase]
 
+    def queued(self, phase: str, count: int = 1):
+        task = self._task(phase)
+        total = self.progress_bar.tasks[task].total or 0
+        self.progress_bar.update(task, total=total + count)
 
-async def reload_data(session: Session, hard_reload: bool = False) -> bool:
-    with Progress(*PROGRESS_COLUMNS) as progress_bar:
+    def done(self, phase: str, count: int = 1):
+        task = self._task(phase)
+        if phase == "discover":
+            # Nothing queues files before the walk finds them
+            self.queued(phase, count)
+        self.progress_bar.advance(task, count)
 
-        if hard_reload:
-            progress_bar.console.print(
-                "[yellow bold]Performing hard reload: wiping DB and thumbnails...[/bold yellow]"
-            )
+    def log(self, *objects):
+        self.progress_bar.console.print(*objects)
 
-            # Delete all thumbnails
-            all_thumbs = session.exec(select(VideosDataBase)).all()
 
-            # Add task to progress_bar
-            thumb_remove_task = progress_bar.add_task(
-                "[red]Remove thumbs[/red]", total=len(all_thumbs)
-            )
+async def make_data(engine: Engine):
+    # An empty db is a reload where every file is new
+    return await reload_data(engine)
 
-            for entry in all_thumbs:
-                try:
-                    entry.delete_thumb()
-                except Exception as e:
-                    progress_bar.console.print(
-                        f"Unable to delete thumb: {entry.thumbnail_path}", e
-                    )
 
-                # Update the progress bar's 'n'
-                progress_bar.advance(thumb_remove_task)
-                session.delete(entry)
+def wipe_videos(session: Session):
+    # Bulk deletes, the ORM cascade would load every probe & fingerprint
+    for table in (VideoProbe, VideoFingerprint, VideosDataBase):
+        session.execute(delete(table))
+    session.commit()
 
-            progress_bar.stop_task(thumb_remove_task)
-            session.commit()
-            filename_exists = []  # We want to re-add everything
 
-        else:
-            # Partial reload: remove stale or orphaned entries only
-            prev_db_data = session.exec(select(VideosDataBase)).all()
-            filename_exists = []
-
-            def should_keep(path: Path) -> bool:
-                valid_file_rules = [
-                    lambda: path.exists(),
-                    lambda: path.suffix in ALLOWED_FILES,
-                    lambda: path.is_symlink()
-                    or any(path.is_relative_to(_root_path) for _root_path in ROOT_DIRS),
-                ]
-                return all(map(lambda rule: rule(), valid_file_rules))
-
-            for data_old in prev_db_data:
-                vid_path = Path(data_old.video_path).expanduser().resolve()
-
-                if should_keep(vid_path):
-                    filename_exists.append(vid_path.stem)
-                else:
-                    progress_bar.console.print(vid_path, data_old.video_path)
-                    try:
-                        data_old.delete_thumb()
-                    except:
-                        pass
-
-                    progress_bar.print(
-                        f"[red bold]File Removed: {vid_path.stem} [!Exist][/bold red]"
-                    )
-
-                    session.delete(data_old)
-                    continue
+def live_fingerprints(session: Session) -> set[tuple[int, int]]:
+    rows = session.exec(select(VideoFingerprint.size, VideoFingerprint.mtime_ns)).all()
+    return set(map(tuple, rows))
 
-            session.commit()
 
-        # New Discover file task
-        discover_file_task = progress_bar.add_task("[cyan]Discovering[/cyan]")
+async def reload_data(
+    engine: Engine, hard_reload: bool = False, reporter: IngestReporter | None = None
+) -> bool:
+    """Every db step runs on a thread with a session of its own, so cancelling
+    the reload never closes a session a thread is still committing with"""
+    with Progress(*PROGRESS_COLUMNS) as progress_bar:
+        # The terminal always gets progress bars, `reporter` a copy of the events
+        terminal = ProgressReporter(progress_bar)
+        reporter = FanoutReporter(terminal, reporter) if reporter else terminal
 
-        # Discover new files
-        def is_file_valid(file: Path) -> bool:
-            return bool(
-                (file.stem not in filename_exists)
-                and (file.suffix and file.suffix in ALLOWED_FILES)
+        if hard_reload:
+            reporter.log(
+                "[yellow bold]Performing hard reload: wiping DB and thumbnails...[/bold yellow]"
             )
 
-        new_files = discover_files(
-            is_file_valid, lambda _: progress_bar.advance(discover_file_task)
-        )
-        progress_bar.update(discover_file_task, total=len(new_files))
-        progress_bar.stop_task(discover_file_task)
+            # All thumbnails are in one pack, dropped at once
+            thumbnail_store.clear()
 
-        if not new_files:
-            return True
+            await asyncio.to_thread(run_in_session, engine, wipe_videos)
+            video_columns.clear()
+            catalog.bump()
 
-        video_info_task = progress_bar.add_task(
-            "[green]Generating Models[/green]", total=len(new_files)
+        else:
+            await asyncio.to_thread(run_in_session, engine, fingerprint_legacy_entries)
+
+        # Files are probed & inserted while the walk goes on, unchanged ones are skipped
+        pipeline = IngestPipeline(
+            engine,
+            lambda unreadable: discover_files(is_file_valid, lambda _: None, unreadable),
+            await asyncio.to_thread(run_in_session, engine, load_known_files),
+            reporter,
         )
+        await pipeline.run()
 
-        results = await create_modals(
-            new_files,
-            lambda: progress_bar.advance(video_info_task),
-            progress_bar.console.print,
-        )
-        progress_bar.advance(video_info_task, len(new_files) - len(results))
-        progress_bar.stop_task(video_info_task)
+        # Unchanged files aren't read by the pipeline, older rows get their hash here
+        try:
+            if hashed := await asyncio.to_thread(
+                run_in_session, engine, backfill_content_hashes
+            ):
+                reporter.log(f"Hashed {hashed} previously indexed files")
+                catalog.bump()
+        except Exception as e:
+            reporter.log("Unable to hash the indexed files:", e)
 
-        add_video_task = progress_bar.add_task(
-            "[green]Inserting in db[/green]", total=len(results)
-        )
-        add_modals_to_db(
-            session,
-            results,
-            lambda: progress_bar.advance(add_video_task),
-            lambda v, e: progress_bar.console.print(
-                "Error while inserting to db:", e, v
-            ),
-        )
-        progress_bar.stop_task(add_video_task)
+        # Unchanged files skip the cache, their fingerprints keep its entries alive
+        def prune_media_cache():
+            live = run_in_session(engine, live_fingerprints)
+            media_cache.prune(MEDIA_CACHE_MAX_AGE_DAYS, live)
+
+        try:
+            await asyncio.to_thread(prune_media_cache)
+        except Exception as e:
+            reporter.log("Unable to prune the media cache:", e)
 
-        session.commit()
+        # Replaced & removed thumbnails are dead weight in the pack until then
+        try:
+            if reclaimed := await asyncio.to_thread(thumbnail_store.compact):
+                reporter.log(f"Compacted thumbnails: {reclaimed / 1024**2:.1f}MB freed")
+        except OSError as e:
+            reporter.log("Unable to compact the thumbnails:", e)
+
+        reconciler = pipeline.reconciler
+        reporter.log(
+            f"[cyan]{reconciler.unchanged} unchanged, {reconciler.new} new, "
+            f"{reconciler.changed} changed, {len(reconciler.moved)} moved, "
+            f"{pipeline.removed} removed[/cyan]"
+        )
     return True
@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+import re
+import shutil
+import time
+from typing import Awaitable
+
+from rich.console import Console
+
+from src.config import (
+    HLS_CACHE_SIZE,
+    HLS_DIR,
+    HLS_IDLE_TIMEOUT,
+    HLS_SEGMENT_SECONDS,
+    HLS_WAIT_TIMEOUT,
+)
+from src.models import VideosDataBase
+from src.utils.video_processing import segment_hls
+
+console = Console()
+
+KEY_PATTERN = re.compile(r"[0-9a-f]{32}")
+FILE_PATTERN = re.compile(r"index\.m3u8|init\.mp4|\d{5,}\.m4s")
+MEDIA_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".mp4": "video/mp4",
+    ".m4s": "video/iso.segment",
+}
+
+# Written once the segmenter is through, the playlist won't change anymore
+COMPLETE = "complete"
+
+
+class HlsSegments:
+    """HLS versions of videos, cut on their first watch by one ffmpeg per video
+
+    Every viewer of a video reads the segments from the same directory while
+    its segmenter is still writing them, a segmenter nobody reads from anymore
+    is stopped. Directories are keyed like the scrub previews, the least
+    recently watched go once they don't fit the cache.
+    """
+
+    def __init__(self, root: Path = HLS_DIR, budget: int = HLS_CACHE_SIZE):
+        self.root = root
+        self.budget = budget
+        self._jobs: dict[str, asyncio.Task] = {}
+        # Key of a running job -> when its playlist or a segment was last asked for
+        self._fetched: dict[str, float] = {}
+        # Keys ffmpeg couldn't segment, not retried until a restart
+        self.failed: set[str] = set()
+
+    @staticmethod
+    def key(video: VideosDataBase) -> str:
+        parts = (
+            video.id,
+            video.video_path,
+            video.filesize,
+            video.modified_time,
+            HLS_SEGMENT_SECONDS,
+        )
+        raw = ":".join(map(str, parts)).encode()
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def directory(self, key: str) -> Path:
+        return self.root / key
+
+    def running(self, key: str) -> bool:
+        return key in self._jobs
+
+    def idle(self, key: str) -> bool:
+        return time.monotonic() - self._fetched.get(key, 0) > HLS_IDLE_TIMEOUT
+
+    def start(self, video: VideosDataBase) -> str | None:
+        """Key of the video's segments, cut unless they're there or being cut already"""
+        key = self.key(video)
+        if key in self.failed:
+            return None
+
+        folder = self.directory(key)
+        self._fetched[key] = time.monotonic()
+        if key not in self._jobs and not (folder / COMPLETE).exists():
+            task = asyncio.create_task(
+                self.segment(key, video.video_path, video.codec)
+            )
+            task.add_done_callback(lambda _: self.finished(key))
+            self._jobs[key] = task
+
+        # mtime doubles as the last time it was watched, for the cache size
+        try:
+            os.utime(folder)
+        except OSError:
+            pass
+        return key
+
+    def finished(self, key: str):
+        self._jobs.pop(key, None)
+        self._fetched.pop(key, None)
+
+    async def segment(self, key: str, video_path: str, codec: str):
+        folder = self.directory(key)
+        # Whatever a run cut short by a restart left behind
+        shutil.rmtree(folder, ignore_errors=True)
+        folder.mkdir(parents=True)
+        # Room for this one before it grows, not only once it's whole
+        await asyncio.to_thread(self.enforce_budget, keep=key)
+        try:
+            done = await self.while_watched(key, segment_hls(video_path, folder, codec))
+        except asyncio.CancelledError:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        except Exception as e:
+            console.print(f"[red]HLS segmenting failed: {video_path}[/red]", e)
+            done = False
+
+        if done is None:
+            console.print(f"[yellow]HLS segmenting stopped, unwatched: {video_path}[/yellow]")
+            # Cut again from the start by the next viewer
+            shutil.rmtree(folder, ignore_errors=True)
+            return
+
+        if not done:
+            self.failed.add(key)
+            shutil.rmtree(folder, ignore_errors=True)
+            return
+
+        (folder / COMPLETE).touch()
+        await asyncio.to_thread(self.enforce_budget, keep=key)
+
+    async def while_watched(self, key: str, work: Awaitable[bool]) -> bool | None:
+        """`work`'s result, None if it was stopped because `key` went idle"""
+        task = asyncio.ensure_future(work)
+        try:
+            while True:
+                finished, _ = await asyncio.wait({task}, timeout=HLS_IDLE_TIMEOUT / 4)
+                if finished:
+                    return task.result()
+                if self.idle(key):
+                    # Kills ffmpeg, or gives up its place in the queue for a slot
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    return None
+        except asyncio.CancelledError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise
+
+    async def file(self, key: str, name: str) -> Path | None:
+        """The file, waiting for the segmenter to write it, None if it never will"""
+        if key in self._jobs:
+            self._fetched[key] = time.monotonic()
+        path = self.directory(key) / name
+        deadline = asyncio.get_running_loop().time() + HLS_WAIT_TIMEOUT
+        while not path.exists():
+            if key not in self._jobs or asyncio.get_running_loop().time() > deadline:
+                # It may have been written right before the segmenter exited
+                return path if path.exists() else None
+            await asyncio.sleep(0.25)
+        return path
+
+    def enforce_budget(self, keep: str | None = None):
+        """Drops the least recently watched videos' segments until they fit the cache"""
+        folders = []
+        for folder in self.root.iterdir():
+            try:
+                size = sum(path.stat().st_size for path in folder.iterdir())
+                folders.append((folder.stat().st_mtime, size, folder))
+            except OSError:
+                continue
+
+        used = sum(size for _, size, _ in folders)
+        for _, size, folder in sorted(folders):
+            if used <= self.budget:
+                break
+            if folder.name == keep or folder.name in self._jobs:
+                continue
+
+            shutil.rmtree(folder, ignore_errors=True)
+            used -= size
+
+    async def shutdown(self):
+        for task in list(self._jobs.values()):
+            task.cancel()
+        await asyncio.gather(*self._jobs.values(), return_exceptions=True)
+
+
+hls_segments = HlsSegments()
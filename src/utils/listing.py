@@ -0,0 +1,79 @@
+import base64
+import binascii
+import json
+from typing import Any
+
+from src.api.exceptions import InvalidListingQuery
+from src.utils.columns import VideoRecord
+
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 500
+
+# Videos on either side of the one being watched, and related ones
+DEFAULT_NEIGHBOURS = 5
+MAX_NEIGHBOURS = 50
+DEFAULT_RELATED = 12
+MAX_RELATED = 50
+
+# `sortBy` value (as sent by the gallery) -> column
+SORT_COLUMNS = {
+    "date": "modified_time",
+    "duration": "duration",
+    "filesize": "filesize",
+    "size": "filesize",
+    "title": "title",
+}
+
+# Filter values the gallery sends -> stored labels
+QUALITY_ALIASES = {"2k": "QHD"}
+ORIENTATION_ALIASES = {"landscape": "16:9", "portrait": "9:16"}
+
+# A sort key is a list of (column name, descending) pairs
+SortKey = list[tuple[str, bool]]
+
+
+def listing_sort_key(sort_by: str, sort_asc: bool, fav_first: bool) -> SortKey:
+    if sort_by not in SORT_COLUMNS:
+        raise InvalidListingQuery(f"Unknown sort: {sort_by}")
+
+    key = [(SORT_COLUMNS[sort_by], not sort_asc), ("id", not sort_asc)]
+    if fav_first:
+        key.insert(0, ("favourite", True))
+
+    return key
+
+
+def filter_labels(quality: str, orientation: str) -> tuple[str | None, str | None]:
+    """Stored (quality, orientation) labels the listing keeps, None for all"""
+    quality, orientation = quality.lower(), orientation.lower()
+    if quality != "all":
+        quality = QUALITY_ALIASES.get(quality, quality).upper()
+    if orientation != "all":
+        orientation = ORIENTATION_ALIASES.get(orientation, orientation)
+
+    return (
+        None if quality == "all" else quality,
+        None if orientation == "all" else orientation,
+    )
+
+
+def encode_cursor(video: VideoRecord, sort_key: SortKey) -> str:
+    # Booleans are stored as 0/1 and only compare with `<`/`>` as integers
+    values = [
+        int(value) if isinstance(value, bool) else value
+        for value in (getattr(video, name) for name, _ in sort_key)
+    ]
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str, length: int) -> list[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise InvalidListingQuery("Malformed cursor")
+
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidListingQuery("Cursor doesn't match the requested sort")
+
+    return values
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta
+import json
+import os
+from pathlib import Path
+import threading
+from typing import NamedTuple
+from uuid import uuid4
+import zlib
+
+from sqlalchemy import bindparam, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, col, select
+
+from src.config import MEDIA_CACHE_DIR, THUMBNAIL_SIZES
+from src.models import CachedMedia, VideosDataBase, thumbnail_key
+from src.sessions import MediaCacheSession
+from src.utils.thumbnail_store import ThumbnailPack, thumbnail_store
+
+
+class MediaKey(NamedTuple):
+    digest: str
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def of(cls, digest: str, st: os.stat_result) -> "MediaKey":
+        """`digest` is the file's `partial_hash`, the same content keyed by its mtime too"""
+        return cls(digest, st.st_size, st.st_mtime_ns)
+
+    @property
+    def name(self) -> str:
+        return f"{self.digest}-{self.size}-{self.mtime_ns}"
+
+
+class CacheHit(NamedTuple):
+    probe: dict
+    thumbnail: str  # name in the cache's own pack
+
+
+def copy_thumbnails(
+    source: ThumbnailPack, name: str, target: ThumbnailPack, target_name: str
+):
+    """Every size of the `name` thumbnail, under `target_name` in the `target` pack"""
+    thumbnails = {}
+    for size in THUMBNAIL_SIZES:
+        data = source.read(thumbnail_key(name, size))
+        if data is not None:
+            thumbnails[thumbnail_key(target_name, size)] = bytes(data)
+    target.put_many(thumbnails)
+
+
+def copy_as_new_thumbnails(
+    source: ThumbnailPack, name: str, target: ThumbnailPack = thumbnail_store
+) -> str:
+    """Fresh thumbnails (named like `generate_thumbnail` does) from the `name` ones"""
+    suffix = os.path.splitext(name)[1]
+    new_name = f"thumbnail_{uuid4().hex}{suffix}"
+    copy_thumbnails(source, name, target, new_name)
+    return new_name
+
+
+class MediaCache:
+    """Probe results & thumbnails by file content, apart from the videos db"""
+
+    def __init__(self, root: Path = MEDIA_CACHE_DIR):
+        self.root = root
+        # Its own pack, hard reloads drop the videos' one
+        self.thumbs = ThumbnailPack(root / "thumbs")
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        # Opened on first use, nothing else needs the cache db. The ingest threads
+        # race for it, only one may migrate the db & adopt the loose files
+        with self._lock:
+            if self._engine is None:
+                self.root.mkdir(parents=True, exist_ok=True)
+                engine = MediaCacheSession().engine
+                self.adopt_files()
+                self._engine = engine
+            return self._engine
+
+    def adopt_files(self):
+        """Thumbnails cached as loose files (before the pack) move into the pack"""
+        if self.thumbs.root.is_dir():
+            self.thumbs.adopt(
+                (path.name, path)
+                for path in self.thumbs.root.iterdir()
+                if path.suffix in (".webp", ".png")
+            )
+
+    def lookup(self, key: MediaKey) -> CacheHit | None:
+        with Session(self.engine) as session:
+            entry = session.get(CachedMedia, key)
+
+        if entry is None:
+            return None
+
+        if not self.thumbs.exists(entry.thumbnail):
+            return None
+
+        return CacheHit(json.loads(zlib.decompress(entry.probe)), entry.thumbnail)
+
+    def restore_thumbnail(
+        self, hit: CacheHit, store: ThumbnailPack = thumbnail_store
+    ) -> str:
+        """Fresh thumbnails from the cached ones"""
+        return copy_as_new_thumbnails(self.thumbs, hit.thumbnail, store)
+
+    def store(self, entries: list[tuple[MediaKey, VideosDataBase, bool]]):
+        """Caches (key, video, was a hit), hits only get their `last_seen` refreshed"""
+        now = datetime.now().timestamp()
+        rows = []
+        for key, video, hit in entries:
+            if hit or not video.probe:
+                continue
+
+            thumbnail = thumbnail_key(video.thumbnail_path)
+            name = key.name + os.path.splitext(thumbnail)[1]
+            if not self.thumbs.exists(name):
+                copy_thumbnails(thumbnail_store, thumbnail, self.thumbs, name)
+
+            rows.append(
+                {
+                    **key._asdict(),
+                    "probe": video.probe.data,
+                    "thumbnail": name,
+                    "last_seen": now,
+                }
+            )
+
+        with Session(self.engine) as session:
+            if rows:
+                statement = sqlite_insert(CachedMedia).values(rows)
+                statement = statement.on_conflict_do_update(
+                    index_elements=list(MediaKey._fields),
+                    set_={
+                        column: statement.excluded[column]
+                        for column in ("probe", "thumbnail", "last_seen")
+                    },
+                )
+                session.execute(statement)
+
+            touched = [
+                {f"key_{name}": value for name, value in key._asdict().items()}
+                for key, _, hit in entries
+                if hit
+            ]
+            if touched:
+                table = CachedMedia.__table__  # type: ignore
+                session.execute(
+                    update(table)
+                    .where(
+                        table.c.digest == bindparam("key_digest"),
+                        table.c.size == bindparam("key_size"),
+                        table.c.mtime_ns == bindparam("key_mtime_ns"),
+                    )
+                    .values(last_seen=now),
+                    touched,
+                )
+            session.commit()
+
+    def prune(self, max_age_days: float, live: set[tuple[int, int]]) -> int:
+        """Drops entries unseen for `max_age_days`, unless a `live` (size, mtime_ns) file has them"""
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).timestamp()
+        with Session(self.engine) as session:
+            stale = [
+                entry
+                for entry in session.exec(
+                    select(CachedMedia).where(col(CachedMedia.last_seen) < cutoff)
+                ).all()
+                if (entry.size, entry.mtime_ns) not in live
+            ]
+            for entry in stale:
+                session.delete(entry)
+            session.commit()
+
+        self.thumbs.delete_many(
+            thumbnail_key(entry.thumbnail, size)
+            for entry in stale
+            for size in THUMBNAIL_SIZES
+        )
+        self.thumbs.compact()
+        return len(stale)
+
+
+media_cache = MediaCache()
@@ -0,0 +1,238 @@
+from array import array
+from fractions import Fraction
+import math
+import mmap
+from pathlib import Path
+import struct
+import sys
+from typing import Iterator, NamedTuple
+
+# Suffixes worth trying before ffprobe (ISO base media files)
+MP4_SUFFIXES = {".mp4", ".m4v", ".mov"}
+
+# Sample entry fourcc -> ffmpeg's codec name
+CODEC_NAMES = {
+    b"avc1": "h264",
+    b"avc3": "h264",
+    b"hvc1": "hevc",
+    b"hev1": "hevc",
+    b"dvh1": "hevc",
+    b"dvhe": "hevc",
+    b"av01": "av1",
+    b"vp08": "vp8",
+    b"vp09": "vp9",
+    b"mp4v": "mpeg4",
+    b"jpeg": "mjpeg",
+    b"mjpa": "mjpeg",
+    b"png ": "png",
+    b"apch": "prores",
+    b"apcn": "prores",
+    b"apcs": "prores",
+    b"apco": "prores",
+    b"ap4h": "prores",
+}
+
+
+class Mp4ParseError(Exception):
+    pass
+
+
+class Box(NamedTuple):
+    type: bytes
+    offset: int  # of the header
+    start: int  # of the payload
+    end: int
+
+
+def iter_boxes(buf, start: int, end: int) -> Iterator[Box]:
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", buf, offset)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", buf, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset  # runs to the end of the file
+
+        if size < header or offset + size > end:
+            raise Mp4ParseError(f"Truncated {kind!r} box at {offset}")
+
+        yield Box(kind, offset, offset + header, offset + size)
+        offset += size
+
+
+def child(buf, box: Box, *path: bytes) -> Box | None:
+    for kind in path:
+        children = iter_boxes(buf, box.start, box.end)
+        box = next((found for found in children if found.type == kind), None)
+        if box is None:
+            return None
+    return box
+
+
+def full_box_version(buf, box: Box) -> int:
+    return buf[box.start]
+
+
+def parse_mvhd(buf, box: Box) -> tuple[int, int]:
+    """(timescale, duration)"""
+    if full_box_version(buf, box) == 1:
+        return struct.unpack_from(">IQ", buf, box.start + 20)
+    return struct.unpack_from(">II", buf, box.start + 12)
+
+
+def parse_tkhd_rotation(buf, box: Box) -> int:
+    """Rotation of the display matrix, with ffprobe's sign (clockwise is negative)"""
+    offset = box.start + (52 if full_box_version(buf, box) == 1 else 40)
+    a, b = struct.unpack_from(">ii", buf, offset)
+    return -round(math.degrees(math.atan2(b, a)))
+
+
+def sample_bytes(buf, stsz: Box) -> tuple[int, int]:
+    """(sample count, total size of the samples)"""
+    sample_size, count = struct.unpack_from(">II", buf, stsz.start + 4)
+    if sample_size:
+        return count, sample_size * count
+
+    table = stsz.start + 12
+    if table + 4 * count > stsz.end:
+        raise Mp4ParseError("Truncated stsz table")
+
+    sizes = array("I")
+    sizes.frombytes(buf[table : table + 4 * count])
+    if sys.byteorder == "little":
+        sizes.byteswap()
+    return count, sum(sizes)
+
+
+def first_sample_delta(buf, stts: Box | None) -> int:
+    if stts is None:
+        return 0
+    (entries,) = struct.unpack_from(">I", buf, stts.start + 4)
+    if not entries:
+        return 0
+    return struct.unpack_from(">II", buf, stts.start + 8)[1]
+
+
+def rate(value: Fraction) -> str:
+    return f"{value.numerator}/{value.denominator}"
+
+
+def parse_video_track(buf, trak: Box, index: int) -> dict | None:
+    mdia = child(buf, trak, b"mdia")
+    hdlr = mdia and child(buf, mdia, b"hdlr")
+    if not hdlr or buf[hdlr.start + 8 : hdlr.start + 12] != b"vide":
+        return None
+
+    mdhd = child(buf, mdia, b"mdhd")
+    stbl = child(buf, mdia, b"minf", b"stbl")
+    stsd = stbl and child(buf, stbl, b"stsd")
+    stsz = stbl and child(buf, stbl, b"stsz")
+    if not (mdhd and stsd and stsz):
+        return None
+
+    timescale, duration_ts = parse_mvhd(buf, mdhd)  # same layout as mvhd
+    count, total_bytes = sample_bytes(buf, stsz)
+    if not (timescale and duration_ts and count):
+        return None  # Fragmented (samples live in moof boxes)
+
+    # First sample description, a VisualSampleEntry
+    entry = stsd.start + 8
+    fourcc = bytes(buf[entry + 4 : entry + 8])
+    width, height = struct.unpack_from(">HH", buf, entry + 32)
+
+    duration = duration_ts / timescale
+    stream = {
+        "index": index,
+        "codec_name": CODEC_NAMES.get(fourcc, fourcc.decode("latin-1").strip()),
+        "codec_type": "video",
+        "codec_tag_string": fourcc.decode("latin-1"),
+        "width": width,
+        "height": height,
+        "avg_frame_rate": rate(Fraction(count * timescale, duration_ts)),
+        "time_base": f"1/{timescale}",
+        "duration_ts": duration_ts,
+        "duration": f"{duration:.6f}",
+        "bit_rate": str(int(total_bytes * 8 / duration)),
+        "nb_frames": str(count),
+        "disposition": {"attached_pic": 0},
+    }
+
+    delta = first_sample_delta(buf, child(buf, stbl, b"stts"))
+    stream["r_frame_rate"] = (
+        rate(Fraction(timescale, delta)) if delta else stream["avg_frame_rate"]
+    )
+
+    tkhd = child(buf, trak, b"tkhd")
+    if tkhd and (rotation := parse_tkhd_rotation(buf, tkhd)):
+        stream["side_data_list"] = [
+            {"side_data_type": "Display Matrix", "rotation": rotation}
+        ]
+
+    return stream
+
+
+def parse_mp4(buf, size: int) -> dict | None:
+    top: dict[bytes, Box] = {}
+    for box in iter_boxes(buf, 0, size):
+        top.setdefault(box.type, box)
+
+    moov, ftyp = top.get(b"moov"), top.get(b"ftyp")
+    mvhd = moov and child(buf, moov, b"mvhd")
+    if not mvhd:
+        return None
+
+    timescale, duration_ts = parse_mvhd(buf, mvhd)
+    if not (timescale and duration_ts):
+        return None
+    duration = duration_ts / timescale
+
+    streams = []
+    boxes = iter_boxes(buf, moov.start, moov.end)
+    for index, trak in enumerate(box for box in boxes if box.type == b"trak"):
+        if stream := parse_video_track(buf, trak, index):
+            streams.append(stream)
+    if not streams:
+        return None
+
+    tags = {}
+    if ftyp:
+        major, minor = struct.unpack_from(">4sI", buf, ftyp.start)
+        compatible = bytes(buf[ftyp.start + 8 : ftyp.end])
+        tags = {
+            "major_brand": major.decode("latin-1"),
+            "minor_version": str(minor),
+            "compatible_brands": compatible.decode("latin-1"),
+        }
+
+    mdat = top.get(b"mdat")
+    return {
+        "streams": streams,
+        "format": {
+            "format_name": "mov,mp4,m4a,3gp,3g2,mj2",
+            "format_long_name": "QuickTime / MOV",
+            "start_time": "0.000000",
+            "duration": f"{duration:.6f}",
+            "size": str(size),
+            "bit_rate": str(int(size * 8 / duration)),
+            "tags": tags,
+        },
+        # Not in ffprobe's output: moov before mdat means it streams without seeking
+        "layout": {
+            "moov_offset": moov.offset,
+            "mdat_offset": mdat.offset if mdat else None,
+            "faststart": mdat is None or moov.offset < mdat.offset,
+        },
+        "parser": "mp4",
+    }
+
+
+def probe_mp4(path: Path | str) -> dict | None:
+    """ffprobe-like output read straight from the boxes, None if it can't be parsed"""
+    try:
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return parse_mp4(buf, len(buf))
+    except (OSError, ValueError, IndexError, struct.error, Mp4ParseError):
+        return None
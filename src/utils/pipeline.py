@@ -0,0 +1,454 @@
+import asyncio
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import threading
+from typing import Any, Callable, Iterator, Protocol
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select
+
+from src.catalog import catalog
+from src.config import INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_QUEUE_SIZE
+from src.data_store import bulk_insert, bulk_upsert
+from src.models import (
+    VideoFingerprint,
+    VideoProbe,
+    VideosDataBase,
+    delete_thumbnails,
+    thumbnail_key,
+)
+from src.utils.columns import video_columns
+from src.utils.discovery import ScanErrorHandler
+from src.utils.fingerprints import (
+    KnownFile,
+    Reconciler,
+    fetch_entries,
+    move_entry,
+    refresh_entry,
+)
+from src.utils.hashing import partial_hash
+from src.utils.media_cache import (
+    CacheHit,
+    MediaCache,
+    MediaKey,
+    copy_as_new_thumbnails,
+    media_cache,
+)
+from src.utils.remux import FaststartRemuxer, faststart_remuxer, needs_faststart
+from src.utils.thumbnail_store import thumbnail_store
+from src.utils.video_processing import build_video_model, read_video_probe
+
+# Tells a stage's workers that nothing else is coming
+STOP = None
+
+videos_table = VideosDataBase.__table__  # type: ignore
+probes_table = VideoProbe.__table__  # type: ignore
+fingerprints_table = VideoFingerprint.__table__  # type: ignore
+
+
+class IngestReporter(Protocol):
+    """Progress sink of the pipeline, `discover` is reported from the walker thread"""
+
+    def queued(self, phase: str, count: int = 1): ...
+
+    def done(self, phase: str, count: int = 1): ...
+
+    def log(self, *objects: Any): ...
+
+
+class FanoutReporter:
+    def __init__(self, *reporters: IngestReporter):
+        self.reporters = reporters
+
+    def queued(self, phase: str, count: int = 1):
+        for reporter in self.reporters:
+            reporter.queued(phase, count)
+
+    def done(self, phase: str, count: int = 1):
+        for reporter in self.reporters:
+            reporter.done(phase, count)
+
+    def log(self, *objects: Any):
+        for reporter in self.reporters:
+            reporter.log(*objects)
+
+
+@dataclass
+class IngestItem:
+    path: Path
+    stat: os.stat_result
+    # Row to refresh, None for new files
+    video_id: str | None = None
+    probe: dict | None = None
+    video: VideosDataBase | None = None
+    # Content key in the media cache, and its entry when there was one
+    key: MediaKey | None = None
+    cached: CacheHit | None = None
+    # Sampled hash of the content, and an indexed file with the same one
+    # (its thumbnail being in the videos' pack)
+    content_hash: str = ""
+    copy: CacheHit | None = None
+    # The moov atom is after the data, queued for a faststart remux once inserted
+    remux: bool = False
+
+
+def add_modals_to_db(
+    session: Session,
+    modals: list[VideosDataBase],
+    error_callback: Callable[[VideosDataBase, Exception], None],
+) -> int:
+    """executemany inserts of the rows (plus probes & fingerprints) in one transaction"""
+    if not modals:
+        return 0
+
+    try:
+        bulk_insert(session, videos_table, (vid.model_dump() for vid in modals))
+        bulk_upsert(
+            session,
+            probes_table,
+            ({"id": vid.id, "data": vid.probe.data} for vid in modals if vid.probe),
+        )
+        bulk_upsert(
+            session,
+            fingerprints_table,
+            (
+                {**vid.fingerprint.model_dump(), "id": vid.id}
+                for vid in modals
+                if vid.fingerprint
+            ),
+        )
+        session.commit()
+        return len(modals)
+    except Exception:
+        session.rollback()
+
+    # Some row broke the batch, find it the slow way
+    added = 0
+    for vid in modals:
+        try:
+            session.add(vid)
+            session.commit()
+            added += 1
+        except Exception as e:
+            session.rollback()
+            error_callback(vid, e)
+    return added
+
+
+class IngestPipeline:
+    """discover -> probe -> thumbnail -> db, every stage bounded by a queue
+
+    Each queue only holds `queue_size` files, a slow stage makes the ones before it
+    wait, so memory doesn't grow with the library. Finished videos are committed in
+    batches and the catalog is bumped for each one.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        # Walks the files, telling the handler about directories it couldn't scan
+        files: Callable[[ScanErrorHandler], Iterator[os.DirEntry]],
+        known: dict[str, KnownFile],
+        reporter: IngestReporter,
+        *,
+        probe_workers: int = os.cpu_count() or 4,
+        thumb_workers: int = os.cpu_count() or 4,
+        queue_size: int = INGEST_QUEUE_SIZE,
+        batch_size: int = INGEST_BATCH_SIZE,
+        flush_interval: float = INGEST_FLUSH_INTERVAL,
+        cache: MediaCache | None = media_cache,
+        remuxer: FaststartRemuxer | None = faststart_remuxer,
+    ):
+        # Batches are written on worker threads, each opens its own session
+        self.engine = engine
+        self.files = files
+        self.reconciler = Reconciler(known)
+        self.reporter = reporter
+        self.probe_workers = probe_workers
+        self.thumb_workers = thumb_workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache = cache
+        self.remuxer = remuxer
+
+        self.to_probe: asyncio.Queue[IngestItem | None] = asyncio.Queue(queue_size)
+        self.to_thumb: asyncio.Queue[IngestItem | None] = asyncio.Queue(queue_size)
+        self.to_insert: asyncio.Queue[IngestItem | None] = asyncio.Queue(queue_size)
+        self.removed = 0
+        self.moves_applied: set[str] = set()
+        self._stopped = threading.Event()
+
+    async def run(self):
+        async def stage(workers: list, outbox: asyncio.Queue, consumers: int):
+            await asyncio.gather(*workers)
+            for _ in range(consumers):
+                await outbox.put(STOP)
+
+        try:
+            # A failing stage cancels the others instead of leaving them blocked
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(stage([self.discover()], self.to_probe, self.probe_workers))
+                tg.create_task(
+                    stage(
+                        [self.probe() for _ in range(self.probe_workers)],
+                        self.to_thumb,
+                        self.thumb_workers,
+                    )
+                )
+                tg.create_task(
+                    stage(
+                        [self.thumbnail() for _ in range(self.thumb_workers)],
+                        self.to_insert,
+                        1,
+                    )
+                )
+                tg.create_task(self.insert())
+        finally:
+            self._stopped.set()
+
+        await asyncio.to_thread(self.reconcile)
+
+    async def discover(self):
+        loop = asyncio.get_running_loop()
+
+        def put(item: IngestItem) -> bool:
+            future = asyncio.run_coroutine_threadsafe(self.to_probe.put(item), loop)
+            # Blocks the walk while the probes are behind (backpressure)
+            while not self._stopped.is_set():
+                try:
+                    future.result(timeout=0.5)
+                    return True
+                except TimeoutError:
+                    continue
+            future.cancel()
+            return False
+
+        def walk():
+            for file in self.files(self.unreadable):
+                self.reporter.done("discover")
+                found = self.reconciler.classify(file)
+                if found is None:
+                    continue
+
+                path, video_id, st = found
+                self.reporter.queued("probe")
+                if not put(IngestItem(Path(path), st, video_id)):
+                    return
+
+        await asyncio.to_thread(walk)
+
+    def unreadable(self, directory: str, error: OSError):
+        self.reconciler.unscanned.append(directory)
+        self.reporter.log(f"[yellow]Unable to scan {directory}:[/yellow]", error)
+
+    async def probe(self):
+        while (item := await self.to_probe.get()) is not STOP:
+            try:
+                await self.lookup(item)
+                known = item.cached or item.copy
+                item.probe = known.probe if known else None
+                item.probe = item.probe or await read_video_probe(item.path)
+            except Exception as e:
+                self.reporter.log(f"Probe failed: {item.path}", e)
+                continue
+            finally:
+                self.reporter.done("probe")
+
+            self.reporter.queued("thumbnail")
+            await self.to_thumb.put(item)
+
+    async def thumbnail(self):
+        while (item := await self.to_thumb.get()) is not STOP:
+            try:
+                thumbnail = self.restore_thumbnail(item)
+                item.video = await build_video_model(
+                    item.path, item.probe, item.stat, thumbnail
+                )
+                item.video.content_hash = item.content_hash
+            except Exception as e:
+                self.reporter.log(f"Thumbnail failed: {item.path}", e)
+                continue
+            finally:
+                self.reporter.done("thumbnail")
+
+            # The full probe lives on in `video.probe`
+            item.remux = needs_faststart(item.probe)
+            item.probe = None
+            self.reporter.queued("insert")
+            await self.to_insert.put(item)
+
+    async def lookup(self, item: IngestItem):
+        """Hashes the file, fills `item.cached` or `item.copy` if its content is known"""
+        await asyncio.to_thread(self.identify, item)
+
+    def identify(self, item: IngestItem):
+        # Neither the hash nor the lookups ever fail a file, they only save work
+        try:
+            item.content_hash = partial_hash(item.path, item.stat.st_size)
+        except Exception as e:
+            self.reporter.log(f"Unable to hash: {item.path}", e)
+            return
+
+        if self.cache is not None:
+            try:
+                item.key = MediaKey.of(item.content_hash, item.stat)
+                item.cached = self.cache.lookup(item.key)
+            except Exception as e:
+                self.reporter.log(f"Media cache lookup failed: {item.path}", e)
+
+        # A copy has its own mtime, so only its content hash finds the original
+        if item.cached is None:
+            try:
+                item.copy = self.find_copy(item)
+            except Exception as e:
+                self.reporter.log(f"Copy lookup failed: {item.path}", e)
+
+    def find_copy(self, item: IngestItem) -> CacheHit | None:
+        """Probe & thumbnail of an indexed file with the same content"""
+        # A session of its own, on the thread the lookup runs on
+        with Session(self.engine) as session:
+            rows = session.exec(
+                select(VideosDataBase.thumbnail_path, VideoProbe.data)
+                .join(VideoProbe, col(VideoProbe.id) == col(VideosDataBase.id))
+                .where(
+                    VideosDataBase.content_hash == item.content_hash,
+                    VideosDataBase.id != item.video_id,
+                )
+            ).all()
+
+        for thumbnail, data in rows:
+            if thumbnail_store.exists(thumbnail_key(thumbnail)):
+                return CacheHit(VideoProbe(data=data).unpack(), thumbnail_key(thumbnail))
+        return None
+
+    def restore_thumbnail(self, item: IngestItem) -> str | None:
+        try:
+            if self.cache is not None and item.cached is not None:
+                return self.cache.restore_thumbnail(item.cached)
+            if item.copy is not None:
+                return copy_as_new_thumbnails(thumbnail_store, item.copy.thumbnail)
+        except OSError as e:
+            self.reporter.log(f"Known thumbnail unusable: {item.path}", e)
+            item.cached = item.copy = None
+        return None
+
+    def remember(self, batch: list[IngestItem]):
+        entries = [
+            (item.key, item.video, item.cached is not None)
+            for item in batch
+            if item.key and item.video
+        ]
+        if self.cache is None or not entries:
+            return
+
+        try:
+            self.cache.store(entries)
+        except Exception as e:
+            self.reporter.log("Unable to update the media cache:", e)
+
+    async def insert(self):
+        batch: list[IngestItem] = []
+        while True:
+            try:
+                if batch:
+                    item = await asyncio.wait_for(
+                        self.to_insert.get(), timeout=self.flush_interval
+                    )
+                else:
+                    item = await self.to_insert.get()
+            except TimeoutError:
+                await self.flush(batch)
+                batch = []
+                continue
+
+            if item is STOP:
+                break
+
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                await self.flush(batch)
+                batch = []
+
+        await self.flush(batch)
+
+    async def flush(self, batch: list[IngestItem]):
+        if not batch:
+            return
+
+        # Off the event loop, requests are served while the batch is written
+        await asyncio.to_thread(self.write, batch)
+
+        if self.remuxer is not None:
+            self.remuxer.queue(
+                self.engine,
+                (item.video_id or item.video.id for item in batch if item.remux),
+            )
+
+    def write(self, batch: list[IngestItem]):
+        # Its own session on the thread, nothing the event loop owns crosses over
+        with Session(self.engine) as session:
+            # A new file may take the path a moved one left
+            moved = self.apply_moves(session)
+
+            # Files modified in place keep their row (id, title, favourite)
+            refreshed = {item.video_id: item.video for item in batch if item.video_id}
+            entries = fetch_entries(session, refreshed)
+            replaced = [entry.thumbnail_path for entry in entries]
+            for entry in entries:
+                refresh_entry(entry, refreshed[entry.id])
+            session.commit()
+            # Until the commit the rows still pointed at them
+            self.delete_thumbnails(replaced)
+
+            add_modals_to_db(
+                session,
+                [item.video for item in batch if not item.video_id and item.video],
+                lambda v, e: self.reporter.log("Error while inserting to db:", e, v),
+            )
+            self.remember(batch)
+
+            # Read back, a row that broke the batch was never inserted
+            written = [item.video_id or item.video.id for item in batch if item.video]
+            video_columns.refresh(session, [*moved, *written])
+        catalog.bump()
+        self.reporter.done("insert", len(batch))
+
+    def delete_thumbnails(self, thumbnail_paths: list[str]):
+        # The rows are committed already, a thumbnail left behind only wastes space
+        try:
+            delete_thumbnails(thumbnail_paths)
+        except Exception as e:
+            self.reporter.log("Unable to delete old thumbnails:", e)
+
+    def apply_moves(self, session: Session) -> list[str]:
+        # Renamed/moved files keep their probe & thumbnail
+        moved = self.reconciler.moved
+        pending = [video_id for video_id in moved if video_id not in self.moves_applied]
+        for entry in fetch_entries(session, pending):
+            move_entry(entry, *moved[entry.id])
+        self.moves_applied.update(pending)
+        return pending
+
+    def reconcile(self):
+        """Removals, only known once the whole tree was walked"""
+        with Session(self.engine) as session:
+            moved = self.apply_moves(session)
+
+            # Files that are gone, not only missed by the walk
+            removed = fetch_entries(session, self.reconciler.removed())
+            for entry in removed:
+                self.reporter.log(
+                    f"[red bold]File Removed: {Path(entry.video_path).stem} [!Exist][/bold red]"
+                )
+                session.delete(entry)
+
+            self.removed = len(removed)
+            removed_ids = [entry.id for entry in removed]
+            thumbnails = [entry.thumbnail_path for entry in removed]
+            session.commit()
+            self.delete_thumbnails(thumbnails)
+
+            video_columns.refresh(session, moved)
+        video_columns.remove(removed_ids)
+        catalog.bump()
@@ -0,0 +1,174 @@
+import asyncio
+from contextlib import asynccontextmanager
+from enum import IntEnum
+import heapq
+import itertools
+import os
+from typing import NamedTuple
+
+from src.config import (
+    DECODE_CONCURRENCY,
+    HLS_CONCURRENCY,
+    INTERACTIVE_EXTRA_SLOTS,
+    LOAD_ADAPTIVE,
+    PROBE_CONCURRENCY,
+    REMUX_CONCURRENCY,
+)
+
+
+class Priority(IntEnum):
+    # Lower goes first
+    INTERACTIVE = 0
+    BULK = 1
+
+
+class ProcessTimeout(Exception):
+    pass
+
+
+class ProcessResult(NamedTuple):
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+
+
+def load_factor() -> float:
+    """1.0 until the load average goes above the core count, then cores / load"""
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):  # Not on every platform
+        return 1.0
+
+    cores = os.cpu_count() or 1
+    return cores / load if load > cores else 1.0
+
+
+class Budget:
+    """How many processes of a kind run at once, waiters are served by priority"""
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        *,
+        adaptive: bool = LOAD_ADAPTIVE,
+        extra_slots: int = INTERACTIVE_EXTRA_SLOTS,
+    ):
+        self.name = name
+        self.limit = limit
+        self.adaptive = adaptive
+        self.extra_slots = extra_slots
+        self.running = 0
+        # (priority, arrival, future) heap, FIFO within a priority
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+
+    def capacity(self, priority: Priority) -> int:
+        limit = self.limit
+        if self.adaptive:
+            limit = max(int(limit * load_factor()), 1)
+
+        if priority == Priority.INTERACTIVE:
+            limit += self.extra_slots
+        return limit
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.BULK):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: Priority):
+        # Nobody with the same or a higher priority is waiting, and there's room
+        if (
+            not self._waiters or self._waiters[0][0] > priority
+        ) and self.running < self.capacity(priority):
+            self.running += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (int(priority), next(self._arrivals), future)
+        heapq.heappush(self._waiters, waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before the cancel
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self):
+        self.running -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.running >= self.capacity(Priority(priority)):
+                break
+
+            heapq.heappop(self._waiters)
+            self.running += 1
+            future.set_result(None)
+
+
+class ProcessScheduler:
+    """Every ffprobe/ffmpeg goes through here, each kind with its own budget"""
+
+    def __init__(self):
+        self.budgets = {
+            "probe": Budget("probe", PROBE_CONCURRENCY),
+            "decode": Budget("decode", DECODE_CONCURRENCY),
+            # Disk bound, the load average says nothing about room for more
+            "remux": Budget("remux", REMUX_CONCURRENCY, adaptive=False),
+            # Every segmenter has a viewer waiting, extra slots would only raise the cap
+            "hls": Budget("hls", HLS_CONCURRENCY, extra_slots=0),
+        }
+
+    async def run(
+        self,
+        budget: str,
+        cmd: list,
+        *,
+        priority: Priority = Priority.BULK,
+        timeout: float | None = None,
+        capture: bool = True,
+    ) -> ProcessResult:
+        """Runs `cmd` once `budget` has room, the process is killed on timeout/cancel"""
+        output = asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL
+
+        async with self.budgets[budget].slot(priority):
+            process = await asyncio.create_subprocess_exec(
+                *map(str, cmd), stdout=output, stderr=output
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except TimeoutError:
+                await kill(process)
+                raise ProcessTimeout(f"{cmd[0]} took more than {timeout}s")
+            except asyncio.CancelledError:
+                await kill(process)
+                raise
+
+        return ProcessResult(process.returncode or 0, stdout or b"", stderr or b"")
+
+
+async def kill(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    # Reap it, no zombies
+    await asyncio.shield(process.wait())
+
+
+scheduler = ProcessScheduler()
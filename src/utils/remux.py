@@ -0,0 +1,151 @@
+import asyncio
+import os
+from pathlib import Path
+import shutil
+from typing import Iterable
+
+from rich.console import Console
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from src.catalog import catalog
+from src.config import FASTSTART_REMUX, REMUX_MIN_FREE_SPACE
+from src.models import VideoProbe, VideosDataBase
+from src.utils.columns import video_columns
+from src.utils.hashing import partial_hash
+from src.utils.media_cache import MediaKey, media_cache
+from src.utils.mp4 import probe_mp4
+from src.utils.video_processing import remux_faststart
+
+console = Console()
+
+# Outcomes kept in `VideosDataBase.remux`, a file with either is left alone
+REMUXED, FAILED = "done", "failed"
+
+
+def needs_faststart(probe: dict | None) -> bool:
+    """Only probes read from the boxes know where the moov is"""
+    layout = (probe or {}).get("layout")
+    return layout is not None and not layout["faststart"]
+
+
+def same_file(a: os.stat_result, b: os.stat_result) -> bool:
+    return (a.st_ino, a.st_size, a.st_mtime_ns) == (b.st_ino, b.st_size, b.st_mtime_ns)
+
+
+class FaststartRemuxer:
+    """Rewrites MP4s with the moov atom up front, in the background, one file each
+
+    The copy is written next to the video and swapped in with a rename, keeping
+    the mtime. The row's size, fingerprint & probe follow the new file, so the
+    next reload sees it as unchanged.
+    """
+
+    def __init__(self, min_free: int = REMUX_MIN_FREE_SPACE):
+        self.min_free = min_free
+        self._jobs: dict[str, asyncio.Task] = {}
+
+    def queue(self, engine: Engine, video_ids: Iterable[str]):
+        # The "remux" process budget decides how many run at once
+        for video_id in video_ids:
+            if video_id in self._jobs:
+                continue
+            task = asyncio.create_task(self.remux(engine, video_id))
+            task.add_done_callback(lambda _, key=video_id: self._jobs.pop(key, None))
+            self._jobs[video_id] = task
+
+    def has_room(self, path: Path, size: int) -> bool:
+        return shutil.disk_usage(path.parent).free >= size + self.min_free
+
+    async def remux(self, engine: Engine, video_id: str):
+        path = await asyncio.to_thread(self.pending, engine, video_id)
+        if path is None:
+            return
+
+        try:
+            before = path.stat()
+            if not self.has_room(path, before.st_size):
+                # Not recorded, the next reload queues it again
+                console.print(f"[yellow]Not enough disk space to remux: {path}[/yellow]")
+                return
+        except OSError:
+            return
+
+        tmp = path.with_name(f".{path.name}.faststart")
+        try:
+            layout = None
+            if await remux_faststart(path, tmp):
+                probe = await asyncio.to_thread(probe_mp4, tmp)
+                layout = probe and probe["layout"]
+            if not (layout and layout["faststart"]):
+                tmp.unlink(missing_ok=True)
+                await asyncio.to_thread(self.record, engine, video_id, FAILED)
+                return
+
+            if not same_file(before, path.stat()):
+                # Changed while it was copied, ingest takes it from here
+                tmp.unlink(missing_ok=True)
+                return
+            os.utime(tmp, ns=(before.st_atime_ns, before.st_mtime_ns))
+            os.replace(tmp, path)
+        except asyncio.CancelledError:
+            tmp.unlink(missing_ok=True)
+            raise
+        except Exception as e:
+            tmp.unlink(missing_ok=True)
+            console.print(f"[red]Faststart remux failed: {path}[/red]", e)
+            # Or every reload would try it again
+            await asyncio.to_thread(self.record, engine, video_id, FAILED)
+            return
+
+        await asyncio.to_thread(self.swapped, engine, video_id, path, layout)
+        catalog.bump()
+
+    def pending(self, engine: Engine, video_id: str) -> Path | None:
+        """The video's path, unless it's gone or was remuxed (or tried) already"""
+        with Session(engine) as session:
+            video = session.get(VideosDataBase, video_id)
+            if video is None or video.remux:
+                return None
+            return Path(video.video_path)
+
+    def record(self, engine: Engine, video_id: str, outcome: str):
+        with Session(engine) as session:
+            if video := session.get(VideosDataBase, video_id):
+                video.remux = outcome
+                session.commit()
+
+    def swapped(self, engine: Engine, video_id: str, path: Path, layout: dict):
+        st = path.stat()
+        with Session(engine) as session:
+            video = session.get(VideosDataBase, video_id)
+            if video is None:
+                return
+
+            video.remux = REMUXED
+            video.filesize = st.st_size
+            # Other copies keep the old layout, this one is no longer the same bytes
+            video.content_hash = partial_hash(path, st.st_size)
+            if video.fingerprint:
+                video.fingerprint.update(str(path), st)
+            if video.probe:
+                probe = video.probe.unpack()
+                probe["layout"] = layout
+                probe.setdefault("format", {})["size"] = str(st.st_size)
+                video.probe.data = VideoProbe.pack(probe).data
+            session.commit()
+            video_columns.refresh(session, [video_id])
+
+            # The cache knows the old content, a hard reload shouldn't probe this again
+            try:
+                media_cache.store([(MediaKey.of(video.content_hash, st), video, False)])
+            except Exception as e:
+                console.print("Unable to update the media cache:", e)
+
+    async def shutdown(self):
+        for task in list(self._jobs.values()):
+            task.cancel()
+        await asyncio.gather(*self._jobs.values(), return_exceptions=True)
+
+
+faststart_remuxer = FaststartRemuxer() if FASTSTART_REMUX else None
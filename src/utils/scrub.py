@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import math
+import os
+from pathlib import Path
+import re
+
+from rich.console import Console
+
+from src.config import (
+    PERFORMANCE,
+    SCRUB_COLUMNS,
+    SCRUB_DIR,
+    SCRUB_DISK_BUDGET,
+    SCRUB_INTERVAL,
+    SCRUB_MAX_FRAMES,
+    SCRUB_TILE_SIZE,
+)
+from src.models import VideosDataBase
+from src.utils.video_processing import generate_scrub_sheet
+
+console = Console()
+
+SHEET_SUFFIX = PERFORMANCE and ".webp" or ".jpg"
+FILE_PATTERN = re.compile(r"[0-9a-f]{32}\.(vtt|webp|jpg)")
+
+
+def scrub_layout(duration: float) -> tuple[float, int]:
+    """(seconds between frames, frames), long videos get a longer interval"""
+    frames = max(math.ceil(duration / SCRUB_INTERVAL), 1)
+    if frames <= SCRUB_MAX_FRAMES:
+        return SCRUB_INTERVAL, frames
+    return duration / SCRUB_MAX_FRAMES, SCRUB_MAX_FRAMES
+
+
+def vtt_timestamp(seconds: float) -> str:
+    millis = round(seconds * 1000)
+    hours, millis = divmod(millis, 3_600_000)
+    minutes, millis = divmod(millis, 60_000)
+    return f"{hours:02}:{minutes:02}:{millis // 1000:02}.{millis % 1000:03}"
+
+
+def scrub_vtt(sheet_url: str, duration: float, interval: float, frames: int) -> str:
+    """WebVTT thumbnails track, every cue is a tile of the sheet (#xywh=...)"""
+    width, height = SCRUB_TILE_SIZE
+    columns = min(frames, SCRUB_COLUMNS)
+    cues = ["WEBVTT", ""]
+    for i in range(frames):
+        start, end = i * interval, min((i + 1) * interval, duration)
+        if start >= duration:
+            break
+        x, y = (i % columns) * width, (i // columns) * height
+        cues += [
+            f"{vtt_timestamp(start)} --> {vtt_timestamp(end)}",
+            f"{sheet_url}#xywh={x},{y},{width},{height}",
+            "",
+        ]
+    return "\n".join(cues)
+
+
+class ScrubPreviews:
+    """Scrub sheets & their WebVTT tracks, made in the background on first watch
+
+    Files are keyed by what the video looked like on disk (and the layout
+    settings), so a changed file gets a new sheet and the old one ages out of
+    the disk budget.
+    """
+
+    def __init__(self, root: Path = SCRUB_DIR, budget: int = SCRUB_DISK_BUDGET):
+        self.root = root
+        self.budget = budget
+        self._jobs: dict[str, asyncio.Task] = {}
+        # Keys ffmpeg couldn't make a sheet for, not retried until a restart
+        self.failed: set[str] = set()
+
+    @staticmethod
+    def key(video: VideosDataBase) -> str:
+        parts = (
+            video.id,
+            video.video_path,
+            video.filesize,
+            video.modified_time,
+            SCRUB_INTERVAL,
+            SCRUB_MAX_FRAMES,
+            SCRUB_TILE_SIZE,
+            SCRUB_COLUMNS,
+        )
+        raw = ":".join(map(str, parts)).encode()
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def sheet_path(self, key: str) -> Path:
+        return self.root / f"{key}{SHEET_SUFFIX}"
+
+    def vtt_path(self, key: str) -> Path:
+        return self.root / f"{key}.vtt"
+
+    def status(self, video: VideosDataBase) -> dict:
+        """Where the track is, the sheet is queued on the first call"""
+        key = self.key(video)
+        vtt = self.vtt_path(key)
+        if vtt.exists():
+            # mtime doubles as the last time it was watched, for the budget
+            for path in (vtt, self.sheet_path(key)):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            return {"state": "ready", "vtt": f"/api/scrub/files/{vtt.name}"}
+
+        if key in self.failed or video.duration <= 0:
+            return {"state": "failed"}
+
+        if key not in self._jobs:
+            task = asyncio.create_task(
+                self.generate(key, video.video_path, video.duration)
+            )
+            task.add_done_callback(lambda _: self._jobs.pop(key, None))
+            self._jobs[key] = task
+        return {"state": "pending"}
+
+    async def generate(self, key: str, video_path: str, duration: float):
+        self.root.mkdir(parents=True, exist_ok=True)
+        interval, frames = scrub_layout(duration)
+        sheet = self.sheet_path(key)
+        tmp = sheet.with_name(f"{key}.tmp{SHEET_SUFFIX}")
+        try:
+            if not await generate_scrub_sheet(video_path, tmp, interval, frames):
+                self.failed.add(key)
+                return
+
+            os.replace(tmp, sheet)
+            vtt = scrub_vtt(
+                f"/api/scrub/files/{sheet.name}", duration, interval, frames
+            )
+            # The track last, its presence means the sheet is there
+            self.vtt_path(key).write_text(vtt)
+        except Exception as e:
+            self.failed.add(key)
+            tmp.unlink(missing_ok=True)
+            console.print(f"[red]Scrub preview failed: {video_path}[/red]", e)
+            return
+
+        await asyncio.to_thread(self.enforce_budget, keep=key)
+
+    def enforce_budget(self, keep: str | None = None):
+        """Drops the least recently watched sheets until they fit the budget"""
+        sheets = {}
+        for path in self.root.iterdir():
+            key = path.name.split(".", 1)[0]
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            size, mtime = sheets.get(key, (0, 0.0))
+            sheets[key] = (size + st.st_size, max(mtime, st.st_mtime))
+
+        used = sum(size for size, _ in sheets.values())
+        for key, (size, _) in sorted(sheets.items(), key=lambda item: item[1][1]):
+            if used <= self.budget:
+                break
+            if key == keep or key in self._jobs:
+                continue
+
+            self.vtt_path(key).unlink(missing_ok=True)
+            self.sheet_path(key).unlink(missing_ok=True)
+            used -= size
+
+    async def shutdown(self):
+        for task in list(self._jobs.values()):
+            task.cancel()
+        await asyncio.gather(*self._jobs.values(), return_exceptions=True)
+
+
+scrub_previews = ScrubPreviews()
@@ -0,0 +1,39 @@
+import re
+
+from sqlalchemy import text
+from sqlmodel import Session
+
+from src.models import VideosDataBase
+
+DEFAULT_SEARCH_LIMIT = 30
+MAX_SEARCH_LIMIT = 200
+
+FTS_TABLE = f"{VideosDataBase.__tablename__}_fts"
+
+
+def fts_query(search: str) -> str | None:
+    """"my vid" -> '"my"* "vid"*' (every word has to match, as a prefix)"""
+    # Same separators as the unicode61 tokenizer, so quoting never breaks a word
+    words = [word for word in re.split(r"[\W_]+", search) if word]
+    if not words:
+        return None
+
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_ids(session: Session, search: str, limit: int) -> list[str]:
+    """Ids of the best matches, best first"""
+    match = fts_query(search)
+    if not match:
+        return []
+
+    # bm25: lower is better, title matches on fewer/shorter words rank first
+    rows = session.execute(
+        text(
+            f"""SELECT v.id FROM {FTS_TABLE}
+            JOIN {VideosDataBase.__tablename__} AS v ON v.rowid = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH :match
+            ORDER BY bm25({FTS_TABLE}) LIMIT :limit"""
+        ).bindparams(match=match, limit=limit)
+    ).all()
+    return [row[0] for row in rows]
@@ -0,0 +1,275 @@
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+from typing import BinaryIO, Iterable, Iterator, NamedTuple
+import zlib
+
+from src.config import THUMB_PACK_COMPACT_RATIO, THUMB_STORE_DIR
+
+MAGIC = b"THP1"
+# magic, kind, name length, data length, crc32 of the data
+HEADER = struct.Struct(">4sBHII")
+DELETE, PUT = 0, 1
+
+# Thumbnails copied per write while compacting
+COMPACT_BATCH = 256
+
+
+class Entry(NamedTuple):
+    offset: int  # of the data
+    length: int
+
+
+class Record(NamedTuple):
+    offset: int  # of the header
+    end: int
+    kind: int
+    name: str
+    entry: Entry
+
+
+def encode_record(kind: int, name: str, data: bytes = b"") -> bytes:
+    raw_name = name.encode()
+    header = HEADER.pack(MAGIC, kind, len(raw_name), len(data), zlib.crc32(data))
+    return header + raw_name + data
+
+
+def iter_records(buf, start: int, end: int) -> Iterator[Record]:
+    """Stops at the first record that isn't whole (a write cut short by a crash)"""
+    offset = start
+    while offset + HEADER.size <= end:
+        magic, kind, name_length, length, _ = HEADER.unpack_from(buf, offset)
+        data = offset + HEADER.size + name_length
+        if magic != MAGIC or data + length > end:
+            return
+
+        name = bytes(buf[offset + HEADER.size : data]).decode()
+        yield Record(offset, data + length, kind, name, Entry(data, length))
+        offset = data + length
+
+
+def is_intact(buf, record: Record) -> bool:
+    crc = HEADER.unpack_from(buf, record.offset)[4]
+    data = record.entry
+    return zlib.crc32(buf[data.offset : data.offset + data.length]) == crc
+
+
+class ThumbnailPack:
+    """Thumbnails appended to a single file, with an in-memory index of their offsets
+
+    Replacing or deleting one only appends (deletes are tombstones), `compact`
+    rewrites the file with the live ones once enough of it is dead. Reads are
+    views of an mmap of the file, nothing is copied.
+    """
+
+    def __init__(self, root: Path = THUMB_STORE_DIR, name: str = "thumbnails.pack"):
+        self.root = root
+        self.path = root / name
+        self.index: dict[str, Entry] = {}
+        self.size = 0
+        self.live = 0  # bytes of the records in `index`
+        self._file: BinaryIO | None = None
+        self._map: mmap.mmap | None = None
+        self._lock = threading.RLock()
+
+    def _open(self) -> BinaryIO:
+        # Opened (and indexed) on first use
+        if self._file is None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a+b")
+            self._load()
+        return self._file
+
+    def open(self):
+        """Indexes the pack now instead of on first use"""
+        with self._lock:
+            self._open()
+
+    def _load(self):
+        file = self._file
+        size = os.fstat(file.fileno()).st_size
+        self.index, self.size, self.live = {}, 0, 0
+        if size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                records = []
+                # Appends aren't fsynced, after a crash any record may hold garbage
+                # (pages reach the disk out of order), not only the last one
+                for record in iter_records(buf, 0, size):
+                    if not is_intact(buf, record):
+                        break
+                    records.append(record)
+            for record in records:
+                self._apply(record)
+        if self.size < size:
+            file.truncate(self.size)  # Drop everything from the first bad record
+
+    def _apply(self, record: Record):
+        if old := self.index.pop(record.name, None):
+            self.live -= self._record_size(record.name, old)
+        if record.kind == PUT:
+            self.index[record.name] = record.entry
+            self.live += record.end - record.offset
+        self.size = record.end
+
+    @staticmethod
+    def _record_size(name: str, entry: Entry) -> int:
+        return HEADER.size + len(name.encode()) + entry.length
+
+    def _append(self, records: list[tuple[int, str, bytes]]):
+        file = self._open()
+        written, chunks, offset = [], [], self.size
+        for kind, name, data in records:
+            raw = encode_record(kind, name, data)
+            written.append(
+                Record(
+                    offset,
+                    offset + len(raw),
+                    kind,
+                    name,
+                    Entry(offset + len(raw) - len(data), len(data)),
+                )
+            )
+            chunks.append(raw)
+            offset += len(raw)
+
+        try:
+            file.write(b"".join(chunks))
+            file.flush()
+        except OSError:
+            self._drop_tail()
+            raise
+
+        # Indexed only once they're in the file
+        for record in written:
+            self._apply(record)
+
+    def _drop_tail(self):
+        """Cuts what a failed write (ENOSPC, EIO) left after `size` off the file"""
+        try:
+            self._file.close()
+        except OSError:
+            pass  # Its buffer couldn't be flushed either, closing dropped it
+
+        try:
+            os.truncate(self.path, self.size)
+            self._file = open(self.path, "a+b")
+        except OSError:
+            # Re-indexed from the file on the next use, torn tail and all
+            self._file = None
+
+    def put_many(self, items: dict[str, bytes]):
+        with self._lock:
+            self._append([(PUT, name, data) for name, data in items.items()])
+
+    def put(self, name: str, data: bytes):
+        self.put_many({name: data})
+
+    def delete_many(self, names: Iterable[str]):
+        with self._lock:
+            self._open()
+            self._append([(DELETE, name, b"") for name in names if name in self.index])
+
+    def exists(self, name: str) -> bool:
+        with self._lock:
+            self._open()
+            return name in self.index
+
+    def read(self, name: str) -> memoryview | None:
+        with self._lock:
+            self._open()
+            entry = self.index.get(name)
+            if entry is None:
+                return None
+
+            if self._map is None or len(self._map) < entry.offset + entry.length:
+                # Views handed out keep the old map alive until they're released
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._map)[entry.offset : entry.offset + entry.length]
+
+    def adopt(self, files: Iterable[tuple[str, Path]]) -> int:
+        """Moves loose thumbnail files into the pack (name, path), returns how many"""
+        adopted = 0
+        for name, path in files:
+            try:
+                data = path.read_bytes()
+            except OSError:
+                continue
+            self.put(name, data)
+            path.unlink(missing_ok=True)
+            adopted += 1
+        return adopted
+
+    def clear(self):
+        """Drops every thumbnail at once (a single unlink)"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file, self._map = None, None
+            self.path.unlink(missing_ok=True)
+            self.index, self.size, self.live = {}, 0, 0
+
+    def compact(self, ratio: float = THUMB_PACK_COMPACT_RATIO) -> int:
+        """Rewrites the pack without the dead records once they're `ratio` of it,
+        returns the bytes reclaimed. Reads & writes go on while it copies."""
+        with self._lock:
+            file = self._open()
+            if not self.size or (self.size - self.live) / self.size < ratio:
+                return 0
+            copied, index = self.size, list(self.index.items())
+            # Mapped while the file is surely open, the map outlives a close
+            buf = mmap.mmap(file.fileno(), copied, access=mmap.ACCESS_READ)
+
+        tmp = self.path.with_name(self.path.name + ".compact")
+        tmp.unlink(missing_ok=True)
+        compacted = ThumbnailPack(self.root, tmp.name)
+        compacted._open()
+        with buf:
+            for start in range(0, len(index), COMPACT_BATCH):
+                compacted.put_many(
+                    {
+                        name: buf[entry.offset : entry.offset + entry.length]
+                        for name, entry in index[start : start + COMPACT_BATCH]
+                    }
+                )
+
+        with self._lock:
+            # A failed append (`_drop_tail`) or `clear` replaced the file meanwhile,
+            # what was copied may no longer be what the pack holds
+            if self._file is not file:
+                compacted._file.close()
+                tmp.unlink(missing_ok=True)
+                return 0
+
+            # Whatever was appended meanwhile goes over as is
+            if self.size > copied:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    tail = buf[copied : self.size]
+                base = compacted.size
+                compacted._file.write(tail)
+                for record in iter_records(tail, 0, len(tail)):
+                    compacted._apply(
+                        Record(
+                            base + record.offset,
+                            base + record.end,
+                            record.kind,
+                            record.name,
+                            Entry(base + record.entry.offset, record.entry.length),
+                        )
+                    )
+
+            compacted._file.flush()
+            os.fsync(compacted._file.fileno())
+            os.replace(tmp, self.path)
+
+            reclaimed = self.size - compacted.size
+            file.close()
+            # Views of the old map stay valid, the old file lives on until they go
+            self._file, self._map = compacted._file, None
+            self.index = compacted.index
+            self.size, self.live = compacted.size, compacted.live
+            return reclaimed
+
+
+thumbnail_store = ThumbnailPack()
@@ -2,12 +2,49 @@ import asyncio
 from collections.abc import Mapping
 from hashlib import sha512
 import json
+import math
+import os
 from pathlib import Path
+import tempfile
 from typing import Optional
 from uuid import uuid4
 
-from src.config import PERFORMANCE, THUMB_DIR
-from src.models import VideosDataBase
+from src.config import (
+    DEFAULT_THUMBNAIL_SIZE,
+    FAST_MP4_PROBE,
+    HLS_COPY_CODECS,
+    HLS_SEGMENT_SECONDS,
+    PERFORMANCE,
+    PROBE_TIMEOUT,
+    SCRUB_COLUMNS,
+    SCRUB_TILE_SIZE,
+    SCRUB_TIMEOUT,
+    THUMBNAIL_CANDIDATES,
+    THUMBNAIL_SCAN_SECONDS,
+    THUMBNAIL_SIZES,
+    THUMBNAIL_TIMEOUT,
+)
+from src.models import (
+    VideoFingerprint,
+    VideoProbe,
+    VideosDataBase,
+    thumbnail_variant,
+)
+from src.utils.mp4 import MP4_SUFFIXES, probe_mp4
+from src.utils.processes import Priority, scheduler
+from src.utils.thumbnail_store import thumbnail_store
+
+
+# Upper pixel-count bound of every quality label, checked in order
+QUALITY_BUCKETS = [
+    ("SD", 640 * 480),
+    ("HD", 1280 * 720),
+    ("FHD", 1920 * 1080),
+    ("QHD", 2560 * 1440),
+    ("4K", 3840 * 2160),
+    ("5K", 5120 * 2880),
+    ("8K", 7680 * 4320),
+]
 
 
 def convert_time(time_float: float) -> str:
@@ -60,16 +97,18 @@ def create_extras(ffprobe: dict) -> dict:
     ]
     #fmt: on
 
-    def pick_attrs(obj: object, *keys: str, default=None) -> dict:
+    def pick_attrs(obj: object, *keys: str) -> dict:
         data = {}
         if isinstance(obj, Mapping):
             get_key = obj.get
         else:
-            get_key = lambda key: getattr(obj, key)
+            get_key = lambda key: getattr(obj, key, None)
 
+        # Missing keys are left out to keep the stored json compact
         for key in keys:
             value = get_key(key)
-            data[key] = default if value is None else value
+            if value is not None:
+                data[key] = value
 
         return data
 
@@ -79,8 +118,8 @@ def create_extras(ffprobe: dict) -> dict:
 
         streams.append({**pick_attrs(stream, *stream_keys), "disposition": disp})
 
-    format = pick_attrs(ffprobe.get("format"), *format_keys)
-    return {"streams": streams, "format": format, **ffprobe}
+    format = pick_attrs(ffprobe.get("format") or {}, *format_keys)
+    return {"streams": streams, "format": format}
 
 
 def is_likely_static_image(stream):
@@ -99,70 +138,328 @@ def is_likely_static_image(stream):
     return False
 
 
+def pick_video_stream(streams: list[dict]) -> dict | None:
+    """Returns the stream that holds the actual video (skips cover arts)"""
+    for stream in streams:
+        if stream.get("codec_type", "video") != "video":
+            continue
+        if not is_likely_static_image(stream):
+            return stream
+
+    return streams[0] if streams else None
+
+
+def classify_dimensions(width: int, height: int) -> tuple[str, str]:
+    """1920x1080 -> ("FHD", "16:9")"""
+    if width <= 0 or height <= 0:
+        return "SD", ""
+
+    pixels = width * height
+    quality = next(
+        (label for label, limit in QUALITY_BUCKETS if pixels <= limit), "UHD+"
+    )
+
+    ratio = width / height
+    orientation = "1:1"
+    if abs(ratio - 16 / 9) < 0.02:
+        orientation = "16:9"
+    elif abs(ratio - 9 / 16) < 0.02:
+        orientation = "9:16"
+
+    return quality, orientation
+
+
+def parse_frame_rate(rate: str | None) -> float:
+    """30000/1001 -> 29.97"""
+    try:
+        num, _, den = str(rate or "0").partition("/")
+        return round(float(num) / float(den or 1), 3)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def parse_rotation(stream: dict) -> int:
+    """Rotation from the `rotate` tag (old ffmpeg) or the display matrix"""
+    rotation = (stream.get("tags") or {}).get("rotate")
+    for side_data in stream.get("side_data_list") or []:
+        if "rotation" in side_data:
+            rotation = side_data["rotation"]
+
+    try:
+        return int(float(rotation or 0)) % 360
+    except ValueError:
+        return 0
+
+
+def apply_probe(video: VideosDataBase, ffprobe: dict):
+    """Fills the typed metadata columns, compact extras and full probe of `video`"""
+    stream = pick_video_stream(ffprobe.get("streams") or []) or {}
+    format_info = ffprobe.get("format") or {}
+
+    video.rotation = parse_rotation(stream)
+    width, height = int(stream.get("width") or 0), int(stream.get("height") or 0)
+    if video.rotation in (90, 270):
+        # Store what the viewer actually sees
+        width, height = height, width
+
+    video.width, video.height = width, height
+    video.quality, video.orientation = classify_dimensions(width, height)
+    video.codec = stream.get("codec_name") or ""
+    video.bit_rate = int(stream.get("bit_rate") or format_info.get("bit_rate") or 0)
+    video.frame_rate = parse_frame_rate(
+        stream.get("avg_frame_rate") or stream.get("r_frame_rate")
+    )
+
+    # Keep the edit history ("update_*") that lives alongside the probe summary
+    history = {
+        key: value
+        for key, value in (video.extras or {}).items()
+        if str(key).startswith("update_")
+    }
+    video.extras = {**create_extras(ffprobe), **history}
+    video.probe = VideoProbe.pack(ffprobe)
+
+
+def thumbnail_filters(source: str, outputs: dict[str, Path], skip_black: bool) -> str:
+    """One decoded frame -> every size, e.g. [0:v:0]...split=3[s0][s1][s2];[s0]scale=..."""
+    chain = []
+    if skip_black:
+        # pblack: % of (nearly) black pixels, frames that are mostly black are dropped
+        chain.append(
+            "blackframe=amount=0,"
+            "metadata=mode=select:key=lavfi.blackframe.pblack:value=90:function=less"
+        )
+        # Most representative of the remaining candidates (no flashes/fades)
+        chain.append(f"thumbnail={THUMBNAIL_CANDIDATES}")
+
+    labels = "".join(f"[s{i}]" for i in range(len(outputs)))
+    chain.append(f"split={len(outputs)}{labels}")
+    graph = [f"{source}{','.join(chain)}"]
+
+    for i, size in enumerate(outputs):
+        width = THUMBNAIL_SIZES[size]
+        # Never upscales, -2 keeps the height even (and the aspect ratio)
+        graph.append(f"[s{i}]scale=w='min({width},iw)':h=-2[o{i}]")
+
+    return ";".join(graph)
+
+
 async def generate_thumbnail(
     vid_path: str | Path,
     stream_idx: int,
     vid_duration: str | float,
-    root_path: Path | str | None = None,
     file_name_prefix: str = "thumbnail_",
-) -> Optional[Path]:
-    """Generates a thumbnail from vid_path, fully resolves the vid_path and returns a fully resolved Path on success"""
+    priority: Priority = Priority.BULK,
+) -> Optional[str]:
+    """Generates every `THUMBNAIL_SIZES` thumbnail from a single decode of vid_path
+    into the thumbnail store, returns the name of the default size on success"""
     vid_path = Path(vid_path).expanduser().resolve()
-    root_path = Path(root_path or THUMB_DIR or Path.cwd()).expanduser().resolve()
-    root_path.mkdir(parents=True, exist_ok=True)
 
     # Add .webp for faster loading (client side) & less storage
-    output_path = root_path / (
-        file_name_prefix + uuid4().hex + (PERFORMANCE and ".webp" or ".png")
-    )
-
-    # Prepare the command base
-    cmd: list = ["ffmpeg", "-hide_banner", "-y"]
+    name = file_name_prefix + uuid4().hex + (PERFORMANCE and ".webp" or ".png")
+
+    async def run(skip_black: bool, workdir: Path) -> dict[str, bytes] | None:
+        outputs = {
+            size: workdir / thumbnail_variant(name, size) for size in THUMBNAIL_SIZES
+        }
+        cmd: list = ["ffmpeg", "-hide_banner", "-y"]
+
+        if stream_idx < -1:
+            source = "[0:v:0]"
+            cmd.extend(
+                [
+                    # Only keyframes are decoded, they're all a thumbnail needs
+                    "-skip_frame",
+                    "nokey",
+                    # Fast seek before input
+                    "-ss",
+                    float(vid_duration or 0) / 2,
+                    "-t",
+                    THUMBNAIL_SCAN_SECONDS,
+                    "-i",
+                    vid_path,
+                ]
+            )
+        else:
+            # Stream index selection (cover art) — no midpoint
+            source = f"[0:{stream_idx}]"
+            cmd.extend(["-i", vid_path])
 
-    if stream_idx < -1:
-        # Fast seek before input
-        midpoint = float(vid_duration) / 2
         cmd.extend(
-            [
-                "-ss",
-                midpoint,
-                "-t",
-                "1",  # Optional: only decode 1s
-                "-i",
-                vid_path,
-                "-frames:v",
-                "1",
-            ]
+            ["-filter_complex", thumbnail_filters(source, outputs, skip_black)]
         )
-    else:
-        # Stream index selection — no midpoint
-        cmd.extend(
-            [
-                "-i",
-                vid_path,
-                "-map",
-                f"0:{stream_idx}",
-            ]
+        for i, path in enumerate(outputs.values()):
+            cmd.extend(["-map", f"[o{i}]", "-frames:v", "1", path])
+
+        # Run the command (decodes share one budget)
+        await scheduler.run(
+            "decode",
+            cmd,
+            priority=priority,
+            timeout=THUMBNAIL_TIMEOUT,
+            capture=False,
         )
+        if not outputs[DEFAULT_THUMBNAIL_SIZE].exists():
+            return None
+        return {
+            path.name: path.read_bytes()
+            for path in outputs.values()
+            if path.exists()
+        }
 
-    if PERFORMANCE:
-        # Scales the image down to 640 (maintaing ar)
-        cmd.extend(["-vf", "scale=640:-1"])
+    # ffmpeg writes files, they only stay around until they're in the pack
+    with tempfile.TemporaryDirectory(prefix="thumbnail-") as tmp:
+        workdir = Path(tmp)
+        # A video that's black all the way through still gets a (black) thumbnail
+        thumbnails = await run(stream_idx < -1, workdir) or await run(False, workdir)
 
-    # Append output and other to cmd
-    cmd.extend(["-frames:v", "1", output_path])
+    if not thumbnails:
+        return None
 
-    # Run the command
-    process = await asyncio.create_subprocess_exec(
-        *map(str, cmd),
-        stdout=asyncio.subprocess.DEVNULL,
-        stderr=asyncio.subprocess.DEVNULL,
-    )
-    await process.wait()
-    return output_path if output_path.exists() else None
+    await asyncio.to_thread(thumbnail_store.put_many, thumbnails)
+    return name
 
 
-async def probe_video(vid_path: Path | str) -> bytes:
+async def generate_scrub_sheet(
+    vid_path: str | Path,
+    output_path: Path,
+    interval: float,
+    frames: int,
+    priority: Priority = Priority.BULK,
+) -> bool:
+    """Tiles a frame every `interval` seconds (keyframes only) into one image"""
+    columns = min(frames, SCRUB_COLUMNS)
+    rows = math.ceil(frames / columns)
+    width, height = SCRUB_TILE_SIZE
+    filters = [
+        f"fps=1/{interval}",
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease",
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+        f"tile={columns}x{rows}",
+    ]
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-y",
+        "-skip_frame",
+        "nokey",
+        "-i",
+        Path(vid_path).expanduser().resolve(),
+        "-an",
+        "-sn",
+        "-vf",
+        ",".join(filters),
+        "-frames:v",
+        "1",
+        output_path,
+    ]
+    try:
+        await scheduler.run(
+            "decode", cmd, priority=priority, timeout=SCRUB_TIMEOUT, capture=False
+        )
+    except BaseException:
+        output_path.unlink(missing_ok=True)
+        raise
+    return output_path.exists()
+
+
+async def remux_faststart(
+    vid_path: str | Path, output_path: Path, priority: Priority = Priority.BULK
+) -> bool:
+    """Copies every stream into a new MP4 with the moov atom before the data"""
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-y",
+        "-i",
+        Path(vid_path).expanduser().resolve(),
+        "-map",
+        "0",
+        "-dn",
+        "-c",
+        "copy",
+        "-map_metadata",
+        "0",
+        "-movflags",
+        "+faststart",
+        "-f",
+        "mp4",
+        output_path,
+    ]
+    try:
+        result = await scheduler.run("remux", cmd, priority=priority, capture=False)
+    except BaseException:
+        output_path.unlink(missing_ok=True)
+        raise
+    return result.returncode == 0 and output_path.exists()
+
+
+async def segment_hls(
+    vid_path: str | Path,
+    output_dir: Path,
+    codec: str,
+    priority: Priority = Priority.INTERACTIVE,
+) -> bool:
+    """Cuts the video into fMP4 HLS segments, index.m3u8 grows as they're written
+
+    The video stream is copied when its codec allows, else it's re-encoded. The
+    `priority` only orders the wait for a slot (a viewer waits on the first segment).
+    """
+    if codec in HLS_COPY_CODECS:
+        video = ["-c:v", "copy"]
+        if codec == "hevc":
+            video += ["-tag:v", "hvc1"]  # What Safari wants for HEVC
+    else:
+        video = [
+            "-c:v",
+            "libx264",
+            "-preset",
+            "veryfast",
+            "-pix_fmt",
+            "yuv420p",
+            "-force_key_frames",
+            f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+        ]
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-y",
+        "-i",
+        Path(vid_path).expanduser().resolve(),
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0?",
+        "-sn",
+        "-dn",
+        *video,
+        "-c:a",
+        "aac",
+        "-ac",
+        "2",
+        "-f",
+        "hls",
+        "-hls_time",
+        HLS_SEGMENT_SECONDS,
+        "-hls_playlist_type",
+        "event",
+        "-hls_segment_type",
+        "fmp4",
+        "-hls_fmp4_init_filename",
+        "init.mp4",
+        "-hls_segment_filename",
+        output_dir / "%05d.m4s",
+        "-hls_flags",
+        "independent_segments+temp_file",
+        output_dir / "index.m3u8",
+    ]
+    result = await scheduler.run("hls", cmd, priority=priority, capture=False)
+    return result.returncode == 0
+
+
+async def probe_video(
+    vid_path: Path | str, priority: Priority = Priority.BULK
+) -> bytes:
     """Uses ffprobe to probe the given the video and returns the process output as is"""
     vid_path = Path(vid_path).expanduser().resolve()
 
@@ -181,28 +478,37 @@ async def probe_video(vid_path: Path | str) -> bytes:
         vid_path,
     ]
 
-    proc = await asyncio.create_subprocess_exec(
-        *map(str, format_command),
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
+    result = await scheduler.run(
+        "probe", format_command, priority=priority, timeout=PROBE_TIMEOUT
     )
-    stdout, stderr = await proc.communicate()
 
-    if proc.returncode != 0:
+    if result.returncode != 0:
         raise Exception(f"FFprobe failed on {vid_path}")
 
-    return stdout or stderr or b""
+    return result.stdout or result.stderr or b""
 
 
-async def generate_video_info(
-    sem: asyncio.Semaphore, vid_path: Path | str
-) -> VideosDataBase | None:
+async def read_video_probe(
+    vid_path: Path | str, priority: Priority = Priority.BULK
+) -> dict:
+    # No process to fork for most files, ffprobe handles whatever the parser can't
+    if FAST_MP4_PROBE and Path(vid_path).suffix.lower() in MP4_SUFFIXES:
+        if video_probe := await asyncio.to_thread(probe_mp4, vid_path):
+            return video_probe
 
-    async with sem:
-        probe = await probe_video(vid_path)
+    probe = await probe_video(vid_path, priority)
+    return json.loads(probe.decode(errors="ignore"))
 
+
+async def build_video_model(
+    vid_path: Path | str,
+    video_probe: dict,
+    vid_stat: os.stat_result | None = None,
+    thumb_path: str | None = None,
+) -> VideosDataBase:
+    """Thumbnail (unless given) + row of an already probed file"""
     vid_path = Path(vid_path).expanduser().resolve()
-    video_probe = json.loads(probe.decode(errors="ignore"))
+    vid_stat = vid_stat or vid_path.stat()
     format_info = video_probe.get("format", {})
     duration = int(float(format_info.get("duration", 0)))
     size = int(format_info.get("size", 0))
@@ -214,18 +520,22 @@ async def generate_video_info(
             thumb_stream_index = int(stream["index"])
             break
 
-    thumb_path = await generate_thumbnail(vid_path, thumb_stream_index, duration)
+    thumb_path = thumb_path or await generate_thumbnail(
+        vid_path, thumb_stream_index, duration
+    )
     if not thumb_path:
         raise OSError("Thumbnail generation failed")
 
-    # Both `vid_path` & `thumb_path` are expanded and resolved
-    return VideosDataBase(
+    # `vid_path` is expanded and resolved, `thumb_path` is a name in the thumbnail store
+    video = VideosDataBase(
         id=sha512((str(vid_path) + str(thumb_path)).encode()).hexdigest(),
         title=vid_path.stem,
         video_path=str(vid_path),
         thumbnail_path=str(thumb_path),
         duration=duration,
         filesize=size,
-        modified_time=vid_path.stat().st_mtime,
-        extras=create_extras(ffprobe=video_probe),
+        modified_time=vid_stat.st_mtime,
+        fingerprint=VideoFingerprint.from_stat(str(vid_path), vid_stat),
     )
+    apply_probe(video, video_probe)
+    return video
@@ -0,0 +1,178 @@
+import asyncio
+import os
+from pathlib import Path
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+from rich.console import Console
+from sqlalchemy.engine import Engine
+
+from src.config import ROOT_DIRS, WATCH_RESCAN_INTERVAL, WATCH_SETTLE_SECONDS
+from src.data_store import run_in_session
+from src.jobs import reload_jobs
+from src.utils.discovery import (
+    FileEntry,
+    RootRules,
+    ScanErrorHandler,
+    root_rules,
+    walk_dirs,
+)
+from src.utils.fingerprints import load_known_files
+from src.utils.helpers import is_file_valid
+from src.utils.pipeline import IngestPipeline
+
+try:
+    from watchfiles import Change, awatch
+except ImportError:  # optional, without it only the periodic rescans run
+    awatch = None
+
+console = Console()
+
+
+class LogReporter:
+    """Watcher batches are a handful of files, their messages are enough"""
+
+    def queued(self, phase: str, count: int = 1):
+        pass
+
+    def done(self, phase: str, count: int = 1):
+        pass
+
+    def log(self, *objects: Any):
+        console.print(*objects)
+
+
+def signature(path: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class LibraryWatcher:
+    """Indexes files under `roots` as they're added/changed/removed (inotify)
+
+    A file is only picked up once it stopped changing for `settle` seconds, so
+    uploads still being written aren't probed half done. `rescan` (a full
+    reload) runs at start, for whatever changed while we were down, and every
+    `rescan_interval` seconds in case events were missed (e.g. queue overflow).
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        rescan: Callable[[], Any],
+        roots: Iterable[Path] = ROOT_DIRS,
+        *,
+        settle: float = WATCH_SETTLE_SECONDS,
+        rescan_interval: float = WATCH_RESCAN_INTERVAL,
+    ):
+        self.engine = engine
+        self.rescan = rescan
+        self.rules = [root_rules(root) for root in roots]
+        self.settle = settle
+        self.rescan_interval = rescan_interval
+        # path -> (last time it changed, size & mtime, whether it was added)
+        self.pending: dict[str, tuple[float, tuple[int, int] | None, bool]] = {}
+
+    def rules_for(self, path: str) -> RootRules | None:
+        return next((rules for rules in self.rules if rules.covers(path)), None)
+
+    async def run(self):
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.rescan_periodically())
+
+            if awatch is None:
+                console.print(
+                    "[yellow]watchfiles isn't installed, only rescanning periodically[/yellow]"
+                )
+                return
+
+            tg.create_task(self.watch())
+            tg.create_task(self.settle_pending())
+
+    async def rescan_periodically(self):
+        while True:
+            self.rescan()
+            await asyncio.sleep(self.rescan_interval)
+
+    async def watch(self):
+        roots = [rules.root for rules in self.rules if os.path.isdir(rules.root)]
+        try:
+            # No filter: `rules_for` decides, like the walk does
+            async for changes in awatch(*roots, watch_filter=None):
+                now = time.monotonic()
+                for change, path in changes:
+                    if not self.rules_for(path):
+                        continue
+
+                    # Directories are only walked when they appear (moved in)
+                    _, _, added = self.pending.get(path, (0, None, False))
+                    added = added or change == Change.added
+                    self.pending[path] = (now, signature(path), added)
+        except OSError as e:
+            # e.g. out of inotify watches, the periodic rescans still run
+            console.print("[red]Unable to watch the root dirs:[/red]", e)
+
+    async def settle_pending(self):
+        while True:
+            await asyncio.sleep(min(self.settle, 1.0))
+
+            if ready := self.settled():
+                try:
+                    await self.index(ready)
+                except Exception as e:
+                    console.print("[red]Unable to index changes:[/red]", e)
+
+    def settled(self) -> dict[str, bool]:
+        """Pending paths that didn't change for `settle` seconds -> whether added"""
+        now = time.monotonic()
+        ready = {}
+        for path, (changed, sig, added) in list(self.pending.items()):
+            current = signature(path)
+            if current != sig:
+                self.pending[path] = (now, current, added)
+            elif now - changed >= self.settle:
+                del self.pending[path]
+                ready[path] = added
+        return ready
+
+    async def index(self, paths: dict[str, bool]):
+        files, dirs, gone = [], [], []
+        for path, added in paths.items():
+            if os.path.isdir(path):
+                if added:
+                    dirs.append(path)
+            elif os.path.lexists(path):
+                if is_file_valid(FileEntry(path)):
+                    files.append(path)
+            else:
+                # A file, or a whole directory that was removed/moved out
+                gone.append(path)
+
+        if not (files or dirs or gone):
+            return
+
+        def entries(unreadable: ScanErrorHandler) -> Iterator:
+            yield from map(FileEntry, files)
+            starts = [(self.rules_for(path), path) for path in dirs]
+            yield from walk_dirs(
+                [(rules, path) for rules, path in starts if rules],
+                is_file_valid,
+                unreadable=unreadable,
+            )
+
+        # Reloads and watcher batches never write at the same time
+        async with reload_jobs.lock:
+            known = await asyncio.to_thread(
+                run_in_session, self.engine, load_known_files, files + gone, dirs + gone
+            )
+            pipeline = IngestPipeline(self.engine, entries, known, LogReporter())
+            await pipeline.run()
+
+        reconciler = pipeline.reconciler
+        console.print(
+            f"[cyan]Watcher: {reconciler.new} new, {reconciler.changed} changed, "
+            f"{len(reconciler.moved)} moved, {pipeline.removed} removed[/cyan]"
+        )
@@ -3,8 +3,12 @@ import {
 	showStatsBottom,
 	getUserName,
 	loginUser,
-	applyFilters,
+	buildListingQuery,
+	fetchVideoPage,
+	fetchSummary,
+	searchVideos,
 	getSortingState,
+	saveSortingConfig,
 } from "./main.js";
 
 let videos = [];
@@ -12,8 +16,10 @@ let isAndroid = (function() {
 	const userAgent = navigator.userAgent || navigator.vendor || window.opera;
 	return /android/i.test(userAgent);
 })();
-let prevBatch = [];
-const batchSize = 10;
+let nextCursor = null;
+let renderGeneration = 0; // Pages of an outdated listing are dropped
+const batchSize = 30;
+const searchLimit = 60;
 const videoGrid = document.querySelector("#videoGrid");
 const renderVideosObserver = new IntersectionObserver(renderNextBatch, {
 	rootMargin: "100px",
@@ -21,28 +27,6 @@ const renderVideosObserver = new IntersectionObserver(renderNextBatch, {
 let lastSelectedSort = null;
 let sortingState = getSortingState();
 
-async function fetchVideos(apiEndpoint = "/api/videos?extras=true") {
-	try {
-		const res = await fetch(apiEndpoint);
-		if (!res.ok) {
-			throw new Error("Request Wasn't Ok!");
-		}
-		const data = await res.json();
-		console.groupCollapsed("Video analysis...");
-		const videos = data.videos.map((vid) => {
-			vid.quality = MainModule.determineQuality(vid); // "4K" | "2K" | "FHD" | "HD" | "SD"
-			vid.orientation = MainModule.determineOrientation(vid); // "16:9" | "9:16" | "1:1"
-			vid.skip = false;
-			return vid;
-		});
-		console.groupEnd();
-		return videos;
-	} catch (error) {
-		console.error("Fetch videos error:", error);
-		return [];
-	}
-}
-
 function deleteVideo(videoData, cardElement) {
 	fetch("/api/video?video_id=" + videoData.id, {
 		method: "DELETE",
@@ -69,95 +53,71 @@ function deleteVideo(videoData, cardElement) {
 		});
 }
 
-function prepareVideos() {
-	videos = applyFilters(sortingState, videos);
-	return videos;
-}
-
-function renderVideos() {
-	// Reset DOM and scroll tracking
-	renderVideosObserver.disconnect();
-	videoGrid.innerHTML = "";
-	prevBatch = [];
-
-	// 1. Get the current, filtered/sorted list of videos
-	videos = prepareVideos();
-	const videosToRender = videos.filter((v) => !v.skip);
-
-	if (videosToRender.length === 0) {
-		console.warn("No videos found matching criteria.");
-		return;
-	}
-
-	// 2. Get the first batch using slice (from index 0, up to batchSize)
-	const newBatch = videosToRender.slice(0, batchSize);
-
-	// 3. Render the batch
-	newBatch.forEach((entry) => {
+function renderBatch(batch, atlas = null) {
+	batch.forEach((entry) => {
 		const renderedVideo = MainModule.renderVideo({
 			video: entry,
+			atlas,
 			deleteBtnCallback: deleteVideo,
 		});
 		renderedVideo.dataset.quality = entry.quality;
 		renderedVideo.dataset.orientation = entry.orientation;
 		videoGrid.appendChild(renderedVideo);
 	});
+	videos.push(...batch);
 
-	// 4. Update state and observer
-	prevBatch.push(...newBatch);
-
-	// Only observe if there are more videos left to load
-	if (videosToRender.length > prevBatch.length && videoGrid.lastChild) {
+	// Only observe if the server has more videos to give
+	if (nextCursor && videoGrid.lastChild) {
 		renderVideosObserver.observe(videoGrid.lastChild);
 	}
 }
 
-function renderNextBatch(observerEntries) {
-	observerEntries.forEach((entry) => {
-		if (!entry.isIntersecting) return;
-		renderVideosObserver.unobserve(entry.target);
+async function renderVideos() {
+	// Reset DOM and scroll tracking
+	renderVideosObserver.disconnect();
+	videoGrid.innerHTML = "";
+	videos = [];
 
-		const lastId = prevBatch.at(-1)?.id;
-		const startIndex = videos.findIndex((v) => v.id === lastId) + 1;
+	// Server sorts/filters, we only fetch the first page
+	const generation = ++renderGeneration;
+	const page = await fetchVideoPage(
+		buildListingQuery(sortingState, { limit: batchSize }),
+	);
+	if (generation !== renderGeneration) return;
 
-		if (!startIndex) {
-			console.error("Last rendered video not found");
-			return;
-		}
+	nextCursor = page.nextCursor;
+	if (page.videos.length === 0) {
+		console.warn("No videos found matching criteria.");
+		return;
+	}
 
-		const newBatch = videos
-			.slice(startIndex)
-			.filter((v) => !v.skip)
-			.slice(0, batchSize)
-			.filter(Boolean);
+	renderBatch(page.videos, page.atlas);
+}
 
-		if (newBatch.length === 0) {
-			console.log("No more un-skipped videos to load in the remaining list.");
-			return;
-		}
+function renderNextBatch(observerEntries) {
+	observerEntries.forEach(async (entry) => {
+		if (!entry.isIntersecting || !nextCursor) return;
+		renderVideosObserver.unobserve(entry.target);
 
-		// Render the batch
-		newBatch.forEach((vid) => {
-			const renderedVideo = MainModule.renderVideo({
-				video: vid,
-				deleteBtnCallback: deleteVideo,
-			});
-			renderedVideo.dataset.quality = vid.quality;
-			renderedVideo.dataset.orientation = vid.orientation;
-			videoGrid.appendChild(renderedVideo);
-		});
+		const generation = renderGeneration;
+		const page = await fetchVideoPage(
+			buildListingQuery(sortingState, { cursor: nextCursor, limit: batchSize }),
+		);
+		if (generation !== renderGeneration) return;
 
-		// Update state and set up observer
-		prevBatch.push(...newBatch);
-		if (videoGrid.lastChild) {
-			renderVideosObserver.observe(videoGrid.lastChild);
+		nextCursor = page.nextCursor;
+		if (page.videos.length === 0) {
+			console.log("No more videos to load.");
+			return;
 		}
+
+		renderBatch(page.videos, page.atlas);
 	});
 }
 
 function applySorting(filters) {
-	videos = applyFilters(filters, videos);
-	sortingState = getSortingState();
+	sortingState = { ...filters };
+	saveSortingConfig(sortingState);
 	renderVideos();
 }
 
@@ -193,9 +153,43 @@ function initilizeFilterDropdown() {
 	});
 }
 
+function followReload(jobId, onEnd) {
+	// The reload runs in the background, progress comes as server-sent events
+	const events = new EventSource(`/reload/${jobId}/events`);
+	const reloadBtn = document.getElementById("reloadBtn");
+
+	events.addEventListener("progress", (e) => {
+		const { phases } = JSON.parse(e.data);
+		reloadBtn.title = Object.entries(phases)
+			.map(([name, p]) => `${name}: ${p.done}/${p.total}`)
+			.join("\n");
+	});
+
+	events.addEventListener("end", (e) => {
+		events.close();
+		onEnd();
+		reloadBtn.title = "Reload the database";
+
+		const job = JSON.parse(e.data);
+		if (job.state === "done") {
+			MainModule.showToast("Reloading page...", "primary");
+			location.reload();
+		} else {
+			MainModule.showToast(`Server reload ${job.state}!`, "danger");
+			if (job.error) console.error("Reload failed:", job.error);
+		}
+	});
+
+	events.onerror = () => {
+		// Closed by the server or the network, don't let it reconnect forever
+		if (events.readyState === EventSource.CLOSED) onEnd();
+	};
+}
+
 document.addEventListener("DOMContentLoaded", async () => {
-	videos = await fetchVideos();
+	await MainModule.syncFavourites();
 	renderVideos(); // Home Button
+	const summary = await fetchSummary();
 
 	if (0) {
 		const homeButton = document.querySelector(".home-button");
@@ -203,7 +197,7 @@ document.addEventListener("DOMContentLoaded", async () => {
 	} // Video Count Extra Element
 
 	if (!isAndroid) {
-		document.getElementById("vidCount").textContent = `${videos.length}`;
+		document.getElementById("vidCount").textContent = `${summary.count}`;
 	} else {
 		document.getElementById("vidCount").remove();
 	} // Reload Button Element
@@ -211,29 +205,34 @@ document.addEventListener("DOMContentLoaded", async () => {
 	document.getElementById("reloadBtn").addEventListener("click", async (e) => {
 		const iElem = document.querySelector("#reloadBtn").querySelector("i");
 
+		// Add spin class to icon
+		iElem.classList.add("fa-spin");
+
 		try {
-			// Add spin class to icon
-			iElem.classList.add("fa-spin");
 			const response = await fetch(
 				"/reload" + (e.shiftKey ? "?hard=true" : ""),
 				{ method: "POST" },
 			);
-			if (response.ok) {
-				MainModule.showToast("Reloading page...", "primary");
-				location.reload();
-			} else {
+			if (!response.ok) {
 				MainModule.showToast("Server reload failed!", "danger");
 				console.error("Server returned error: " + response.status);
+				iElem.classList.remove("fa-spin");
+				return;
 			}
+
+			const job = await response.json();
+			MainModule.showToast(
+				job.started ? "Reload started..." : "Reload already running...",
+				"primary",
+			);
+			followReload(job.id, () => iElem.classList.remove("fa-spin"));
 		} catch (err) {
 			MainModule.showToast("Failed to send reload request!", "danger");
 			console.error("Fetch failed:", err);
-		} finally {
-			// Remove spin class from icon
 			iElem.classList.remove("fa-spin");
 		}
 	});
-	showStatsBottom(videos); // Search
+	showStatsBottom(summary); // Search
 
 	const searchDiv = document.querySelector("#searchVideos");
 	const clearSearch = searchDiv.querySelector('button[type="reset"]');
@@ -258,7 +257,7 @@ document.addEventListener("DOMContentLoaded", async () => {
 
 	searchInput.addEventListener(
 		"input",
-		debounce(() => {
+		debounce(async () => {
 			const searchTerm = searchInput.value.trim();
 			searchResults.innerHTML = ""; // clear before rendering new results
 
@@ -268,9 +267,9 @@ document.addEventListener("DOMContentLoaded", async () => {
 				return;
 			}
 
-			const results = videos.filter((v) =>
-				v.title.toLowerCase().includes(searchTerm.toLowerCase()),
-			);
+			const results = await searchVideos(searchTerm, searchLimit);
+			if (searchInput.value.trim() !== searchTerm) return; // outdated
+			searchResults.innerHTML = "";
 
 			if (results.length > 0) {
 				searchResults.classList.remove("empty");
@@ -1,99 +1,69 @@
 export const MainModule = (() => {
-    let favourites = JSON.parse(localStorage.getItem("favourites") || "[]");
-
-    if (!Array.isArray(favourites)) {
-        favourites = [];
-    }
-
-    function saveFavourites() {
-        localStorage.setItem("favourites", JSON.stringify(favourites));
-    }
-
-    function toggleFavourite(element, id) {
-        const index = favourites.indexOf(id);
-        if (index > -1) {
-            favourites.splice(index, 1);
-            element.classList.remove("active");
-            element.querySelector("i").className = "fa-solid fa-heart";
-            element.querySelector("i").style.color = "";
-        } else {
-            favourites.push(id);
-            element.classList.add("active");
-            element.querySelector("i").className = "fa-solid fa-heart";
-            element.querySelector("i").style.color = "var(--favourite)";
+    async function toggleFavourite(element, video) {
+        const favourite = !video.favourite;
+        try {
+            const res = await fetch(`/api/video?video_id=${video.id}`, {
+                method: "PATCH",
+                headers: { "Content-Type": "application/json" },
+                body: JSON.stringify({ favourite }),
+            });
+            if (!res.ok) throw new Error("Request Wasn't Ok!");
+        } catch (err) {
+            console.error("Toggle favourite error:", err);
+            showToast("Unable to update favourite!", "danger");
+            return false;
         }
-        saveFavourites();
-    }
 
-    function isFavourite(id) {
-        return favourites.includes(id);
+        video.favourite = favourite;
+        element.classList.toggle("active", favourite);
+        element.querySelector("i").className = "fa-solid fa-heart";
+        element.querySelector("i").style.color = favourite
+            ? "var(--favourite)"
+            : "";
+        return true;
     }
 
-    function determineQuality(video) {
-        if (
-            !video.extras ||
-            !video.extras.streams ||
-            video.extras.streams.length === 0
-        )
-            return "SD";
-
-        const getQuality = (stream) => {
-            const { width, height } = stream;
-            const pixels = width * height;
-
-            let quality = "SD";
-
-            if (pixels <= 640 * 480) quality = "SD";
-            else if (pixels <= 1280 * 720) quality = "HD";
-            else if (pixels <= 1920 * 1080) quality = "FHD";
-            else if (pixels <= 2560 * 1440) quality = "QHD";
-            else if (pixels <= 3840 * 2160) quality = "4K";
-            else if (pixels <= 5120 * 2880) quality = "5K";
-            else if (pixels <= 7680 * 4320) quality = "8K";
-            else quality = "UHD+";
-
-            console.log(
-                `Guessed quality of ${video.title.slice(0, 20).padEnd(23, ".")}: ${quality}`,
-            );
-            return quality;
-        };
-
-        const main = video.extras.streams.find((s) => s.profile === "Main");
-        return getQuality(main || video.extras.streams[0]);
+    // Favourites used to live in localStorage, push them to the server once
+    async function syncFavourites() {
+        const legacy = JSON.parse(localStorage.getItem("favourites") || "[]");
+        if (!Array.isArray(legacy) || legacy.length === 0) return;
+
+        await Promise.allSettled(
+            legacy.map((id) =>
+                fetch(`/api/video?video_id=${id}`, {
+                    method: "PATCH",
+                    headers: { "Content-Type": "application/json" },
+                    body: JSON.stringify({ favourite: true }),
+                }),
+            ),
+        );
+        localStorage.removeItem("favourites");
     }
 
-    function determineOrientation(video) {
-        if (!video.extras || !video.extras.streams?.length) return undefined;
-
-        let ratio = 1; // fallback 1:1
-        let orientation = "1:1";
-        const calculate = (w, h) => w / h;
-
-        for (const stream of video.extras.streams) {
-            if (stream.profile === "Main" || stream.codec_name !== "mjpeg") {
-                ratio = calculate(stream.width, stream.height);
-                break;
-            }
-        }
-
-        const close = (a, b, tolerance = 0.02) => Math.abs(a - b) < tolerance;
-
-        if (close(ratio, 16 / 9)) orientation = "16:9";
-        if (close(ratio, 9 / 16)) orientation = "9:16";
-
-        console.log(
-            `Guessed aspect ration of ${video.title.slice(0, 20).padEnd(23, ".")}: ${orientation} [${ratio}]`,
-        );
-        return orientation;
+    // Inline style showing `video`'s tile of a page atlas (one image for the page)
+    function spriteStyle(atlas, videoId) {
+        const offset = atlas?.tiles?.[videoId];
+        if (!offset) return null;
+
+        const [tileWidth, tileHeight] = atlas.tile;
+        const [width, height] = atlas.size;
+        const position = (value, size, tile) =>
+            size > tile ? (value / (size - tile)) * 100 : 0;
+        return [
+            `background-image: url('${atlas.url}')`,
+            `background-size: ${(width / tileWidth) * 100}% ${(height / tileHeight) * 100}%`,
+            `background-position: ${position(offset[0], width, tileWidth)}% ${position(offset[1], height, tileHeight)}%`,
+        ].join("; ");
     }
 
     function renderVideo({
         video,
+        atlas = null,
         favouriteBtnCallback = (element, videoData) => {
-            toggleFavourite(element, videoData.id);
+            return toggleFavourite(element, videoData);
         },
         isFavouriteCallback = (videoData) => {
-            return isFavourite(videoData.id);
+            return Boolean(videoData.favourite);
         },
         thumbnailCallback = (videoData) => {
             window.open(`watch?id=${videoData.id}`);
@@ -124,10 +94,15 @@ export const MainModule = (() => {
             return `${minutes}:${seconds.toString().padStart(2, "0")}`;
         }
 
+        const thumbnailUrl = video.thumbnail || `/api/thumbnail/${video.id}/latest`;
+        const sprite = spriteStyle(atlas, video.id);
+        const thumbnail = sprite
+            ? `<div id="vidThumbnail" class="sprite" role="img" aria-label="${video.title}" style="${sprite}"></div>`
+            : `<img id="vidThumbnail" src="${thumbnailUrl}" srcset="${thumbnailUrl}?size=grid 320w, ${thumbnailUrl}?size=card 640w, ${thumbnailUrl}?size=poster 1280w" sizes="(max-width: 600px) 100vw, 320px" loading="lazy" alt="${video.title}">`;
         const thumbnailContainer = document.createElement("div");
         thumbnailContainer.className = "thumbnail-box";
         thumbnailContainer.innerHTML = `
-        <img id="vidThumbnail" src="/api/thumbnail?video_id=${video.id}" loading="lazy" alt="${video.title}">
+        ${thumbnail}
         <div class="overlays">
         <div id="addFavBtn" class="overlay-item ${isFav ? "active" : ""}">
 			<i class="fa-solid fa-heart"></i>
@@ -144,13 +119,14 @@ export const MainModule = (() => {
         <div class="orientation badge bottom left">${video.orientation}</div>
         `;
         const favBtn = thumbnailContainer.querySelector("#addFavBtn");
-        favBtn.addEventListener("click", (event) => {
+        favBtn.addEventListener("click", async (event) => {
             event.stopPropagation();
-            favouriteBtnCallback(favBtn, video);
-            card.classList.toggle("favourite");
+            if (await favouriteBtnCallback(favBtn, video)) {
+                card.classList.toggle("favourite", Boolean(video.favourite));
+            }
         });
         thumbnailContainer
-            .querySelector("img")
+            .querySelector("#vidThumbnail")
             .addEventListener("click", () => thumbnailCallback(video));
 
         const delBtn = thumbnailContainer.querySelector("#deleteVidBtn");
@@ -259,12 +235,10 @@ export const MainModule = (() => {
     }
 
     return {
-        isFavourite: isFavourite,
+        syncFavourites: syncFavourites,
         renderVideo: renderVideo,
         showToast: showToast,
         getRelativeTime: getRelativeTime,
-        determineOrientation: determineOrientation,
-        determineQuality: determineQuality,
     };
 })();
 
@@ -283,65 +257,83 @@ export function saveSortingConfig(sortingState) {
     localStorage.setItem("sortingState", JSON.stringify(sortingState));
 }
 
-export function applyFilters(filters, videos) {
-    let localVideos = [...videos];
-    filterVideos(localVideos, filters);
-    sortVideos(localVideos, filters);
-    saveSortingConfig(filters);
-    return localVideos;
+// Turns the sorting state into `/api/videos` query params (the server sorts & filters)
+export function buildListingQuery(filters, { cursor, limit } = {}) {
+    const params = new URLSearchParams({
+        sort_by: filters.sortBy || "date",
+        sort_asc: Boolean(filters.sortAsc),
+        fav_first: Boolean(filters.favFirst),
+        orientation: filters.orientation || "all",
+        quality: filters.quality || "all",
+    });
+    cursor && params.set("cursor", cursor);
+    limit && params.set("limit", limit);
+    return params;
 }
 
-function filterVideos(videos, filters) {
-    videos.forEach((v) => {
-        v.skip = false;
-
-        // Orientation filter
-        if (filters.orientation !== "all") {
-            if (filters.orientation === "landscape" && v.orientation !== "16:9")
-                v.skip = true;
-            else if (filters.orientation === "portrait" && v.orientation !== "9:16")
-                v.skip = true;
-        }
-
-        // Quality filter
-        if (filters.quality !== "all") {
-            if (!v.skip) {
-                v.skip = filters.quality.toLowerCase() !== v.quality.toLowerCase();
-            }
+export async function fetchVideoPage(params) {
+    try {
+        const res = await fetch(`/api/videos?${params}`);
+        if (!res.ok) {
+            throw new Error("Request Wasn't Ok!");
         }
-    });
+        const data = await res.json();
+        return {
+            videos: Array.isArray(data.videos) ? data.videos : [],
+            nextCursor: data.next_cursor || null,
+            atlas: data.atlas || null,
+        };
+    } catch (error) {
+        console.error("Fetch videos error:", error);
+        return { videos: [], nextCursor: null, atlas: null };
+    }
 }
 
-function sortVideos(videos, filters) {
-    const sortMap = {
-        date: (v) => v.modified_time,
-        filesize: (v) => v.filesize,
-        duration: (v) => v.duration,
-    };
-
-    const keyFunc = sortMap[filters.sortBy];
-
-    if (!keyFunc) {
-        return;
+// The videos around one in the listing (nearest first) and ones related to it
+export async function fetchNeighbours(videoId, filters) {
+    try {
+        const params = buildListingQuery(filters);
+        params.set("video_id", videoId);
+        const res = await fetch(`/api/neighbours?${params}`);
+        if (!res.ok) throw new Error("Request Wasn't Ok!");
+        const data = await res.json();
+        return {
+            previous: data.previous || [],
+            next: data.next || [],
+            related: data.related || [],
+        };
+    } catch (error) {
+        console.error("Fetch neighbours error:", error);
+        return { previous: [], next: [], related: [] };
     }
+}
 
-    videos.sort((a, b) => {
-        const A = keyFunc(a);
-        const B = keyFunc(b);
-
-        if (filters.favFirst) {
-            const aFav = MainModule.isFavourite(a.id);
-            const bFav = MainModule.isFavourite(b.id);
-
-            if (aFav !== bFav) return aFav ? -1 : 1;
-        }
+// Ranked title search (prefix matching on every word) done by the server
+export async function searchVideos(searchTerm, limit) {
+    try {
+        const params = new URLSearchParams({ q: searchTerm, limit });
+        const res = await fetch(`/api/search?${params}`);
+        if (!res.ok) throw new Error("Request Wasn't Ok!");
+        const data = await res.json();
+        return Array.isArray(data.videos) ? data.videos : [];
+    } catch (error) {
+        console.error("Search videos error:", error);
+        return [];
+    }
+}
 
-        if (A === B) return 0;
-        return filters.sortAsc ? A - B : B - A;
-    });
+export async function fetchSummary() {
+    try {
+        const res = await fetch("/api/summary");
+        if (!res.ok) throw new Error("Request Wasn't Ok!");
+        return await res.json();
+    } catch (error) {
+        console.error("Fetch summary error:", error);
+        return { count: 0, filesize: 0, favourites: 0 };
+    }
 }
 
-export function showStatsBottom(videos) {
+export function showStatsBottom(summary) {
     let statsBottom = document.getElementById("statsBottom");
 
     if (!statsBottom) {
@@ -350,16 +342,11 @@ export function showStatsBottom(videos) {
         document.body.appendChild(statsBottom);
     }
 
-    const totalVideos = videos.length;
-    const totalSizeInBytes = videos.reduce(
-        (acc, video) => acc + Number(video.filesize || 0),
-        0,
-    );
+    const totalVideos = summary.count;
+    const totalSizeInBytes = Number(summary.filesize || 0);
     const totalSizeMB = (totalSizeInBytes / 1024 ** 2).toFixed(2);
     const totalSizeGB = (totalSizeInBytes / 1024 ** 3).toFixed(2);
-
-    const favourites = JSON.parse(localStorage.getItem("favourites") || "[]");
-    const totalFavourites = favourites.length;
+    const totalFavourites = summary.favourites;
 
     statsBottom.innerHTML = `
         <span>Total Videos: <strong>${totalVideos}</strong></span>
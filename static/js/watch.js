@@ -3,9 +3,14 @@ import {
 	showStatsBottom,
 	getUserName,
 	loginUser,
-	applyFilters,
+	buildListingQuery,
+	fetchVideoPage,
+	fetchNeighbours,
+	fetchSummary,
+	searchVideos,
 	showModal,
 	getSortingState,
+	saveSortingConfig,
 } from "./main.js";
 
 // --- Global DOM Element References ---
@@ -14,16 +19,22 @@ const retryButton = document.getElementById("retryButton");
 const refreshButton = document.getElementById("refreshVideos");
 const downloadBtn = document.getElementById("downloadBtn");
 const videoGrid = document.getElementById("videoGrid");
+const relatedVideos = document.getElementById("relatedVideos");
+const relatedGrid = document.getElementById("relatedGrid");
 
 // --- Global / Module variables ---
 let videoId = new URLSearchParams(window.location.search).get("id");
 let videos = [];
+// Previous/next in the listing & related videos of `neighbours.videoId`
+let neighbours = { videoId: null, previous: [], next: [], related: [] };
 const isAndroid = (() => {
 	const ua = navigator.userAgent || navigator.vendor || window.opera;
 	return /android/i.test(ua);
 })();
-let prevBatch = [];
-const batchSize = 10;
+let nextCursor = null;
+let renderGeneration = 0; // Pages of an outdated listing are dropped
+const batchSize = 30;
+const searchLimit = 60;
 const renderVideoObserver = new IntersectionObserver(renderNextBatch, {
 	rootMargin: "100px",
 });
@@ -37,36 +48,28 @@ let keyboardShortcutsBound = false;
 
 /* -------------------- Utils -------------------- */
 const UtilsModule = (() => {
-	const playPrev = () => {
-		let prevVideo = document.querySelector(
-			`[data-video-id="${videoId}"]`,
-		).previousSibling;
-		if (!prevVideo) {
-			console.info("No previous video from:", videoId);
-			MainModule.showToast("No Previous Video", "warning");
-			return;
-		}
-
-		console.info("Playing prev video:", prevVideo.dataset.videoId);
-		videoId = prevVideo.dataset.videoId;
-		PlayerModule.initialize(true);
-		UtilsModule.updateVideoGrid();
-	};
-	const playNext = () => {
-		let nextVideo = document.querySelector(
-			`[data-video-id="${videoId}"]`,
-		).nextSibling;
-		if (!nextVideo) {
-			console.info("No next video from:", videoId);
-			MainModule.showToast("No Next Video", "warning");
+	// From the server's neighbours, the video may be past the loaded pages
+	const playAdjacent = async (direction) => {
+		if (neighbours.videoId !== videoId) await loadNeighbours();
+
+		const adjacent = neighbours[direction][0];
+		if (!adjacent) {
+			console.info(`No ${direction} video from:`, videoId);
+			MainModule.showToast(
+				direction === "next" ? "No Next Video" : "No Previous Video",
+				"warning",
+			);
 			return;
 		}
 
-		console.info("Playing next video:", nextVideo.dataset.videoId);
-		videoId = nextVideo.dataset.videoId;
+		console.info(`Playing ${direction} video:`, adjacent.id);
+		videoId = adjacent.id;
 		PlayerModule.initialize(true);
 		UtilsModule.updateVideoGrid();
+		setVideoInfoAndPageTitle();
 	};
+	const playPrev = () => playAdjacent("previous");
+	const playNext = () => playAdjacent("next");
 
 	function updateVideoGrid() {
 		videoGrid.childNodes.forEach((el) => {
@@ -223,7 +226,12 @@ const PlayerModule = (() => {
 			return;
 		}
 
-		currentVideoData = videos.find((i) => i.id === videoId);
+		currentVideoData = [
+			...videos,
+			...neighbours.previous,
+			...neighbours.next,
+			...neighbours.related,
+		].find((i) => i.id === videoId);
 		const newUrl = new URL(window.location.href);
 		newUrl.searchParams.set("id", videoId);
 		window.history.pushState({ path: newUrl.href }, "", newUrl.href);
@@ -233,14 +241,21 @@ const PlayerModule = (() => {
 
 		renderPlayer(playOnDone);
 		setVideoInfo();
+		loadNeighbours();
 	}
 
 	function renderPlayer(playOnDone) {
 		if (!playerElement || !(playerElement instanceof HTMLVideoElement)) return;
 
 		const videoUrl = `/api/video?video_id=${videoId}`;
-		const thumbnailUrl = `/api/thumbnail?video_id=${videoId}`;
-		playerElement.src = videoUrl;
+		const thumbnailUrl = currentVideoData?.thumbnail
+			? `${currentVideoData.thumbnail}?size=poster`
+			: `/api/thumbnail?video_id=${videoId}&size=poster`;
+		// Where HLS plays natively (Safari, phones) the video streams in segments,
+		// so it starts just as fast however big it is or wherever its index sits
+		const hlsUrl = `/api/hls/${videoId}.m3u8`;
+		const useHls = playerElement.canPlayType("application/vnd.apple.mpegurl") !== "";
+		playerElement.src = useHls ? hlsUrl : videoUrl;
 		playerElement.poster = thumbnailUrl;
 
 		playerElement.onloadedmetadata = () => {
@@ -250,12 +265,18 @@ const PlayerModule = (() => {
 		};
 
 		playerElement.onerror = (e) => {
+			if (useHls && playerElement.src.includes("/api/hls/")) {
+				// Couldn't be segmented, play the file itself
+				playerElement.src = videoUrl;
+				return;
+			}
 			console.error(e);
 			MainModule.showToast("Video loading failed!", "danger");
 		};
 
 		// ensure keyboard shortcuts bound and reference the native element
 		setupKeyboardShortcuts(() => playerElement);
+		loadScrubPreview(videoId);
 
 		// fullscreen change visual adjustment
 		document.addEventListener("fullscreenchange", () => {
@@ -265,6 +286,93 @@ const PlayerModule = (() => {
 		});
 	}
 
+	// Frame previews under the player, the sheet is made on the first watch
+	async function loadScrubPreview(id, attempt = 0) {
+		const scrubBar = document.getElementById("scrubBar");
+		if (!scrubBar) return;
+		if (attempt === 0) {
+			scrubBar.hidden = true;
+			playerElement.querySelector("track#scrubTrack")?.remove();
+		}
+
+		let res;
+		try {
+			res = await fetch(`/api/scrub/${id}`);
+		} catch (error) {
+			console.error("Scrub preview error:", error);
+			return;
+		}
+		if (id !== videoId) return;
+		if (res.status === 202) {
+			attempt < 40 && setTimeout(() => loadScrubPreview(id, attempt + 1), 3000);
+			return;
+		}
+		if (!res.ok) return;
+
+		const { state, vtt } = await res.json();
+		if (state !== "ready") return;
+
+		const trackElement = document.createElement("track");
+		trackElement.id = "scrubTrack";
+		trackElement.kind = "metadata";
+		trackElement.src = vtt;
+		trackElement.addEventListener("load", () => {
+			if (id === videoId) setupScrubBar(scrubBar, trackElement.track);
+		});
+		playerElement.appendChild(trackElement);
+		// Hidden tracks still load their cues
+		trackElement.track.mode = "hidden";
+	}
+
+	function setupScrubBar(scrubBar, track) {
+		const preview = scrubBar.querySelector(".scrub-preview");
+		const frame = scrubBar.querySelector(".scrub-frame");
+		const label = scrubBar.querySelector(".scrub-time");
+		const cues = Array.from(track.cues || []);
+		if (!cues.length) return;
+
+		const duration = () =>
+			playerElement.duration || currentVideoData?.duration || cues.at(-1).endTime;
+		const timeAt = (event) => {
+			const rect = scrubBar.getBoundingClientRect();
+			const ratio = Math.min(Math.max((event.clientX - rect.left) / rect.width, 0), 1);
+			return { time: ratio * duration(), x: event.clientX - rect.left };
+		};
+
+		scrubBar.onpointermove = (event) => {
+			const { time, x } = timeAt(event);
+			const cue =
+				cues.find((c) => time >= c.startTime && time < c.endTime) || cues.at(-1);
+			const [url, hash] = cue.text.split("#xywh=");
+			const [left, top, width, height] = hash.split(",").map(Number);
+
+			frame.style.width = `${width}px`;
+			frame.style.height = `${height}px`;
+			frame.style.backgroundImage = `url('${url}')`;
+			frame.style.backgroundPosition = `-${left}px -${top}px`;
+			label.innerText = formatTime(time);
+
+			const half = width / 2;
+			preview.style.left = `${Math.min(Math.max(x, half), scrubBar.clientWidth - half)}px`;
+			preview.classList.add("visible");
+		};
+		scrubBar.onpointerleave = () => preview.classList.remove("visible");
+		scrubBar.onclick = (event) => {
+			playerElement.currentTime = timeAt(event).time;
+		};
+		scrubBar.hidden = false;
+	}
+
+	function formatTime(seconds) {
+		const total = Math.floor(seconds);
+		const hours = Math.floor(total / 3600);
+		const minutes = Math.floor((total % 3600) / 60);
+		const secs = (total % 60).toString().padStart(2, "0");
+		return hours
+			? `${hours}:${minutes.toString().padStart(2, "0")}:${secs}`
+			: `${minutes}:${secs}`;
+	}
+
 	function setVideoInfo() {
 		const videoInfoContainer = document.querySelector("div.info-container");
 		const videoTitleContainer = document.querySelector("div.title-container");
@@ -299,6 +407,10 @@ const PlayerModule = (() => {
 				icon: `<i class="fa-solid fa-video"></i>`,
 				content: `${currentVideoData.quality || "SD"} (${currentVideoData.orientation || "?"})`,
 			},
+			{
+				icon: `<i class="fa-solid fa-film"></i>`,
+				content: `${(currentVideoData.codec || "?").toUpperCase()} • ${currentVideoData.frame_rate || "?"}fps`,
+			},
 			{
 				icon: `<i class="fa-solid fa-database"></i>`,
 				content: `${((currentVideoData.filesize ?? 0) / 1024 ** 2).toFixed(2)}MB`,
@@ -539,6 +651,36 @@ const PlayerModule = (() => {
 				],
 				postFunc: null,
 			},
+			{
+				content: `<i class="fa-solid fa-circle-info"></i>`,
+				props: [{ key: "title", value: "Show full probe info" }],
+				eventListeners: [
+					{
+						event: "click",
+						handler: async () => {
+							// The full probe is only fetched when asked for
+							try {
+								const res = await fetch(`/api/probe?video_id=${videoId}`);
+								if (!res.ok) throw new Error("Unable to get probe!");
+								const pre = document.createElement("pre");
+								pre.textContent = JSON.stringify(await res.json(), null, 2);
+								showModal({
+									content: "<h1>Probe</h1>",
+									applyFn: (modal) => {
+										pre.style.overflow = "auto";
+										pre.style.maxHeight = "60dvh";
+										modal.appendChild(pre);
+									},
+								});
+							} catch (err) {
+								console.error(err);
+								MainModule.showToast("Failed!", "danger");
+							}
+						},
+					},
+				],
+				postFunc: null,
+			},
 			{
 				content: `<i class="fa-solid fa-trash"></i>`,
 				props: [
@@ -728,30 +870,6 @@ const PlayerModule = (() => {
 	return { initialize, setVideoInfo };
 })();
 
-/* -------------------- Fetch & Prepare -------------------- */
-async function fetchVideos(apiEndpoint = "/api/videos?extras=true") {
-	try {
-		const res = await fetch(apiEndpoint);
-		if (!res.ok) throw new Error("Request wasn't ok");
-		const data = await res.json();
-
-		console.groupCollapsed("Video analysis...");
-		const parsed = (Array.isArray(data.videos) ? data.videos : []).map(
-			(vid) => {
-				vid.quality = MainModule.determineQuality(vid);
-				vid.orientation = MainModule.determineOrientation(vid);
-				vid.skip = false;
-				return vid;
-			},
-		);
-		console.groupEnd();
-		return parsed;
-	} catch (error) {
-		console.error("Fetch videos error:", error);
-		return [];
-	}
-}
-
 /* -------------------- Delete -------------------- */
 function deleteVideo(videoData, cardElement) {
 	fetch("/api/video?video_id=" + videoData.id, {
@@ -776,91 +894,87 @@ function deleteVideo(videoData, cardElement) {
 		});
 }
 
-/* -------------------- Sorting / Preparing list -------------------- */
-function prepareVideos() {
-	videos = applyFilters(sortingState, videos);
-	return videos;
+/* -------------------- Rendering -------------------- */
+function renderBatch(batch) {
+	batch.forEach((entry) => {
+		videoGrid.appendChild(UtilsModule.renderVideo(entry));
+	});
+	videos.push(...batch);
+
+	// Only observe if the server has more videos to give
+	if (nextCursor && videoGrid.lastChild) {
+		renderVideoObserver.observe(videoGrid.lastChild);
+	}
 }
 
-/* -------------------- Rendering -------------------- */
-function renderVideos() {
+async function renderVideos() {
 	// Reset DOM and scroll tracking
 	renderVideoObserver.disconnect();
 	videoGrid.innerHTML = "";
-	prevBatch = [];
+	videos = [];
 
-	// 1. Get the current, filtered/sorted list of videos
-	videos = prepareVideos();
-	const videosToRender = videos.filter((v) => !v.skip);
+	// Server sorts/filters, we only fetch the first page
+	const generation = ++renderGeneration;
+	const page = await fetchVideoPage(
+		buildListingQuery(sortingState, { limit: batchSize }),
+	);
+	if (generation !== renderGeneration) return;
 
-	if (videosToRender.length === 0) {
+	nextCursor = page.nextCursor;
+	if (page.videos.length === 0) {
 		console.warn("No videos found matching criteria.");
 		return;
 	}
 
-	// 2. Get the first batch using slice (from index 0, up to batchSize)
-	const newBatch = videosToRender.slice(0, batchSize);
-
-	// 3. Render the batch
-	newBatch.forEach((entry) => {
-		const renderedVideo = UtilsModule.renderVideo(entry);
-		videoGrid.appendChild(renderedVideo);
-		return;
-	});
-
-	// 4. Update state and observer
-	prevBatch.push(...newBatch);
-
-	// Only observe if there are more videos left to load
-	if (videosToRender.length > prevBatch.length && videoGrid.lastChild) {
-		renderVideoObserver.observe(videoGrid.lastChild);
-	}
+	renderBatch(page.videos);
 }
 
 function renderNextBatch(observerEntries) {
-	observerEntries.forEach((entry) => {
-		if (!entry.isIntersecting) return;
+	observerEntries.forEach(async (entry) => {
+		if (!entry.isIntersecting || !nextCursor) return;
 		renderVideoObserver.unobserve(entry.target);
 
-		const lastId = prevBatch.at(-1)?.id;
-		const startIndex = videos.findIndex((v) => v.id === lastId) + 1;
+		const generation = renderGeneration;
+		const page = await fetchVideoPage(
+			buildListingQuery(sortingState, { cursor: nextCursor, limit: batchSize }),
+		);
+		if (generation !== renderGeneration) return;
 
-		if (!startIndex) {
-			console.error("Last rendered video not found");
+		nextCursor = page.nextCursor;
+		if (page.videos.length === 0) {
+			console.log("No more videos to load.");
 			return;
 		}
 
-		const newBatch = videos
-			.slice(startIndex)
-			.filter((v) => !v.skip)
-			.slice(0, batchSize)
-			.filter(Boolean);
+		renderBatch(page.videos);
+	});
+}
 
-		if (newBatch.length === 0) {
-			console.log("No more un-skipped videos to load in the remaining list.");
-			return;
-		}
+/* -------------------- Neighbours -------------------- */
+async function loadNeighbours() {
+	const id = videoId;
+	const found = await fetchNeighbours(id, sortingState);
+	// Moved on to another video meanwhile
+	if (id !== videoId) return;
 
-		// Render the batch
-		newBatch.forEach((vid) => {
-			const renderedVideo = UtilsModule.renderVideo(vid);
-			videoGrid.appendChild(renderedVideo);
-			return;
-		});
+	neighbours = { videoId: id, ...found };
+	renderRelated(found.related);
+}
 
-		// Update state and set up observer
-		prevBatch.push(...newBatch);
-		if (videoGrid.lastChild) {
-			renderVideoObserver.observe(videoGrid.lastChild);
-		}
+function renderRelated(related) {
+	relatedGrid.innerHTML = "";
+	related.forEach((entry) => {
+		relatedGrid.appendChild(UtilsModule.renderVideo(entry));
 	});
+	relatedVideos.hidden = related.length === 0;
 }
 
 /* -------------------- Sort state setter -------------------- */
 function applySorting(filters) {
-	videos = applyFilters(filters, videos);
-	sortingState = getSortingState();
+	sortingState = { ...filters };
+	saveSortingConfig(sortingState);
 	renderVideos();
+	loadNeighbours();
 }
 
 function initilizeFilterDropdown() {
@@ -899,7 +1013,7 @@ function initilizeFilterDropdown() {
 /* -------------------- Player info fetcher -------------------- */
 function setVideoInfoAndPageTitle() {
 	if (!videoId) return;
-	fetch(`/api/stats?video_id=${videoId}&extras=true`)
+	fetch(`/api/stats?video_id=${videoId}`)
 		.then((resp) => {
 			if (!resp.ok) throw new Error("Unable to get video stats!");
 			return resp.json();
@@ -907,9 +1021,6 @@ function setVideoInfoAndPageTitle() {
 		.then((vidData) => {
 			currentVideoData = vidData || null;
 			if (!currentVideoData) return;
-			currentVideoData.quality = MainModule.determineQuality(currentVideoData);
-			currentVideoData.orientation =
-				MainModule.determineOrientation(currentVideoData);
 			document.title = currentVideoData.title || document.title;
 			PlayerModule.setVideoInfo();
 		})
@@ -930,27 +1041,24 @@ document.addEventListener("DOMContentLoaded", async () => {
 	PlayerModule.initialize();
 	setVideoInfoAndPageTitle();
 
-	// fetch videos (global var)
-	videos = await fetchVideos();
-	renderVideos();
+	// fetch the first page of videos (global var)
+	await renderVideos();
 
 	// Retry button
 	retryButton?.addEventListener("click", PlayerModule.initialize);
 
 	// Refresh
-	refreshButton?.addEventListener("click", async () => {
-		videos = await fetchVideos();
-		renderVideos();
-	});
+	refreshButton?.addEventListener("click", renderVideos);
 
 	// vidCount
+	const summary = await fetchSummary();
 	const vidCountEl = document.getElementById("vidCount");
 	if (vidCountEl) {
-		if (!isAndroid) vidCountEl.innerText = `${videos.length}`;
+		if (!isAndroid) vidCountEl.innerText = `${summary.count}`;
 		else vidCountEl.remove();
 	}
 
-	showStatsBottom(videos);
+	showStatsBottom(summary);
 
 	// Search UI
 	const searchDiv = document.querySelector("#searchVideos");
@@ -979,7 +1087,7 @@ document.addEventListener("DOMContentLoaded", async () => {
 
 		searchInput?.addEventListener(
 			"input",
-			debounce(() => {
+			debounce(async () => {
 				const searchTerm = searchInput.value.trim();
 				if (!searchResults) return;
 				searchResults.innerHTML = "";
@@ -990,11 +1098,9 @@ document.addEventListener("DOMContentLoaded", async () => {
 					return;
 				}
 
-				const results = videos.filter((v) =>
-					String(v.title || "")
-						.toLowerCase()
-						.includes(searchTerm.toLowerCase()),
-				);
+				const results = await searchVideos(searchTerm, searchLimit);
+				if (searchInput.value.trim() !== searchTerm) return; // outdated
+				searchResults.innerHTML = "";
 
 				if (results.length > 0) {
 					searchResults.classList.remove("empty");